@@ -0,0 +1,374 @@
+from __future__ import print_function
+
+"""
+# =============================================================================
+
+Copyright Government of Canada 2015
+
+Funded by the National Micriobiology Laboratory
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+
+# =============================================================================
+"""
+
+# Times parse_yaml, validate_config and map_tool_to_destination on synthetic
+# configs of several sizes, and on synthetic jobs built with tests/mockGalaxy.py.
+# Reports latency percentiles and throughput per call, and can save them as JSON
+# to compare runs.
+#
+# Run from the root of the repository:
+#
+#     python -m benchmarks.mapping --tools 10,1000 --output before.json
+#     python -m benchmarks.mapping --tools 10,1000 --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from benchmarks.records import write_fasta
+from dynamic_tool_destination import DynamicToolDestination as dt
+from tests import mockGalaxy as mg
+
+# the most precise clock available
+timer = getattr(time, 'perf_counter', time.time)
+
+PRIORITIES = ('low', 'med', 'high')
+USERS = ['user' + str(number) + '@email.com' for number in range(20)]
+
+
+def generate_destination(rng, name):
+    """
+    Make either a plain destination or one per priority.
+    """
+    if rng.random() < 0.3:
+        return {'priority': dict((priority, name + '_' + priority)
+                                 for priority in PRIORITIES)}
+    return name
+
+
+def generate_rule(rng, number):
+    """
+    Make a random valid rule of any rule_type.
+    """
+    rule_type = rng.choice(['file_size', 'records', 'num_input_datasets', 'arguments'])
+    rule = {
+        'rule_type': rule_type,
+        'nice_value': rng.randint(-20, 20),
+        'destination': generate_destination(rng, 'cluster_' + str(number % 50)),
+    }
+
+    if rule_type == 'file_size':
+        lower = rng.randint(0, 1000)
+        rule['lower_bound'] = str(lower) + ' KB'
+        if rng.random() < 0.2:
+            rule['upper_bound'] = 'Infinity'
+        else:
+            rule['upper_bound'] = str(lower + rng.randint(1, 100000)) + ' KB'
+    elif rule_type == 'records':
+        lower = rng.randint(0, 10000)
+        rule['lower_bound'] = lower
+        if rng.random() < 0.2:
+            rule['upper_bound'] = 'Infinity'
+        else:
+            rule['upper_bound'] = lower + rng.randint(1, 100000)
+    elif rule_type == 'num_input_datasets':
+        lower = rng.randint(0, 20)
+        rule['lower_bound'] = lower
+        if rng.random() < 0.2:
+            rule['upper_bound'] = 'Infinity'
+        else:
+            rule['upper_bound'] = lower + rng.randint(1, 20)
+    else:
+        rule['arguments'] = rng.choice([
+            {'careful': rng.choice([True, False])},
+            {'mlst_or_genedb.vfdb_in': rng.choice(['-bact', '-other'])},
+        ])
+
+    if rng.random() < 0.05:
+        rule['destination'] = 'fail'
+        rule['fail_message'] = 'Rule ' + str(number) + ' rejected the job'
+
+    if rng.random() < 0.1:
+        rule['users'] = rng.sample(USERS, rng.randint(1, 3))
+
+    return rule
+
+
+def generate_config(rng, tools, min_rules, max_rules, settings=None):
+    """
+    Make a config for tools tools with min_rules to max_rules rules each.
+    """
+    config = {
+        'tools': {},
+        'default_destination': generate_destination(rng, 'cluster_default'),
+        'users': dict((user, {'priority': rng.choice(PRIORITIES)})
+                      for user in USERS[:10]),
+        'verbose': False,
+    }
+    if settings:
+        config['settings'] = settings
+
+    for number in range(tools):
+        tool_config = {
+            'rules': [generate_rule(rng, rule_number)
+                      for rule_number in range(rng.randint(min_rules, max_rules))]
+        }
+        if rng.random() < 0.5:
+            tool_config['default_destination'] = generate_destination(
+                rng, 'tool_default_' + str(number % 10))
+        config['tools']['tool' + str(number)] = tool_config
+
+    return config
+
+
+def generate_inputs(directory, fasta_sizes):
+    """
+    Write a FASTA file of each of fasta_sizes and a few other inputs.
+
+    @return: the FASTA files and the other files
+    """
+    fasta_files = []
+    for number, size in enumerate(fasta_sizes):
+        file_name = os.path.join(directory, 'input' + str(number) + '.fasta')
+        write_fasta(file_name, size, 1000, 60)
+        fasta_files.append(file_name)
+
+    other_files = []
+    for number in range(4):
+        file_name = os.path.join(directory, 'input' + str(number) + '.txt')
+        with open(file_name, 'wb') as stream:
+            stream.write(b'A' * (1024 * 4 ** number))
+        other_files.append(file_name)
+
+    return fasta_files, other_files
+
+
+def generate_job(rng, fasta_files, other_files, max_inputs):
+    """
+    Make a mock job with 1 to max_inputs inputs.
+    """
+    job = mg.Job()
+    for number in range(rng.randint(1, max_inputs)):
+        if fasta_files and rng.random() < 0.5:
+            # FASTA inputs without metadata have their records counted
+            sequences = rng.choice([None, rng.randint(1, 100000)])
+            dataset = mg.Dataset(rng.choice(fasta_files), 'fasta', sequences)
+        else:
+            dataset = mg.Dataset(rng.choice(other_files), 'txt', None)
+        job.add_input_dataset(mg.InputDataset('input' + str(number), dataset))
+
+    job.set_arg_value('careful', rng.choice([True, False]))
+    job.set_arg_value('mlst_or_genedb', {'vfdb_in': rng.choice(['-bact', '-other'])})
+    return job
+
+
+def time_calls(function, calls):
+    """
+    Call function calls times.
+
+    @return: the latency of each call, in seconds
+    """
+    latencies = []
+    for number in range(calls):
+        start = timer()
+        function(number)
+        latencies.append(timer() - start)
+    return latencies
+
+
+def percentile(ordered, fraction):
+    """
+    Get the value below which fraction of the sorted values ordered fall.
+    """
+    position = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[position]
+
+
+def summarize(latencies):
+    """
+    Get the percentiles of latencies and the throughput they amount to.
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        'calls': len(ordered),
+        'mean': total / len(ordered),
+        'p50': percentile(ordered, 0.5),
+        'p90': percentile(ordered, 0.9),
+        'p99': percentile(ordered, 0.99),
+        'max': ordered[-1],
+        'throughput': len(ordered) / total if total > 0 else None,
+    }
+
+
+def benchmark_scale(rng, directory, tools, args, fasta_files, other_files):
+    """
+    Time the three operations on a config of tools tools.
+
+    @return: the summaries, by operation
+    """
+    settings = None
+    if args.disable_caches:
+        settings = {'decision_cache_size': 0, 'dataset_cache_size': 0}
+    config = generate_config(rng, tools, args.min_rules, args.max_rules, settings)
+    config_path = os.path.join(directory, 'tool_destinations_' + str(tools) + '.yml')
+    with open(config_path, 'w') as stream:
+        yaml.safe_dump(config, stream, default_flow_style=False)
+
+    results = {}
+
+    parsed = []
+    results['parse_yaml'] = summarize(time_calls(
+        lambda number: parsed.append(dt.parse_yaml(config_path)),
+        args.parse_calls))
+
+    with open(config_path) as stream:
+        loaded = yaml.safe_load(stream)
+    results['validate_config'] = summarize(time_calls(
+        lambda number: dt.validate_config(loaded), args.parse_calls))
+
+    tool_ids = sorted(config['tools'])
+    app = mg.App('cluster_default', '-q test.q')
+    jobs = []
+    for number in range(args.map_calls):
+        tool = mg.Tool(rng.choice(tool_ids))
+        job = generate_job(rng, fasta_files, other_files, args.max_inputs)
+        jobs.append((job, tool, rng.choice(USERS)))
+
+    def map_job(number):
+        job, tool, user = jobs[number]
+        try:
+            dt.map_tool_to_destination(job, app, tool, user, True, config_path)
+        except mg.JobMappingException:
+            # jobs sent to 'fail' are mapped all the same
+            pass
+
+    # the config is loaded once before timing, like in a running Galaxy; how long
+    # that takes is what parse_yaml measures
+    dt.clear_caches()
+    dt.get_compiled_config(config_path)
+    results['map_tool_to_destination'] = summarize(time_calls(map_job, args.map_calls))
+
+    rules = sum(len(tool_config['rules']) for tool_config in config['tools'].values())
+    return {
+        'tools': tools,
+        'rules': rules,
+        'config_size': os.path.getsize(config_path),
+        'operations': results,
+    }
+
+
+def print_results(results, baseline=None):
+    """
+    Print a table of results, with how much faster than baseline each median is.
+    """
+    previous = {}
+    if baseline is not None:
+        for scale in baseline['scales']:
+            for operation, summary in scale['operations'].items():
+                previous[(scale['tools'], operation)] = summary
+
+    for scale in results['scales']:
+        print("%d tools, %d rules, config of %s" % (
+            scale['tools'], scale['rules'], dt.bytes_to_str(scale['config_size'])))
+        for operation in ('parse_yaml', 'validate_config', 'map_tool_to_destination'):
+            summary = scale['operations'][operation]
+            line = "  %-24s %6d calls  p50 %10.3f ms  p90 %10.3f ms  p99 %10.3f ms" % (
+                operation, summary['calls'], summary['p50'] * 1000,
+                summary['p90'] * 1000, summary['p99'] * 1000)
+            if summary['throughput'] is not None:
+                line += "  %10.1f calls/s" % summary['throughput']
+            before = previous.get((scale['tools'], operation))
+            if before is not None and summary['p50'] > 0:
+                line += "  %6.2fx" % (before['p50'] / summary['p50'])
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time parsing, validating and mapping with synthetic configs '
+        'and jobs.')
+    parser.add_argument('--tools', default="10,1000,10000",
+                        help='comma separated numbers of tools in the configs '
+                        '(default: 10,1000,10000)')
+    parser.add_argument('--min-rules', type=int, default=1,
+                        help='fewest rules per tool (default: 1)')
+    parser.add_argument('--max-rules', type=int, default=200,
+                        help='most rules per tool (default: 200)')
+    parser.add_argument('--parse-calls', type=int, default=3,
+                        help='how many times to parse and validate each config '
+                        '(default: 3)')
+    parser.add_argument('--map-calls', type=int, default=1000,
+                        help='how many jobs to map with each config (default: 1000)')
+    parser.add_argument('--max-inputs', type=int, default=20,
+                        help='most inputs per job (default: 20)')
+    parser.add_argument('--fasta-sizes', default="1 MB,10 MB",
+                        help='comma separated sizes of the FASTA inputs (default: '
+                        '1 MB,10 MB)')
+    parser.add_argument('--disable-caches', action='store_true',
+                        help='map without the decision and dataset caches')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic configs and jobs (default: 0)')
+    parser.add_argument('--directory', default=None,
+                        help='where to write the configs and inputs (default: a '
+                        'temporary directory)')
+    parser.add_argument('--output', default=None,
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file of an earlier run to compare the medians with')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        fasta_sizes = [dt.str_to_bytes(size.strip())
+                       for size in args.fasta_sizes.split(",") if size.strip()]
+        fasta_files, other_files = generate_inputs(directory, fasta_sizes)
+
+        results = {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'arguments': vars(args),
+            'scales': [],
+        }
+        for tools in args.tools.split(","):
+            results['scales'].append(benchmark_scale(
+                rng, directory, int(tools), args, fasta_files, other_files))
+    finally:
+        shutil.rmtree(directory)
+        dt.clear_caches()
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+        print("Results saved to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+"""
+# =============================================================================
+
+Copyright Government of Canada 2015
+
+Funded by the National Micriobiology Laboratory
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+
+# =============================================================================
+"""
+
+# Compares counting the records of a synthetic FASTA file line by line, the way
+# map_tool_to_destination used to, with count_records.
+#
+# Run from the root of the repository:
+#
+# Measures the memory taken by validating and compiling a synthetic config with
+# tracemalloc: what the validated and compiled configs keep, and the peak while
+# building them. tracemalloc needs Python 3.4 or later.
+#
+# Run from the root of the repository:
+#
+#     python3 -m benchmarks.memory --tools 1000
+
+import argparse
+import gc
+import random
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from benchmarks.mapping import generate_config
+from dynamic_tool_destination import DynamicToolDestination as dt
+
+
+def measure(function):
+    """
+    Call function while tracing allocations.
+
+    @return: the result, the bytes still held by it and the peak bytes allocated
+             during the call
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the memory taken by validating and compiling a '
+        'synthetic config.')
+    parser.add_argument('--tools', type=int, default=1000,
+                        help='number of tools in the config (default: 1000)')
+    parser.add_argument('--min-rules', type=int, default=1,
+                        help='fewest rules per tool (default: 1)')
+    parser.add_argument('--max-rules', type=int, default=200,
+                        help='most rules per tool (default: 200)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic config (default: 0)')
+    args = parser.parse_args()
+
+    if tracemalloc is None:
+        sys.exit("tracemalloc isn't available; run this with Python 3.4 or later.")
+
+    rng = random.Random(args.seed)
+    config = generate_config(rng, args.tools, args.min_rules, args.max_rules)
+    rules = sum(len(tool['rules']) for tool in config['tools'].values())
+    print("Config: %d tools, %d rules" % (args.tools, rules))
+
+    validated, validated_size, validated_peak = measure(
+        lambda: dt.validate_config(config))
+    compiled, compiled_size, compiled_peak = measure(
+        lambda: dt.compile_config(validated))
+
+    print("%-16s %12s %12s" % ("", "kept", "peak"))
+    for name, size, peak in [("validate_config", validated_size, validated_peak),
+                             ("compile_config", compiled_size, compiled_peak)]:
+        print("%-16s %12s %12s" % (name, dt.bytes_to_str(size), dt.bytes_to_str(peak)))
+    print("%-16s %12s" % ("per rule", dt.bytes_to_str(
+        (validated_size + compiled_size) // max(rules, 1))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+from __future__ import print_function
+
+"""
+# =============================================================================
+
+Copyright Government of Canada 2015
+
+Funded by the National Micriobiology Laboratory
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+
+# =============================================================================
+"""
+
+# Compares counting the records of a synthetic FASTA file line by line, the way
+# map_tool_to_destination used to, with count_records.
+#
+# Run from the root of the repository:
+#
+#     python -m benchmarks.records --size "1 GB"
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from dynamic_tool_destination.DynamicToolDestination import (
+    bytes_to_str, count_records, str_to_bytes)
+
+
+def write_fasta(file_name, size, sequence_length, line_width):
+    """
+    Write a FASTA file of at least size bytes made of identical records.
+    """
+    sequence = b"ACGT" * (sequence_length // 4 + 1)
+    lines = [b">record"]
+    for start in range(0, sequence_length, line_width):
+        lines.append(sequence[start:min(start + line_width, sequence_length)])
+    record = b"\n".join(lines) + b"\n"
+
+    # write blocks of about 1 MB instead of one record at a time
+    block = record * max(1, (1024 * 1024) // len(record))
+
+    written = 0
+    with open(file_name, 'wb') as stream:
+        while written < size:
+            stream.write(block)
+            written += len(block)
+
+
+def count_lines(file_name):
+    """
+    Count records the way map_tool_to_destination used to.
+    """
+    records = 0
+    with open(file_name) as inp_db:
+        for line in inp_db:
+            if line[0] == ">":
+                records += 1
+    return records
+
+
+def best_time(function, repeat):
+    """
+    Run function repeat times and keep the fastest run.
+    """
+    result = None
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time counting the records of a synthetic FASTA file.')
+    parser.add_argument('--size', default="1 GB",
+                        help='size of the synthetic FASTA file (default: 1 GB)')
+    parser.add_argument('--sequence-length', type=int, default=1000,
+                        help='length of the sequence of each record (default: 1000)')
+    parser.add_argument('--line-width', type=int, default=60,
+                        help='length of the sequence lines (default: 60)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='how many times to time each method (default: 3)')
+    parser.add_argument('--directory', default=None,
+                        help='where to write the FASTA file (default: a temporary '
+                        'directory)')
+    args = parser.parse_args()
+
+    size = str_to_bytes(args.size)
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        file_name = os.path.join(directory, "synthetic.fasta")
+        write_fasta(file_name, size, args.sequence_length, args.line_width)
+        actual_size = os.path.getsize(file_name)
+        print("FASTA file: " + bytes_to_str(actual_size))
+
+        methods = [
+            ("line by line", lambda: count_lines(file_name)),
+            ("count_records", lambda: count_records(file_name)),
+            ("count_records (mmap)", lambda: count_records(file_name, use_mmap=True)),
+        ]
+
+        baseline = None
+        for name, function in methods:
+            records, elapsed = best_time(function, args.repeat)
+            if baseline is None:
+                baseline = elapsed
+            print("%-22s %12d records %8.3f s %10s/s %6.1fx" % (
+                name, records, elapsed, bytes_to_str(actual_size / elapsed),
+                baseline / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+from __future__ import print_function
+
+"""
+# =============================================================================
+
+Copyright Government of Canada 2015
+
+Funded by the National Micriobiology Laboratory
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+
+# =============================================================================
+"""
+
+# Compares validating the whole of a synthetic config with validating it again
+# after one of its tools changed, the way configs are reloaded: every tool's
+# section is hashed, and only the changed tool is validated.
+#
+# Run from the root of the repository:
+#
+#     python -m benchmarks.reload --tools 2000 --rules 10
+
+import argparse
+import copy
+import logging
+import random
+
+import yaml
+
+from benchmarks.mapping import generate_config
+from benchmarks.records import best_time
+from dynamic_tool_destination import DynamicToolDestination as dt
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare validating a synthetic config with reloading it '
+        'after one of its tools changed.')
+    parser.add_argument('--tools', type=int, default=2000,
+                        help='number of tools in the config (default: 2000)')
+    parser.add_argument('--rules', type=int, default=10,
+                        help='rules per tool (default: 10)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times to repeat each measurement, keeping the best '
+                        '(default: 5)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic config (default: 0)')
+    args = parser.parse_args()
+
+    # the synthetic config is valid, but don't time logging if it isn't
+    logging.disable(logging.CRITICAL)
+
+    rng = random.Random(args.seed)
+    generated = generate_config(rng, args.tools, args.rules, args.rules)
+    edited = copy.deepcopy(generated)
+    edited['tools'][sorted(edited['tools'])[0]]['rules'][0]['destination'] = 'changed'
+
+    # parse both versions like the config file would be, so that the sections
+    # that didn't change come out the same
+    config = yaml.safe_load(yaml.safe_dump(generated))
+    changed = yaml.safe_load(yaml.safe_dump(edited))
+    sections = {}
+    dt.validate_config(config, sections=sections)
+
+    def reload():
+        checks = {}
+        dt.validate_config(changed, sections=dict(sections), checks=checks)
+        return checks
+
+    print("Config: %d tools, %d rules each" % (args.tools, args.rules))
+    full = best_time(lambda: dt.validate_config(changed), args.repeat)[1]
+    digests = best_time(
+        lambda: [dt._section_digest(section) for section in changed['tools'].values()],
+        args.repeat)[1]
+    checks, incremental = best_time(reload, args.repeat)
+
+    print("%-28s %10.4f s" % ("validate the whole config", full))
+    print("%-28s %10.4f s" % ("hash every tool", digests))
+    print("%-28s %10.4f s" % ("reload, 1 tool changed", incremental))
+    print("reloading is %.1f times faster; the config %s" % (
+        full / incremental, "validates" if checks['valid'] else "doesn't validate"))
+
+
+if __name__ == '__main__':
+    main()
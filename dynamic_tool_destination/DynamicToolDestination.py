@@ -29,16 +29,36 @@ specific language governing permissions and limitations under the License.
 """
 
 from yaml import load
+from yaml import YAMLError
 
 import argparse
+import bisect
 import glob
+import hashlib
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import sys
-import copy
+import time
 import string
 import collections
+import numbers
 import re
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __version__ = '1.0.0'
 
@@ -49,6 +69,43 @@ log = logging.getLogger(__name__)
 # does a lot more logging when set to true
 verbose = True
 
+# validated configs keyed by resolved path; each entry holds the file signature
+# it was parsed from, the validated config and the config's verbose setting
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+# the signature of the file of each config whose last change was rejected, see
+# get_compiled_config
+_rejected_configs = {}
+
+# ConfigWatchers by the path given to get_compiled_config
+_config_watchers = {}
+_config_watchers_lock = threading.Lock()
+
+# clock used to time mapping, which doesn't go back when the system time is set
+_clock = getattr(time, 'monotonic', time.time)
+
+# optional settings that can be given under 'settings:' in the config, with the type
+# their value must have and the value used when they aren't given
+available_settings = {
+    'record_cache': (str, None),
+    'record_cache_size': (int, 10000),
+    'measurement_threads': (int, 1),
+    'decision_cache_size': (int, 1000),
+    'dataset_cache_size': (int, 1000),
+    'dataset_cache_ttl': (int, 300),
+    'timing': (bool, False),
+    'timing_log': (bool, False),
+    'metrics_file': (str, None),
+    'metrics_interval': (int, 60),
+    'reload_interval': (int, 0),
+    'lazy_validation': (bool, False),
+}
+
+# a list with the available rule_types. Can be expanded on easily in the future;
+# rule_schema lists what's checked in the rules of each
+available_rule_types = ['file_size', 'num_input_datasets', 'records', 'arguments']
+
 
 class MalformedYMLException(Exception):
     pass
@@ -58,203 +115,285 @@ class ScannerError(Exception):
     pass
 
 
-class RuleValidator:
+class RuleError(object):
     """
-    This class is the primary facility for validating configs. It's always called
-    in map_tool_to_destination and it's called for validating config directly through
-    DynamicToolDestination.py
+    A problem found in a rule while validating it. Its message is only put
+    together when it's logged, so that validating without verbose doesn't
+    format messages nobody reads.
     """
 
-    @classmethod
-    def validate_rule(cls, rule_type, return_bool=False, *args, **kwargs):
-        """
-        This function is responsible for passing each rule to its relevant function.
-
-        @type rule_type: str
-        @param rule_type: the current rule's type
-
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+    __slots__ = ('template', 'values', 'fix')
 
-        @rtype: bool, dict (depending on return_bool)
-        @return: validated rule or result of validation (depending on return_bool)
+    def __init__(self, template, values, fix=None):
         """
-        if rule_type == 'file_size':
-            return cls.__validate_file_size_rule(return_bool, *args, **kwargs)
-
-        elif rule_type == 'num_input_datasets':
-            return cls.__validate_num_input_datasets_rule(return_bool, *args, **kwargs)
+        @type template: str
+        @param template: the message, with a %s for each of values
 
-        elif rule_type == 'records':
-            return cls.__validate_records_rule(return_bool, *args, **kwargs)
+        @type values: tuple
+        @param values: what the message is about, such as the rule's number and tool,
+                       formatted with %s
 
-        elif rule_type == 'arguments':
-            return cls.__validate_arguments_rule(return_bool, *args, **kwargs)
-
-    @classmethod
-    def __validate_file_size_rule(
-            cls, return_bool, original_rule, counter, tool):
+        @type fix: str
+        @param fix: what's done about the problem when the validated rule is returned
         """
-        This function is responsible for validating 'file_size' rules.
+        self.template = template
+        self.values = values
+        self.fix = fix
 
+    def message(self, return_bool=False):
+        """
         @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
-
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
-
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
-
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
+        @param return_bool: True when only the result of the validation was asked
+                            for, in which case nothing was fixed
 
-        @rtype: bool, dict (depending on return_bool)
-        @return: validated rule or result of validation (depending on return_bool)
+        @rtype: str
+        @return: the message logged for the problem
         """
+        error = self.template % self.values
+        if self.fix is not None and not return_bool:
+            error += " " + self.fix
+        return error
 
-        rule = copy.deepcopy(original_rule)
-        valid_rule = True
+    def __repr__(self):
+        return "RuleError(" + repr(self.message()) + ")"
 
-        # Users Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_users(
-                valid_rule, return_bool, rule, tool, counter)
 
-        # Nice_value Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_nice_value(
-                valid_rule, return_bool, rule, tool, counter)
+_email_pattern = re.compile(r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$")
 
-        # Destination Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_destination(
-                valid_rule, return_bool, rule, tool, counter)
 
-        # Bounds Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_bounds(
-                valid_rule, return_bool, rule, tool, counter)
+def _check_users(rule, tool, counter, fix, errors):
+    """
+    Check the users of a rule, if it has any.
 
-        if return_bool:
-            return valid_rule
+    Each of the _check_ functions takes the rule being validated, the tool's id,
+    the rule's number, whether to fix what's wrong and the list of RuleErrors to
+    add to. They return the rule, or None when it has to be ignored.
+    """
+    if "users" in rule:
+        if isinstance(rule["users"], list):
+            users = rule["users"] = list(rule["users"])
+            for user in reversed(users):
+                if not isinstance(user, str):
+                    errors.append(RuleError(
+                        "Entry '%s' in users for rule %s in tool '%s' is in an "
+                        "invalid format!", (user, counter, tool), "Ignoring entry."))
+                    users.remove(user)
+
+                elif _email_pattern.match(user) is None:
+                    errors.append(RuleError(
+                        "Supplied email '%s' for rule %s in tool '%s' is in an "
+                        "invalid format!", (user, counter, tool), "Ignoring email."))
+                    users.remove(user)
 
         else:
-            return rule
+            errors.append(RuleError(
+                "Couldn't find a list under 'users:'!", (), "Ignoring rule."))
+            if fix:
+                return None
 
-    @classmethod
-    def __validate_num_input_datasets_rule(
-            cls, return_bool, original_rule, counter, tool):
-        """
-        This function is responsible for validating 'num_input_datasets' rules.
+        # make sure we didn't just remove all the users; if we did, ignore the rule
+        if rule["users"] is not None and len(rule["users"]) == 0:
+            errors.append(RuleError(
+                "No valid user emails were specified for rule %s in tool '%s'!",
+                (counter, tool), "Ignoring rule."))
+            if fix:
+                return None
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+    return rule
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
+def _check_nice_value(rule, tool, counter, fix, errors):
+    """
+    Check the nice_value of a rule.
+    """
+    if "nice_value" in rule:
+        if rule["nice_value"] < -20 or rule["nice_value"] > 20:
+            errors.append(RuleError(
+                "nice_value goes from -20 to 20; rule %s in '%s' has a nice_value "
+                "of '%s'.", (counter, tool, rule["nice_value"]),
+                "Setting nice_value to 0."))
+            if fix:
+                rule["nice_value"] = 0
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
+    else:
+        errors.append(RuleError(
+            "No nice_value found for rule %s in '%s'.", (counter, tool),
+            "Setting nice_value to 0."))
+        if fix:
+            rule["nice_value"] = 0
 
-        @rtype: bool, dict (depending on return_bool)
-        @return: validated rule or result of validation (depending on return_bool)
-        """
+    return rule
 
-        rule = copy.deepcopy(original_rule)
-        valid_rule = True
 
-        # Users Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_users(
-                valid_rule, return_bool, rule, tool, counter)
+def _check_destination(rule, tool, counter, fix, errors):
+    """
+    Check the destination and fail_message of a rule.
+    """
+    if "fail_message" in rule:
+        if rule.get("destination") != "fail":
+            errors.append(RuleError(
+                "Found a fail_message for rule %s in '%s', but destination is not "
+                "'fail'!", (counter, tool), "Setting destination to 'fail'."))
+        rule["destination"] = "fail"
+
+    destination = rule.get("destination")
+    if isinstance(destination, str):
+        if destination == "fail" and "fail_message" not in rule:
+            errors.append(RuleError(
+                "Missing a fail_message for rule %s in '%s'.", (counter, tool),
+                "Adding generic fail_message."))
+            if fix:
+                rule["fail_message"] = ("Invalid parameters for rule " + str(counter) +
+                                        " in '" + str(tool) + "'.")
+
+    elif isinstance(destination, dict) and isinstance(destination.get("priority"), dict):
+        priorities = destination["priority"]
+        if "med" not in priorities:
+            errors.append(RuleError(
+                "No 'med' priority destination for rule %s in '%s'.", (counter, tool),
+                "Ignoring..."))
+        else:
+            for priority in priorities:
+                if priority not in ("low", "med", "high"):
+                    errors.append(RuleError(
+                        "Invalid priority destination '%s' for rule %s in '%s'.",
+                        (priority, counter, tool), "Ignoring..."))
+                elif not isinstance(priorities[priority], str):
+                    errors.append(RuleError(
+                        "No '%s'priority destination for rule %s in '%s'.",
+                        (priority, counter, tool), "Ignoring..."))
 
-        # Nice_value Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_nice_value(
-                valid_rule, return_bool, rule, tool, counter)
+    else:
+        errors.append(RuleError(
+            "No destination specified for rule %s in '%s'.", (counter, tool),
+            "Ignoring..."))
 
-        # Destination Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_destination(
-                valid_rule, return_bool, rule, tool, counter)
+    return rule
 
-        # Bounds Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_bounds(
-                valid_rule, return_bool, rule, tool, counter)
 
-        if return_bool:
-            return valid_rule
+def _bounds_check(sizes=False):
+    """
+    Make a check of the bounds of a rule.
 
-        else:
+    @type sizes: bool
+    @param sizes: True when the bounds are sizes such as '1 GB', which are
+                  compared in bytes
+
+    @rtype: function
+    @return: the check
+    """
+    def check_bounds(rule, tool, counter, fix, errors):
+        if "upper_bound" not in rule or "lower_bound" not in rule:
+            errors.append(RuleError(
+                "Missing bounds for rule %s in '%s'.", (counter, tool),
+                "Ignoring rule."))
+            if fix:
+                return None
             return rule
 
-    @classmethod
-    def __validate_records_rule(cls, return_bool, original_rule, counter, tool):
-        """
-        This function is responsible for validating 'records' rules.
+        if sizes:
+            upper_bound = bound_to_bytes(rule["upper_bound"])
+            lower_bound = bound_to_bytes(rule["lower_bound"])
+        else:
+            upper_bound = rule["upper_bound"]
+            lower_bound = rule["lower_bound"]
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+        if lower_bound == "Infinity":
+            errors.append(RuleError(
+                "Error: lower_bound is set to Infinity, but must be lower than "
+                "upper_bound!", (), "Setting lower_bound to 0!"))
+            if fix:
+                lower_bound = 0
+                rule["lower_bound"] = 0
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
+        if upper_bound == "Infinity":
+            upper_bound = -1
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
+        if upper_bound != -1 and lower_bound > upper_bound:
+            errors.append(RuleError(
+                "lower_bound exceeds upper_bound for rule %s in '%s'.", (counter, tool),
+                "Reversing bounds."))
+            if fix:
+                rule["upper_bound"], rule["lower_bound"] = (
+                    rule["lower_bound"], rule["upper_bound"])
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
+        return rule
 
-        @rtype: bool, dict (depending on return_bool)
-        @return: validated rule or result of validation (depending on return_bool)
-        """
+    return check_bounds
 
-        rule = copy.deepcopy(original_rule)
-        valid_rule = True
 
-        # Users Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_users(
-                valid_rule, return_bool, rule, tool, counter)
+def _check_arguments(rule, tool, counter, fix, errors):
+    """
+    Check that a rule has arguments to match.
+    """
+    if not isinstance(rule.get("arguments"), dict):
+        errors.append(RuleError(
+            "No arguments found for rule %s in '%s' despite being of type arguments.",
+            (counter, tool), "Ignoring rule."))
+        if fix:
+            return None
+
+    return rule
+
+
+# the checks made on the rules of each rule_type, in order
+rule_schema = {
+    'file_size': (_check_users, _check_nice_value, _check_destination,
+                  _bounds_check(sizes=True)),
+    'num_input_datasets': (_check_users, _check_nice_value, _check_destination,
+                           _bounds_check()),
+    'records': (_check_users, _check_nice_value, _check_destination,
+                _bounds_check()),
+    'arguments': (_check_users, _check_nice_value, _check_destination,
+                  _check_arguments),
+}
+
+
+def compile_rule_checks(checks):
+    """
+    Turn the checks of a rule_type into a function validating its rules.
 
-        # Nice_value Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_nice_value(
-                valid_rule, return_bool, rule, tool, counter)
+    @type checks: tuple
+    @param checks: the rule_type's checks, from rule_schema
 
-        # Destination Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_destination(
-                valid_rule, return_bool, rule, tool, counter)
+    @rtype: function
+    @return: a function taking a rule, its number, its tool's id, return_bool and
+             a list the RuleErrors found in the rule are added to, and returning
+             the validated copy of the rule (None if it's ignored)
+    """
+    def validate(original_rule, counter, tool, return_bool, errors):
+        fix = not return_bool
+        rule = dict(original_rule)
+        for check in checks:
+            rule = check(rule, tool, counter, fix, errors)
+            if rule is None:
+                break
+        return rule
 
-        # Bounds Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_bounds(
-                valid_rule, return_bool, rule, tool, counter)
+    return validate
 
-        if return_bool:
-            return valid_rule
 
-        else:
-            return rule
+rule_validators = dict((rule_type, compile_rule_checks(checks))
+                       for rule_type, checks in rule_schema.items())
+
+
+class RuleValidator:
+    """
+    This class is the primary facility for validating configs. It's always called
+    in map_tool_to_destination and it's called for validating config directly through
+    DynamicToolDestination.py. What's checked in each rule_type's rules is listed in
+    rule_schema.
+    """
 
     @classmethod
-    def __validate_arguments_rule(
-            cls, return_bool, original_rule, counter, tool):
+    def validate_rule(cls, rule_type, return_bool=False, original_rule=None,
+                      counter=None, tool=None, verbose=True, errors=None):
         """
-        This is responsible for validating 'arguments' rules.
+        This function is responsible for validating a rule with its rule_type's
+        checks and logging what's wrong with it.
+
+        @type rule_type: str
+        @param rule_type: the current rule's type
 
         @type return_bool: bool
         @param return_bool: True when we are only interested in the result of the
@@ -270,457 +409,771 @@ class RuleValidator:
         @type tool: str
         @param tool: the name of the current tool. Necessary for log output.
 
+        @type verbose: bool
+        @param verbose: log the errors found in the rule when True
+
+        @type errors: list
+        @param errors: if given, the RuleErrors found in the rule are added to it,
+                       so that whether a fixed rule was valid is known too
+
         @rtype: bool, dict (depending on return_bool)
         @return: validated rule or result of validation (depending on return_bool)
         """
+        validate = rule_validators.get(rule_type)
+        if validate is None:
+            return None
 
-        rule = copy.deepcopy(original_rule)
-        valid_rule = True
-
-        # Users Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_users(
-                valid_rule, return_bool, rule, tool, counter)
-
-        # Nice_value Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_nice_value(
-                valid_rule, return_bool, rule, tool, counter)
-
-        # Destination Verification #
-        if rule is not None:
-            valid_rule, rule = cls.__validate_destination(
-                valid_rule, return_bool, rule, tool, counter)
-
-        # Arguments Verification (for rule_type arguments; read comment block at top
-        # of function for clarification.
-        if rule is not None:
-            valid_rule, rule = cls.__validate_arguments(
-                valid_rule, return_bool, rule, tool, counter)
+        if errors is None:
+            errors = []
+        try:
+            rule = validate(original_rule, counter, tool, return_bool, errors)
+        finally:
+            # what was found before a check raised is still worth logging
+            if verbose:
+                for error in errors:
+                    log.debug(error.message(return_bool))
 
         if return_bool:
-            return valid_rule
+            return not errors
 
         else:
             return rule
 
-    @classmethod
-    def __validate_nice_value(cls, valid_rule, return_bool, rule, tool, counter):
-        """
-        This function is responsible for validating nice_value.
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+def parse_yaml(path="/config/tool_destinations.yml", test=False, return_bool=False):
+    """
+    Get a yaml file from path and send it to validate_config for validation.
 
-        @type valid_rule: bool
-        @param valid_rule: returns True if everything is valid. False if it encounters any
-                       abnormalities in the config.
+    @type path: str
+    @param path: the path to the config file
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
+    @type test: bool
+    @param test: indicates whether to run in test mode or production mode
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
+    @type return_bool: bool
+    @param return_bool: True when we are only interested in the result of the
+                          validation, and not the validated rule itself.
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
+    @rtype: bool, dict (depending on return_bool)
+    @return: validated rule or result of validation (depending on return_bool)
 
-        @rtype: bool, dict (tuple)
-        @return: validated rule and result of validation
-        """
+    """
+    return _parse_yaml(path, test, return_bool)[0]
 
-        if "nice_value" in rule:
-            if rule["nice_value"] < -20 or rule["nice_value"] > 20:
-                error = "nice_value goes from -20 to 20; rule " + str(counter)
-                error += " in '" + str(tool) + "' has a nice_value of '"
-                error += str(rule["nice_value"]) + "'."
-                if not return_bool:
-                    error += " Setting nice_value to 0."
-                    rule["nice_value"] = 0
 
-                if verbose:
-                    log.debug(error)
-                valid_rule = False
+def _parse_yaml(path="/config/tool_destinations.yml", test=False, return_bool=False,
+                times=None, lazy=False, sections=None, checks=None):
+    """
+    Same as parse_yaml, but also get the config's verbose setting.
 
-        else:
-            error = "No nice_value found for rule " + str(counter) + " in '" + str(tool)
-            error += "'."
-            if not return_bool:
-                error += " Setting nice_value to 0."
-                rule["nice_value"] = 0
-            if verbose:
-                log.debug(error)
-            valid_rule = False
+    @type times: dict
+    @param times: if given, how long parsing and validating took are stored in it
+                  under 'parse' and 'validate'
 
-        return valid_rule, rule
+    @type lazy: bool
+    @param lazy: passed on to validate_config
 
-    @classmethod
-    def __validate_destination(cls, valid_rule, return_bool, rule, tool, counter):
-        """
-        This function is responsible for validating destination.
+    @type sections: dict
+    @param sections: passed on to validate_config
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+    @type checks: dict
+    @param checks: passed on to validate_config
 
-        @type valid_rule: bool
-        @param valid_rule: returns True if everything is valid. False if it encounters any
-                       abnormalities in the config.
+    @rtype: bool, dict (depending on return_bool) and bool (tuple)
+    @return: validated rule or result of validation (depending on return_bool), and
+               the config's verbose setting
+    """
+    # until the config is loaded, fall back on the module's verbose setting
+    config_verbose = verbose
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
+    # Import file from path
+    try:
+        started = _clock()
+        if test:
+            config = load(path)
+        else:
+            opt_file = resolve_config_path(path)
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
+            with open(opt_file, 'r') as stream:
+                config = load(stream)
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
+        config_verbose = get_verbose(config, return_bool)
+        if times is not None:
+            times['parse'] = _clock() - started
+            started = _clock()
 
-        @rtype: bool, dict (tuple)
-        @return: validated rule and result of validation
-        """
+        # Test imported file
+        try:
+            if return_bool:
+                valid_config = validate_config(config, return_bool)
+            else:
+                config = validate_config(config, lazy=lazy, sections=sections,
+                                         checks=checks)
+        except MalformedYMLException as e:
+            if config_verbose:
+                log.error(str(e))
+            raise
 
-        if "fail_message" in rule:
-            if "destination" not in rule or rule['destination'] != "fail":
-                error = "Found a fail_message for rule " + str(counter)
-                error += " in '" + str(tool) + "', but destination is not 'fail'!"
-                if not return_bool:
-                    error += " Setting destination to 'fail'."
-                if verbose:
-                    log.debug(error)
+        if times is not None:
+            times['validate'] = _clock() - started
+    except ScannerError:
+        if config_verbose:
+            log.error("Config is too malformed to fix!")
+        raise
 
-                valid_rule = False
+    if return_bool:
+        return valid_config, config_verbose
 
-            rule["destination"] = "fail"
+    else:
+        return config, config_verbose
 
-        if "destination" in rule:
-            if isinstance(rule["destination"], str):
-                if rule["destination"] == "fail" and "fail_message" not in rule:
-                    error = "Missing a fail_message for rule " + str(counter)
-                    error += " in '" + str(tool) + "'."
-                    if not return_bool:
-                        error += " Adding generic fail_message."
-                        message = "Invalid parameters for rule " + str(counter)
-                        message += " in '" + str(tool) + "'."
-                        rule["fail_message"] = message
-                    if verbose:
-                        log.debug(error)
-                    valid_rule = False
-            elif isinstance(rule["destination"], dict):
-                if ("priority" in rule["destination"] and
-                        isinstance(rule["destination"]["priority"], dict)):
-                    if "med" not in rule["destination"]["priority"]:
-                        error = "No 'med' priority destination for rule " + str(counter)
-                        error += " in '" + str(tool) + "'."
-                        if not return_bool:
-                            error += " Ignoring..."
-                        if verbose:
-                            log.debug(error)
-                        valid_rule = False
-                    else:
-                        for priority in rule["destination"]["priority"]:
-                            if priority not in ["low", "med", "high"]:
-                                error = "Invalid priority destination '" + str(priority)
-                                error += "' for rule " + str(counter)
-                                error += " in '" + str(tool) + "'."
-                                if not return_bool:
-                                    error += " Ignoring..."
-                                if verbose:
-                                    log.debug(error)
-                                valid_rule = False
-                            elif not isinstance(
-                                    rule["destination"]["priority"][priority], str):
-                                error = "No '" + str(priority)
-                                error += "'priority destination for rule " + str(counter)
-                                error += " in '" + str(tool) + "'."
-                                if not return_bool:
-                                    error += " Ignoring..."
-                                if verbose:
-                                    log.debug(error)
-                                valid_rule = False
-                else:
-                    error = "No destination specified for rule " + str(counter)
-                    error += " in '" + str(tool) + "'."
-                    if not return_bool:
-                        error += " Ignoring..."
-                    if verbose:
-                        log.debug(error)
-                    valid_rule = False
-            else:
-                error = "No destination specified for rule " + str(counter)
-                error += " in '" + str(tool) + "'."
-                if not return_bool:
-                    error += " Ignoring..."
-                if verbose:
-                    log.debug(error)
-                valid_rule = False
-        else:
-            error = "No destination specified for rule " + str(counter)
-            error += " in '" + str(tool) + "'."
-            if not return_bool:
-                error += " Ignoring..."
-            if verbose:
-                log.debug(error)
-            valid_rule = False
 
-        return valid_rule, rule
+def get_verbose(obj, return_bool=False):
+    """
+    Get the verbose setting of a config. Validation only for the result always
+    logs everything, and configs without a valid verbose setting don't log.
 
-    @classmethod
-    def __validate_bounds(cls, valid_rule, return_bool, rule, tool, counter):
-        """
-        This function is responsible for validating bounds.
+    @type obj: dict
+    @param obj: the entire contents of the config
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+    @type return_bool: bool
+    @param return_bool: True when we are only interested in the result of the
+                          validation, and not the validated rule itself.
 
-        @type valid_rule: bool
-        @param valid_rule: returns True if everything is valid. False if it encounters any
-                       abnormalities in the config.
+    @rtype: bool
+    @return: whether to log everything
+    """
+    if return_bool:
+        return True
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
+    elif obj is not None and 'verbose' in obj and isinstance(obj['verbose'], bool):
+        return obj['verbose']
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
+    return False
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
 
-        @rtype: bool/None, dict (tuple)
-        @return: validated rule (or None if invalid) and result of validation
-        """
+def resolve_config_path(path="/config/tool_destinations.yml"):
+    """
+    Get the location of the config file on disk.
 
-        if "upper_bound" in rule and "lower_bound" in rule:
-            if rule["rule_type"] == "file_size":
-                upper_bound = str_to_bytes(rule["upper_bound"])
-                lower_bound = str_to_bytes(rule["lower_bound"])
-            else:
-                upper_bound = rule["upper_bound"]
-                lower_bound = rule["lower_bound"]
-
-            if lower_bound == "Infinity":
-                error = "Error: lower_bound is set to Infinity, but must be lower than "
-                error += "upper_bound!"
-                if not return_bool:
-                    error += " Setting lower_bound to 0!"
-                    lower_bound = 0
-                    rule["lower_bound"] = 0
-                if verbose:
-                    log.debug(error)
-                valid_rule = False
+    @type path: str
+    @param path: the path to the config file
 
-            if upper_bound == "Infinity":
-                upper_bound = -1
+    @rtype: str
+    @return: the path that should be opened
+    """
+    if path == "/config/tool_destinations.yml":
+        # os.path.realpath gets the path of DynamicToolDestination.py
+        # and then os.path.join is used to go back four directories
+        config_directory = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '../../../..')
 
-            if upper_bound != -1 and lower_bound > upper_bound:
+        return config_directory + path
 
-                error = "lower_bound exceeds upper_bound for rule " + str(counter)
-                error += " in '" + str(tool) + "'."
-                if not return_bool:
-                    error += " Reversing bounds."
-                    temp_upper_bound = rule["upper_bound"]
-                    temp_lower_bound = rule["lower_bound"]
-                    rule["upper_bound"] = temp_lower_bound
-                    rule["lower_bound"] = temp_upper_bound
-                if verbose:
-                    log.debug(error)
-                valid_rule = False
+    return path
 
-        else:
-            error = "Missing bounds for rule " + str(counter)
-            error += " in '" + str(tool) + "'."
-            if not return_bool:
-                error += " Ignoring rule."
-                rule = None
-            if verbose:
-                log.debug(error)
-            valid_rule = False
 
-        return valid_rule, rule
+# version of the format of config snapshots; snapshots of another version, or
+# written by another version of this module, are ignored
+SNAPSHOT_VERSION = 2
 
-    @classmethod
-    def __validate_arguments(cls, valid_rule, return_bool, rule, tool, counter):
-        """
-        This function is responsible for validating arguments.
+# added to the path of a config to get the path of its snapshot
+SNAPSHOT_SUFFIX = ".snapshot"
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
 
-        @type valid_rule: bool
-        @param valid_rule: returns True if everything is valid. False if it encounters any
-                       abnormalities in the config.
+def _file_digest(file_name):
+    """
+    @rtype: str
+    @return: the SHA-1 of the contents of file_name, in hexadecimal
+    """
+    with open(file_name, 'rb') as stream:
+        return hashlib.sha1(stream.read()).hexdigest()
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
+def _plain_config(obj):
+    """
+    Copy a validated config with its defaultdicts and ValidatedRecords turned
+    into dicts, which can be pickled and loaded again whatever name this module
+    was imported under (it's __main__ when snapshots are written with -s).
+    """
+    if isinstance(obj, (dict, ValidatedRecord)):
+        return dict((key, _plain_config(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_plain_config(value) for value in obj]
+    return obj
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
 
-        @rtype: bool/None, dict (tuple)
-        @return: validated rule (or None if invalid) and result of validation
-        """
+def _records_config(config):
+    """
+    Turn the sections of a config copied by _plain_config back into the
+    ValidatedRecords validate_config makes.
 
-        if "arguments" not in rule or not isinstance(rule["arguments"], dict):
-            error = "No arguments found for rule " + str(counter) + " in '"
-            error += str(tool) + "' despite being of type arguments."
-            if not return_bool:
-                error += " Ignoring rule."
-                rule = None
-            if verbose:
-                log.debug(error)
-            valid_rule = False
+    @type config: dict
+    @param config: the copied config; it's changed in place
 
-        return valid_rule, rule
+    @rtype: dict
+    @return: config
+    """
+    tools = config.get('tools')
+    if isinstance(tools, dict):
+        for tool, section in tools.items():
+            if isinstance(section.get('rules'), list):
+                section['rules'] = [Rule(rule) for rule in section['rules']]
+            tools[tool] = ToolEntry(section)
+    if isinstance(config.get('default_destination'), dict):
+        config['default_destination'] = PriorityDestination(config['default_destination'])
+    return config
+
+
+def write_snapshot(path="/config/tool_destinations.yml"):
+    """
+    Parse and validate the config at path, and write the validated config next
+    to it, so that handlers can load it without parsing and validating it
+    themselves. The snapshot is only used as long as the config is unchanged.
 
-    @classmethod
-    def __validate_users(cls, valid_rule, return_bool, rule, tool, counter):
-        """
-        This function is responsible for validating users (if present).
+    @type path: str
+    @param path: the path to the config file
 
-        @type return_bool: bool
-        @param return_bool: True when we are only interested in the result of the
-                              validation, and not the validated rule itself.
+    @rtype: str
+    @return: the path of the snapshot
+    """
+    opt_file = os.path.realpath(resolve_config_path(path))
+
+    # hash before parsing, so that an edit racing with the parse below leaves a
+    # snapshot that is already stale rather than one that looks fresh
+    digest = _file_digest(opt_file)
+    checks = {}
+    sections = {}
+    config, config_verbose = _parse_yaml(opt_file, checks=checks, sections=sections)
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'module_version': __version__,
+        'source': digest,
+        'config': _plain_config(config),
+        'verbose': config_verbose,
+        'valid': checks['valid'],
+        # so that handlers loading the snapshot can tell which tools changed
+        'digests': dict((tool, section[0]) for tool, section in sections.items()),
+    }
+    snapshot_file = opt_file + SNAPSHOT_SUFFIX
+    write_atomically(snapshot_file, pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL),
+                     binary=True)
+    return snapshot_file
+
+
+def load_snapshot(path="/config/tool_destinations.yml"):
+    """
+    Load the snapshot written by write_snapshot for the config at path.
 
-        @type valid_rule: bool
-        @param valid_rule: returns True if everything is valid. False if it encounters any
-                       abnormalities in the config.
+    @type path: str
+    @param path: the path to the config file
 
-        @type original_rule: dict
-        @param original_rule: contains the original received rule
+    @rtype: tuple
+    @return: the validated config and its verbose setting, or None if there
+             isn't a snapshot, or it is stale or can't be read
+    """
+    snapshot = _read_snapshot(os.path.realpath(resolve_config_path(path)))
+    if snapshot is None:
+        return None
+    return snapshot['config'], snapshot['verbose']
 
-        @type counter: int
-        @param counter: this counter is used to identify what rule # is currently being
-                        validated. Necessary for log output.
 
-        @type tool: str
-        @param tool: the name of the current tool. Necessary for log output.
+def _read_snapshot(opt_file):
+    """
+    Same as load_snapshot, but get everything the snapshot holds.
 
-        @rtype: bool, dict (tuple)
-        @return: validated rule and result of validation
-        """
+    @type opt_file: str
+    @param opt_file: the resolved path to the config file
 
-        emailregex = "^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$"
+    @rtype: dict
+    @return: the snapshot, or None if there isn't one, or it is stale or can't
+             be read
+    """
+    snapshot_file = opt_file + SNAPSHOT_SUFFIX
 
-        if "users" in rule:
-            if isinstance(rule["users"], list):
-                for user in reversed(rule["users"]):
-                    if not isinstance(user, str):
-                        error = "Entry '" + str(user) + "' in users for rule "
-                        error += str(counter) + " in tool '" + str(tool) + "' is in an "
-                        error += "invalid format!"
-                        if not return_bool:
-                            error += " Ignoring entry."
-                        if verbose:
-                            log.debug(error)
-                        valid_rule = False
-                        rule["users"].remove(user)
+    try:
+        with open(snapshot_file, 'rb') as stream:
+            snapshot = pickle.load(stream)
+    except (IOError, OSError):
+        return None
+    except (EOFError, pickle.UnpicklingError, ValueError, TypeError,
+            AttributeError, ImportError, IndexError, KeyError) as e:
+        log.warning("Couldn't read " + snapshot_file + ": " + str(e))
+        return None
+
+    try:
+        if (snapshot['version'] != SNAPSHOT_VERSION or
+                snapshot['module_version'] != __version__ or
+                snapshot['source'] != _file_digest(opt_file)):
+            log.warning(snapshot_file + " is out of date; parsing " + opt_file)
+            return None
+        snapshot['config'] = _records_config(snapshot['config'])
+        return snapshot
+    except (TypeError, KeyError, AttributeError, IOError, OSError):
+        log.warning("Couldn't read " + snapshot_file)
+        return None
+
+
+def get_compiled_config(path="/config/tool_destinations.yml"):
+    """
+    Get the compiled config for path, only parsing, validating and compiling the
+    file again when it has changed since the last call. The file is considered
+    changed when its mtime, size or inode differ from the ones it was last parsed
+    with. A fresh snapshot written by write_snapshot is loaded instead of parsing
+    and validating the file.
+
+    A changed config that doesn't validate is rejected, and the config loaded
+    before it is still used, until the file changes again. When the config has
+    a reload_interval, a ConfigWatcher checks it for changes in the background
+    instead, and jobs only get the latest config it loaded.
+
+    @type path: str
+    @param path: the path to the config file
+
+    @rtype: CompiledConfig
+    @return: compiled config
+    """
+    watcher = _config_watchers.get(path)
+    if watcher is not None and watcher.watching():
+        entry = _config_cache.get(watcher.opt_file)
+        if entry is not None:
+            return entry[1]
+
+    opt_file = os.path.realpath(resolve_config_path(path))
+    compiled_config = _load_config(opt_file)
+
+    if compiled_config.settings['reload_interval'] > 0:
+        watch_config(path, opt_file, compiled_config.settings['reload_interval'])
+
+    return compiled_config
+
+
+def _has_default_destination(config):
+    """
+    @type config: dict
+    @param config: a validated config
+
+    @rtype: bool
+    @return: whether the config has a global default_destination that jobs can
+             be sent to
+    """
+    destination = config.get('default_destination')
+    if isinstance(destination, str):
+        return True
+    if isinstance(destination, (dict, ValidatedRecord)):
+        priorities = destination.get('priority')
+        return (isinstance(priorities, (dict, ValidatedRecord)) and
+                isinstance(priorities.get('med'), str))
+    return False
 
-                    else:
-                        if re.match(emailregex, user) is None:
-                            error = "Supplied email '" + str(user) + "' for rule "
-                            error += str(counter) + " in tool '" + str(tool) + "' is in "
-                            error += "an invalid format!"
-                            if not return_bool:
-                                error += " Ignoring email."
-                            if verbose:
-                                log.debug(error)
-                            valid_rule = False
-                            rule["users"].remove(user)
 
+def _load_config(opt_file):
+    """
+    Get the compiled config for opt_file, loading it again if it changed. See
+    get_compiled_config.
+
+    @type opt_file: str
+    @param opt_file: the resolved path to the config file
+
+    @rtype: CompiledConfig
+    @return: compiled config
+    """
+    # stat before reading so that an edit racing with the parse below can only
+    # ever cause an extra reload, never a stale cache entry
+    stat = os.stat(opt_file)
+    signature = (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    entry = _config_cache.get(opt_file)
+    if entry is not None and (entry[0] == signature or
+                              _rejected_configs.get(opt_file) == signature):
+        return entry[1]
+
+    with _config_cache_lock:
+        entry = _config_cache.get(opt_file)
+        if entry is not None and (entry[0] == signature or
+                                  _rejected_configs.get(opt_file) == signature):
+            return entry[1]
+
+        times = {}
+        previous = None
+        sections = {}
+        if entry is not None:
+            previous = entry[1]
+            sections = dict(previous.tool_sections)
+        checks = {}
+        try:
+            started = _clock()
+            snapshot = _read_snapshot(opt_file)
+            if snapshot is not None:
+                config, config_verbose = snapshot['config'], snapshot['verbose']
+                checks['valid'] = snapshot['valid']
+                # the tools' digests tell which tools changed, but they have to
+                # be validated again to be reused by a later reload
+                sections = dict((tool, (digest, None, None)) for tool, digest in
+                                (snapshot.get('digests') or {}).items())
+                times['snapshot'] = _clock() - started
             else:
-                error = "Couldn't find a list under 'users:'!"
-                if not return_bool:
-                    error += " Ignoring rule."
-                    rule = None
-                if verbose:
-                    log.debug(error)
-                valid_rule = False
-
-            # post-processing checking to make sure we didn't just remove all the users
-            # if we did, we should ignore the rule
-            if rule is not None and rule["users"] is not None and len(rule["users"]) == 0:
-                error = "No valid user emails were specified for rule " + str(counter)
-                error += " in tool '" + str(tool) + "'!"
-                if not return_bool:
-                    error += " Ignoring rule."
-                    rule = None
-                if verbose:
-                    log.debug(error)
-                valid_rule = False
+                config, config_verbose = _parse_yaml(
+                    opt_file, times=times, lazy=True, sections=sections, checks=checks)
+
+            # validate_config fixes what it can, so that a config that's only
+            # partly written, or empty, still comes out of it; don't use one of
+            # those instead of a config that was working
+            if entry is not None:
+                if not _has_default_destination(config):
+                    raise MalformedYMLException(
+                        "No valid global default_destination in config!")
+                if not checks['valid']:
+                    raise MalformedYMLException(
+                        "Config doesn't validate; check it with "
+                        "DynamicToolDestination.py -c")
+        except (MalformedYMLException, ScannerError, YAMLError, IOError) as e:
+            if entry is None:
+                raise
+
+            # keep the last config that was valid, and don't try this one again
+            _rejected_configs[opt_file] = signature
+            _metrics.rejected()
+            error = "Rejected changes to " + opt_file + "; still using the config "
+            error += "loaded before them: " + str(e)
+            log.error(error)
+            return entry[1]
+
+        started = _clock()
+        compiled_config = compile_config(config, config_verbose, previous)
+        times['compile'] = _clock() - started
+        compiled_config.load_times = times
+        compiled_config.tool_sections = sections
+        if previous is not None and previous.tool_sections and sections:
+            compiled_config.changed_tools = tuple(sorted(
+                (tool for tool in set(previous.tool_sections) | set(sections)
+                 if previous.tool_sections.get(tool, (None,))[0] !=
+                 sections.get(tool, (None,))[0]), key=str))
+            if config_verbose:
+                log.debug("Reloaded " + opt_file + "; tools changed: " +
+                          ", ".join(str(tool) for tool in compiled_config.changed_tools))
+        _config_cache[opt_file] = (signature, compiled_config)
+        _rejected_configs.pop(opt_file, None)
+        _metrics.reloaded()
+
+    return compiled_config
+
+
+class ConfigWatcher(object):
+    """
+    Checks a config for changes every few seconds in a background thread, so
+    that mapping jobs never waits for the config to be loaded again.
+    """
 
-        return valid_rule, rule
+    def __init__(self, path, opt_file, interval):
+        """
+        @type path: str
+        @param path: the path to the config file, as given to get_compiled_config
 
+        @type opt_file: str
+        @param opt_file: the resolved path to the config file
 
-def parse_yaml(path="/config/tool_destinations.yml", test=False, return_bool=False):
+        @type interval: int
+        @param interval: how many seconds to wait between checks
+        """
+        self.path = path
+        self.opt_file = opt_file
+        self.interval = interval
+        self.pid = os.getpid()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watching(self):
+        """
+        @rtype: bool
+        @return: whether the config is still being checked by this process
+        """
+        # threads don't survive a fork, so a forked handler starts its own
+        return (self.pid == os.getpid() and not self.stopped.is_set() and
+                self.thread.is_alive())
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                return
+            self.check()
+
+    def check(self):
+        """
+        Load the config again if it changed, and stop watching it if it no longer
+        has a reload_interval.
+        """
+        try:
+            compiled_config = _load_config(self.opt_file)
+        except (MalformedYMLException, ScannerError, YAMLError, IOError, OSError) as e:
+            # the file is being replaced, or was never valid
+            log.error("Couldn't load " + self.opt_file + ": " + str(e))
+            return
+
+        interval = compiled_config.settings['reload_interval']
+        if interval > 0:
+            self.interval = interval
+        else:
+            self.stop()
+
+
+def watch_config(path, opt_file, interval):
     """
-    Get a yaml file from path and send it to validate_config for validation.
+    Start checking the config at path for changes in the background, unless it
+    already is.
 
     @type path: str
-    @param path: the path to the config file
+    @param path: the path to the config file, as given to get_compiled_config
 
-    @type test: bool
-    @param test: indicates whether to run in test mode or production mode
+    @type opt_file: str
+    @param opt_file: the resolved path to the config file
 
-    @type return_bool: bool
-    @param return_bool: True when we are only interested in the result of the
-                          validation, and not the validated rule itself.
+    @type interval: int
+    @param interval: how many seconds to wait between checks
+
+    @rtype: ConfigWatcher
+    @return: the watcher
+    """
+    with _config_watchers_lock:
+        watcher = _config_watchers.get(path)
+        if watcher is None or not watcher.watching():
+            watcher = ConfigWatcher(path, opt_file, interval)
+            _config_watchers[path] = watcher
+    return watcher
 
-    @rtype: bool, dict (depending on return_bool)
-    @return: validated rule or result of validation (depending on return_bool)
 
+def get_config(path="/config/tool_destinations.yml"):
     """
-    # Import file from path
-    try:
-        if test:
-            config = load(path)
-        else:
-            if path == "/config/tool_destinations.yml":
-                # os.path.realpath gets the path of DynamicToolDestination.py
-                # and then os.path.join is used to go back four directories
-                config_directory = os.path.join(
-                    os.path.dirname(os.path.realpath(__file__)), '../../../..')
+    Get the validated config for path. See get_compiled_config.
 
-                opt_file = config_directory + path
+    @type path: str
+    @param path: the path to the config file
 
-            else:
-                opt_file = path
+    @rtype: dict
+    @return: validated config
+    """
+    return get_compiled_config(path).config
 
-            with open(opt_file, 'r') as stream:
-                config = load(stream)
 
-        # Test imported file
+def clear_caches():
+    """
+    Drop all configs that have been cached by get_compiled_config, and stop
+    watching them, the virulence factor databases found by get_vfdb and the
+    measurements of datasets.
+    """
+    with _config_watchers_lock:
+        for watcher in _config_watchers.values():
+            watcher.stop()
+        _config_watchers.clear()
+    with _config_cache_lock:
+        _config_cache.clear()
+        _rejected_configs.clear()
+    with _vfdb_cache_lock:
+        _vfdb_cache.clear()
+    _dataset_cache.clear()
+
+
+def infinite_defaultdict():
+    """
+    A dict that expands automatically when adding values to new levels.
+    """
+    return collections.defaultdict(infinite_defaultdict)
+
+
+# stands in for the fields of a ValidatedRecord that the config doesn't have
+_unset = object()
+
+# the fields of each kind of ValidatedRecord with the functions setting them,
+# which go straight to the slots instead of through __setattr__
+_record_setters = {}
+
+
+class ValidatedRecord(object):
+    """
+    A read-only part of a validated config, with a fixed set of fields stored in
+    slots. It can be read like the dict it was validated from, and compares
+    equal to it, so that validated configs keep the shape they always had.
+    Subclasses list their fields, followed by 'extra', in __slots__.
+    """
+
+    __slots__ = ()
+
+    # the names of the fields, in the order they're listed
+    fields = ()
+
+    def __init__(self, values):
+        """
+        @type values: dict
+        @param values: the fields' values; fields it doesn't have are left unset,
+                       and keys that aren't fields are kept in a dict under extra
+        """
+        cls = type(self)
         try:
-            if return_bool:
-                valid_config = validate_config(config, return_bool)
-            else:
-                config = validate_config(config)
-        except MalformedYMLException:
-            if verbose:
-                log.error(str(sys.exc_value))
-            raise
-    except ScannerError:
-        if verbose:
-            log.error("Config is too malformed to fix!")
-        raise
+            setters = _record_setters[cls]
+        except KeyError:
+            setters = _record_setters[cls] = tuple(
+                (field, getattr(cls, field).__set__) for field in cls.fields)
+
+        get = values.get
+        found = 0
+        for field, set_field in setters:
+            value = get(field, _unset)
+            if value is not _unset:
+                found += 1
+            set_field(self, value)
+
+        extra = None
+        if len(values) > found:
+            extra = dict((key, value) for key, value in values.items()
+                         if key not in self.fields)
+        cls.extra.__set__(self, extra)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(type(self).__name__ + " objects are read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(type(self).__name__ + " objects are read-only")
+
+    def __reduce__(self):
+        return type(self), (dict(self.items()),)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is not _unset:
+                return value
+        elif self.extra is not None:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-    if return_bool:
-        return valid_config
+    def __contains__(self, key):
+        if key in self.fields:
+            return getattr(self, key) is not _unset
+        return self.extra is not None and key in self.extra
 
-    else:
-        return config
+    def keys(self):
+        keys = [field for field in self.fields if getattr(self, field) is not _unset]
+        if self.extra is not None:
+            keys.extend(self.extra)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
 
+    def __len__(self):
+        return len(self.keys())
 
-def validate_config(obj, return_bool=False):
+    def __eq__(self, other):
+        if not isinstance(other, (ValidatedRecord, dict)):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + repr(dict(self.items())) + ")"
+
+
+class Priorities(ValidatedRecord):
+    """
+    The destinations of a PriorityDestination, by priority.
+    """
+
+    fields = ('low', 'med', 'high')
+    __slots__ = fields + ('extra',)
+
+
+class PriorityDestination(ValidatedRecord):
+    """
+    A destination per priority, as {'priority': {'med': ..., ...}}.
+    """
+
+    fields = ('priority',)
+    __slots__ = fields + ('extra',)
+
+    def __init__(self, values):
+        ValidatedRecord.__init__(self, values)
+        if isinstance(self.priority, dict):
+            object.__setattr__(self, 'priority', Priorities(self.priority))
+
+
+def _validated_destination(destination):
+    """
+    @return: destination, with a dict of destinations per priority turned into
+             a PriorityDestination
+    """
+    if isinstance(destination, dict):
+        return PriorityDestination(destination)
+    return destination
+
+
+class Rule(ValidatedRecord):
+    """
+    A validated rule.
+    """
+
+    fields = ('rule_type', 'nice_value', 'lower_bound', 'upper_bound', 'arguments',
+              'users', 'destination', 'fail_message')
+    __slots__ = fields + ('extra',)
+
+    def __init__(self, values):
+        ValidatedRecord.__init__(self, values)
+        object.__setattr__(self, 'destination', _validated_destination(self.destination))
+
+
+class ToolEntry(ValidatedRecord):
+    """
+    The validated section of a tool.
+    """
+
+    fields = ('default_destination', 'rules')
+    __slots__ = fields + ('extra',)
+
+    def __init__(self, values):
+        ValidatedRecord.__init__(self, values)
+        object.__setattr__(self, 'default_destination',
+                           _validated_destination(self.default_destination))
+
+
+def _add_tool_entry(tools, tool, entry):
+    """
+    Add the validated section of a tool to the tools of a validated config,
+    merging it with what's already there for tools whose id is both a number and
+    a string.
+    """
+    if tool in tools:
+        values = dict(tools[tool].items())
+        values.update(entry.items())
+        entry = ToolEntry(values)
+    tools[tool] = entry
+
+
+def validate_config(obj, return_bool=False, lazy=False, sections=None, checks=None):
     """
     Validate received config.
 
@@ -731,29 +1184,35 @@ def validate_config(obj, return_bool=False):
     @param return_bool: True when we are only interested in the result of the
                           validation, and not the validated rule itself.
 
+    @type lazy: bool
+    @param lazy: when the config's lazy_validation setting is also turned on,
+                 leave its tools to be validated when they're first looked up,
+                 see LazyToolSections
+
+    @type sections: dict
+    @param sections: if given, the digest, validated section and validity of the
+                     tools of an earlier version of the config, by tool (sections
+                     that are None are only known by their digest); tools with
+                     the same digest are reused rather than validated again,
+                     and it's updated with the tools of this version, or
+                     emptied when they're validated lazily
+
+    @type checks: dict
+    @param checks: if given when fixing the config, whether it validates
+                   without anything having to be fixed is stored in it under
+                   'valid'; tools validated lazily aren't checked
+
     @rtype: bool, dict (depending on return_bool)
     @return: validated rule or result of validation (depending on return_bool)
     """
 
-    def infinite_defaultdict():
-        return collections.defaultdict(infinite_defaultdict)
-
     # Allow new_config to expand automatically when adding values to new levels
     new_config = infinite_defaultdict()
 
-    global verbose
-    verbose = False
+    # verbose only applies to this validation, so that validating one config doesn't
+    # change how anything else logs
+    verbose = get_verbose(obj, return_bool)
     valid_config = True
-    valid_rule = True
-    tool_has_default = False
-
-    if return_bool:
-        verbose = True
-
-    elif obj is not None and 'verbose' in obj and isinstance(obj['verbose'], bool):
-        verbose = obj['verbose']
-    else:
-        valid_config = False
 
     if not return_bool and verbose:
         log.debug("Running config validation...")
@@ -762,9 +1221,6 @@ def validate_config(obj, return_bool=False):
     if not valid_config and return_bool:
         log.debug("Missing mandatory field 'verbose' in config!")
 
-    # a list with the available rule_types. Can be expanded on easily in the future
-    available_rule_types = ['file_size', 'num_input_datasets', 'records', 'arguments']
-
     if obj is not None:
         # in obj, there should always be only 4 categories: tools, default_destination,
         # users, and verbose
@@ -817,6 +1273,10 @@ def validate_config(obj, return_bool=False):
                 log.debug(error)
             valid_config = False
 
+        if isinstance(new_config.get('default_destination'), dict):
+            new_config['default_destination'] = PriorityDestination(
+                new_config['default_destination'])
+
         if 'users' in obj:
             if isinstance(obj['users'], dict):
                 for user in obj['users']:
@@ -848,161 +1308,86 @@ def validate_config(obj, return_bool=False):
                     log.debug(error)
                 valid_config = False
 
-        if 'tools' in obj:
-            for tool in obj['tools']:
-                curr = obj['tools'][tool]
-
-                # This check is to make sure we have a tool name, and not just
-                # rules right way.
-                if not isinstance(curr, list):
-                    curr_tool_rules = []
-
-                    if curr is not None:
-
-                        # in each tool, there should always be only 2 sub-categories:
-                        # default_destination (not mandatory) and rules (mandatory)
-                        if "default_destination" in curr:
-                            if isinstance(curr['default_destination'], str):
-                                new_config['tools'][tool]['default_destination'] = (
-                                    curr['default_destination'])
-                                tool_has_default = True
-                            elif isinstance(curr['default_destination'], dict):
-                                if ('priority' in curr['default_destination'] and
-                                        isinstance(
-                                            curr['default_destination']['priority'],
-                                            dict)):
-                                    if ('med' not in
-                                            curr['default_destination']['priority']):
-                                        error = "No default 'med' priority destination "
-                                        error += "for " + str(tool) + "!"
-                                        if verbose:
-                                            log.debug(error)
-                                        valid_config = False
-                                    else:
-                                        for priority, destination in (
-                                                curr['default_destination']['priority']):
-                                            if priority in ['low', 'med', 'high']:
-                                                if isinstance(destination, str):
-                                                    new_config['tools'][tool][
-                                                        'default_destination'][
-                                                            'priority'][
-                                                                priority] = destination
-                                                    tool_has_default = True
-                                                else:
-                                                    error = ("No default '" +
-                                                             str(priority) +
-                                                             "' priority destination " +
-                                                             "for " + str(tool) +
-                                                             " in config!")
-                                                    if verbose:
-                                                        log.debug(error)
-                                                    valid_config = False
-                                            else:
-                                                error = ("Invalid default priority " +
-                                                         "destination '" + str(priority) +
-                                                         "' for " + str(tool) +
-                                                         "found in config!")
-                                                if verbose:
-                                                    log.debug(error)
-                                                valid_config = False
-                                else:
-                                    error = "No default priority destinations specified"
-                                    error += " for " + str(tool) + " in config!"
-                                    if verbose:
-                                        log.debug(error)
-                                    valid_config = False
-
-                        if "rules" in curr and isinstance(curr['rules'], list):
-                            # under rules, there should only be a list of rules
-                            curr_tool = curr
-                            counter = 0
-
-                            for rule in curr_tool['rules']:
-                                if "rule_type" in rule:
-                                    if rule['rule_type'] in available_rule_types:
-                                        validated_rule = None
-                                        counter += 1
-
-                                        # if we're only interested in the result of
-                                        # the validation, then only retrieve the
-                                        # result
-                                        if return_bool:
-                                            valid_rule = RuleValidator.validate_rule(
-                                                rule['rule_type'], return_bool,
-                                                rule, counter, tool)
-
-                                        # otherwise, retrieve the processed rule
-                                        else:
-                                            validated_rule = (
-                                                RuleValidator.validate_rule(
-                                                    rule['rule_type'],
-                                                    return_bool,
-                                                    rule, counter, tool))
-
-                                        # if the result we get is False, then
-                                        # indicate that the whole config is invalid
-                                        if not valid_rule:
-                                            valid_config = False
-
-                                        # if we got a rule back that seems to be
-                                        # valid (or was fixable) then append it to
-                                        # list of ready-to-use tools
-                                        if (not return_bool and
-                                                validated_rule is not None):
-                                            curr_tool_rules.append(
-                                                copy.deepcopy(validated_rule))
-
-                                    # if rule['rule_type'] in available_rule_types
-                                    else:
-                                        error = "Unrecognized rule_type '"
-                                        error += rule['rule_type'] + "' "
-                                        error += "found in '" + str(tool) + "'. "
-                                        if not return_bool:
-                                            error += "Ignoring..."
-                                        if verbose:
-                                            log.debug(error)
-                                        valid_config = False
-
-                                # if "rule_type" in rule
-                                else:
-                                    counter += 1
-                                    error = "No rule_type found for rule "
-                                    error += str(counter)
-                                    error += " in '" + str(tool) + "'."
-                                    if verbose:
-                                        log.debug(error)
-                                    valid_config = False
+        if 'settings' in obj:
+            if isinstance(obj['settings'], dict):
+                for setting in obj['settings']:
+                    curr = obj['settings'][setting]
 
-                        # if "rules" in curr and isinstance(curr['rules'], list):
-                        elif not tool_has_default:
-                            valid_config = False
-                            error = "Tool '" + str(tool) + "' does not have rules nor a"
-                            error += " default_destination!"
+                    if setting in available_settings:
+                        setting_type = available_settings[setting][0]
+                        if (isinstance(curr, setting_type) and
+                                not (setting_type is int and isinstance(curr, bool))):
+                            new_config['settings'][setting] = curr
+                        else:
+                            error = "Invalid value '" + str(curr) + "' for setting '"
+                            error += str(setting) + "'!"
+                            if not return_bool:
+                                error += " Using default."
                             if verbose:
                                 log.debug(error)
-
-                    # if obj['tools'][tool] is not None:
+                            valid_config = False
                     else:
-                        valid_config = False
-                        error = "Config section for tool '" + str(tool) + "' is blank!"
+                        error = "Unrecognized setting '" + str(setting)
+                        error += "' found in config!"
+                        if not return_bool:
+                            error += " Ignoring..."
                         if verbose:
                             log.debug(error)
+                        valid_config = False
+            else:
+                error = "Settings option is not a dictionary!"
+                if verbose:
+                    log.debug(error)
+                valid_config = False
 
-                    if curr_tool_rules:
-                        new_config['tools'][str(tool)]['rules'] = curr_tool_rules
+        lazy = (lazy and not return_bool and 'settings' in new_config and
+                new_config['settings'].get('lazy_validation', False))
 
-                # if not isinstance(curr, list)
-                else:
-                    error = "Malformed YML; expected job name, "
-                    error += "but found a list instead!"
-                    if verbose:
-                        log.debug(error)
-                    valid_config = False
+        if 'tools' in obj:
+            if lazy and isinstance(obj['tools'], dict):
+                # tools are validated the first time one of their jobs is mapped,
+                # and aren't hashed, so which of them changed isn't known
+                new_config['tools'] = LazyToolSections(obj['tools'], verbose)
+                if sections is not None:
+                    sections.clear()
+            elif sections is not None and not return_bool:
+                new_sections = {}
+                tools = infinite_defaultdict()
+                for tool in obj['tools']:
+                    digest = _section_digest(obj['tools'][tool])
+                    if (tool in sections and sections[tool][0] == digest and
+                            sections[tool][1] is not None):
+                        validated, valid_tool = sections[tool][1:]
+                    else:
+                        validated = {}
+                        valid_tool = _validate_tool(tool, obj['tools'][tool], validated,
+                                                    return_bool, verbose)
+                    new_sections[tool] = (digest, validated, valid_tool)
+                    if not valid_tool:
+                        valid_config = False
+
+                    # sections are shared with the earlier version as they are,
+                    # so that their compiled rules can be reused too
+                    for key, entry in validated.items():
+                        _add_tool_entry(tools, key, entry)
+                if tools:
+                    new_config['tools'] = tools
+                sections.clear()
+                sections.update(new_sections)
+            else:
+                tools = infinite_defaultdict()
+                for tool in obj['tools']:
+                    if not _validate_tool(tool, obj['tools'][tool], tools,
+                                          return_bool, verbose):
+                        valid_config = False
+                if tools:
+                    new_config['tools'] = tools
 
         # quickly run through categories to detect unrecognized types
         for category in obj.keys():
             if not (category == 'verbose' or category == 'tools' or
-                    category == 'default_destination' or category == 'users'):
+                    category == 'default_destination' or category == 'users' or
+                    category == 'settings'):
                 error = "Unrecognized category '" + category
                 error += "' found in config file!"
                 if verbose:
@@ -1018,6 +1403,8 @@ def validate_config(obj, return_bool=False):
     if not return_bool:
         if verbose:
             log.debug("Finished config validation.")
+        if checks is not None:
+            checks['valid'] = valid_config
 
     if return_bool:
         return valid_config
@@ -1026,47 +1413,305 @@ def validate_config(obj, return_bool=False):
         return new_config
 
 
-def bytes_to_str(size, unit="YB"):
-    '''
-    Uses the bi convention: 1024 B = 1 KB since this method primarily
-    has inputs of bytes for RAM
-
-    @type size: int
-    @param size: the size in int (bytes) to be converted to str
+def _section_digest(section):
+    """
+    @return: the SHA-1 of a section of a config, as parsed, in hexadecimal
 
-    @rtype: str
-    @return return_str: the resulting string
-    '''
-    # converts size in bytes to most readable unit
-    units = ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"]
-    i = 0
+    The section's repr keeps the types of its keys and values apart (123 and
+    '123'), and is much cheaper to get than a canonical serialization. It follows
+    the order the keys were parsed in, so a section whose keys were only
+    reordered looks changed, and is just validated again.
+    """
+    return hashlib.sha1(repr(section).encode('utf-8')).hexdigest()
 
-    # mostly called in order to convert "infinity"
-    try:
-        size_changer = int(size)
-    except ValueError:
-        error = "bytes_to_str passed uncastable non numeric value "
-        raise ValueError(error + str(size))
 
-    try:
-        upto = units.index(unit.strip().upper())
-    except ValueError:
-        upto = 9
+def _validate_tool(tool, curr, tools, return_bool=False, verbose=False):
+    """
+    Validate the section of one tool of a config.
 
-    while size_changer >= 1024 and i < upto:
-        size_changer = size_changer / 1024.0
-        i += 1
+    @type tool: str
+    @param tool: the tool's id
 
-    if size_changer == -1:
-        size_changer = "Infinity"
-        i = 0
+    @param curr: the tool's section of the config
 
-    try:
-        return_str = "%.2f %s" % (size_changer, units[i])
-    except TypeError:
-        return_str = "%s" % (size_changer)
+    @type tools: dict
+    @param tools: where the validated section is stored as a ToolEntry, under the
+                  tool's id
 
-    return return_str
+    @type return_bool: bool
+    @param return_bool: True when we are only interested in the result of the
+                          validation, and not the validated rule itself.
+
+    @type verbose: bool
+    @param verbose: log what's wrong with the section when True
+
+    @rtype: bool
+    @return: whether the section is valid, without anything having to be fixed
+    """
+    valid_tool = True
+    valid_rule = True
+    tool_has_default = False
+    validated = infinite_defaultdict()
+
+    # This check is to make sure we have a tool name, and not just
+    # rules right way.
+    if not isinstance(curr, list):
+        curr_tool_rules = []
+
+        if curr is not None:
+
+            # in each tool, there should always be only 2 sub-categories:
+            # default_destination (not mandatory) and rules (mandatory)
+            if "default_destination" in curr:
+                if isinstance(curr['default_destination'], str):
+                    validated[tool]['default_destination'] = curr['default_destination']
+                    tool_has_default = True
+                elif isinstance(curr['default_destination'], dict):
+                    if ('priority' in curr['default_destination'] and
+                            isinstance(curr['default_destination']['priority'], dict)):
+                        if 'med' not in curr['default_destination']['priority']:
+                            error = "No default 'med' priority destination "
+                            error += "for " + str(tool) + "!"
+                            if verbose:
+                                log.debug(error)
+                            valid_tool = False
+                        else:
+                            for priority, destination in (
+                                    curr['default_destination']['priority'].items()):
+                                if priority in ['low', 'med', 'high']:
+                                    if isinstance(destination, str):
+                                        validated[tool]['default_destination'][
+                                            'priority'][priority] = destination
+                                        tool_has_default = True
+                                    else:
+                                        error = ("No default '" + str(priority) +
+                                                 "' priority destination for " +
+                                                 str(tool) + " in config!")
+                                        if verbose:
+                                            log.debug(error)
+                                        valid_tool = False
+                                else:
+                                    error = ("Invalid default priority " +
+                                             "destination '" + str(priority) +
+                                             "' for " + str(tool) +
+                                             "found in config!")
+                                    if verbose:
+                                        log.debug(error)
+                                    valid_tool = False
+                    else:
+                        error = "No default priority destinations specified"
+                        error += " for " + str(tool) + " in config!"
+                        if verbose:
+                            log.debug(error)
+                        valid_tool = False
+
+            if "rules" in curr and isinstance(curr['rules'], list):
+                # under rules, there should only be a list of rules
+                curr_tool = curr
+                counter = 0
+
+                for rule in curr_tool['rules']:
+                    if "rule_type" in rule:
+                        if rule['rule_type'] in available_rule_types:
+                            validated_rule = None
+                            counter += 1
+
+                            # if we're only interested in the result of the
+                            # validation, then only retrieve the result
+                            if return_bool:
+                                valid_rule = RuleValidator.validate_rule(
+                                    rule['rule_type'], return_bool,
+                                    rule, counter, tool, verbose)
+
+                            # otherwise, retrieve the processed rule, and
+                            # whether it had to be fixed
+                            else:
+                                errors = []
+                                validated_rule = RuleValidator.validate_rule(
+                                    rule['rule_type'], return_bool,
+                                    rule, counter, tool, verbose, errors)
+                                valid_rule = not errors
+
+                            # if the result we get is False, then indicate that
+                            # the whole config is invalid
+                            if not valid_rule:
+                                valid_tool = False
+
+                            # if we got a rule back that seems to be valid (or
+                            # was fixable) then append it to list of
+                            # ready-to-use tools; it's already a copy
+                            if not return_bool and validated_rule is not None:
+                                curr_tool_rules.append(Rule(validated_rule))
+
+                        # if rule['rule_type'] in available_rule_types
+                        else:
+                            error = "Unrecognized rule_type '"
+                            error += rule['rule_type'] + "' "
+                            error += "found in '" + str(tool) + "'. "
+                            if not return_bool:
+                                error += "Ignoring..."
+                            if verbose:
+                                log.debug(error)
+                            valid_tool = False
+
+                    # if "rule_type" in rule
+                    else:
+                        counter += 1
+                        error = "No rule_type found for rule "
+                        error += str(counter)
+                        error += " in '" + str(tool) + "'."
+                        if verbose:
+                            log.debug(error)
+                        valid_tool = False
+
+            # if "rules" in curr and isinstance(curr['rules'], list):
+            elif not tool_has_default:
+                valid_tool = False
+                error = "Tool '" + str(tool) + "' does not have rules nor a"
+                error += " default_destination!"
+                if verbose:
+                    log.debug(error)
+
+        # if obj['tools'][tool] is not None:
+        else:
+            valid_tool = False
+            error = "Config section for tool '" + str(tool) + "' is blank!"
+            if verbose:
+                log.debug(error)
+
+        if curr_tool_rules:
+            validated[str(tool)]['rules'] = curr_tool_rules
+
+    # if not isinstance(curr, list)
+    else:
+        error = "Malformed YML; expected job name, "
+        error += "but found a list instead!"
+        if verbose:
+            log.debug(error)
+        valid_tool = False
+
+    for key, section in validated.items():
+        _add_tool_entry(tools, key, ToolEntry(section))
+
+    return valid_tool
+
+
+def _tool_error(tool, error):
+    """
+    @type tool: str
+    @param tool: the id of a tool that couldn't be validated or compiled
+
+    @type error: Exception
+    @param error: why it couldn't be
+
+    @rtype: MalformedYMLException
+    @return: the error to raise for each of the tool's jobs
+    """
+    if isinstance(error, MalformedYMLException):
+        return error
+    return MalformedYMLException("Couldn't load the rules of '" + str(tool) + "': " +
+                                 repr(error))
+
+
+class LazyToolSections(object):
+    """
+    The tools of a config that are only validated when they're first looked up,
+    for configs with so many tools that validating all of them would hold up the
+    first jobs mapped after loading the config.
+    """
+
+    def __init__(self, tools, verbose=False):
+        """
+        @type tools: dict
+        @param tools: the tools section of the config, not validated yet
+
+        @type verbose: bool
+        @param verbose: log what's wrong with the sections when True
+        """
+        self.tools = tools
+        self.verbose = verbose
+        self.sections = {}
+        self.lock = threading.Lock()
+
+        # the keys of the sections by tool id, since ids that look like numbers
+        # are parsed as numbers
+        self.keys = collections.defaultdict(list)
+        for key in tools:
+            self.keys[str(key)].append(key)
+
+    def get(self, tool, default=None):
+        """
+        @type tool: str
+        @param tool: the tool's id
+
+        @rtype: dict
+        @return: the validated section of the tool, or default if there isn't one
+        """
+        section = self.sections.get(tool, _missing)
+        if section is _missing:
+            with self.lock:
+                section = self.sections.get(tool, _missing)
+                if section is _missing:
+                    validated = {}
+                    try:
+                        for key in self.keys.get(str(tool), ()):
+                            _validate_tool(key, self.tools[key], validated,
+                                           verbose=self.verbose)
+                        section = validated.get(tool)
+                    except Exception as e:
+                        # the tool can't be validated; raise why for each of its
+                        # jobs rather than validating it again
+                        section = _tool_error(tool, e)
+                    self.sections[tool] = section
+
+        if isinstance(section, MalformedYMLException):
+            raise section
+        if section is None:
+            return default
+        return section
+
+
+def bytes_to_str(size, unit="YB"):
+    '''
+    Uses the bi convention: 1024 B = 1 KB since this method primarily
+    has inputs of bytes for RAM
+
+    @type size: int
+    @param size: the size in int (bytes) to be converted to str
+
+    @rtype: str
+    @return return_str: the resulting string
+    '''
+    # converts size in bytes to most readable unit
+    units = ["B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"]
+    i = 0
+
+    # mostly called in order to convert "infinity"
+    try:
+        size_changer = int(size)
+    except ValueError:
+        error = "bytes_to_str passed uncastable non numeric value "
+        raise ValueError(error + str(size))
+
+    try:
+        upto = units.index(unit.strip().upper())
+    except ValueError:
+        upto = 9
+
+    while size_changer >= 1024 and i < upto:
+        size_changer = size_changer / 1024.0
+        i += 1
+
+    if size_changer == -1:
+        size_changer = "Infinity"
+        i = 0
+
+    try:
+        return_str = "%.2f %s" % (size_changer, units[i])
+    except TypeError:
+        return_str = "%s" % (size_changer)
+
+    return return_str
 
 
 def str_to_bytes(size):
@@ -1080,6 +1725,9 @@ def str_to_bytes(size):
     @rtype: int
     @return curr_size: the resulting size converted from str
     '''
+    if isinstance(size, numbers.Number):
+        return size
+
     units = ["", "b", "kb", "mb", "gb", "tb", "pb", "eb", "zb", "yb"]
     curr_size = size
 
@@ -1122,338 +1770,2593 @@ def str_to_bytes(size):
     return curr_size
 
 
-def importer(test):
-    """
-    Uses Mock galaxy for testing or real galaxy for production
+# the bounds of rules converted by bound_to_bytes, by how they're written
+_bound_sizes = {}
 
-    @type test: bool
-    @param test: True when being run from a test
+# how many bounds _bound_sizes holds before it's emptied
+BOUND_SIZES_LIMIT = 10000
+
+
+def bound_to_bytes(size):
     """
-    global JobDestination
-    global JobMappingException
-    if test:
-        from tests.mockGalaxy import JobDestination
-        from tests.mockGalaxy import JobMappingException
-    else:
-        from galaxy.jobs import JobDestination
-        from galaxy.jobs.mapper import JobMappingException
+    Same as str_to_bytes, but remembers what the bounds of rules convert to,
+    since configs use the same few sizes in many rules.
+    """
+    try:
+        return _bound_sizes[size]
+    except KeyError:
+        if len(_bound_sizes) >= BOUND_SIZES_LIMIT:
+            _bound_sizes.clear()
+        converted = _bound_sizes[size] = str_to_bytes(size)
+        return converted
+    except TypeError:
+        # not hashable, so not a size either
+        return str_to_bytes(size)
 
 
-def map_tool_to_destination(
-        job, app, tool, user_email, test=False, path="/config/tool_destinations.yml"):
+# upper bound of rules that go up to Infinity
+INFINITY = float('inf')
+
+
+def resolve_destination(destination, priority, default_priority='med'):
     """
-    Dynamically allocate resources
+    Pick the destination to use for a user's priority.
 
-    @param job: galaxy job
-    @param app: current app
-    @param tool: current tool
+    @type destination: str, dict
+    @param destination: a destination name, or a dict of destinations per priority
+                          under 'priority'
 
-    @type test: bool
-    @param test: True when running in test mode
+    @type priority: str
+    @param priority: the user's priority
 
-    @type path: str
-    @param path: path to tool_destinations.yml
+    @type default_priority: str
+    @param default_priority: the priority to fall back on if there isn't a
+                               destination for the user's priority
+
+    @rtype: str
+    @return: the destination's name
     """
-    importer(test)
+    if isinstance(destination, str):
+        return destination
 
-    # set verbose to True by default, just in case (some tests fail without this due to
-    # how the tests apparently work)
-    global verbose
-    verbose = True
-    filesize_rule_present = False
-    num_input_datasets_rule_present = False
-    records_rule_present = False
+    if priority in destination['priority']:
+        return destination['priority'][priority]
 
-    # Get configuration from tool_destinations.yml
-    try:
-        config = parse_yaml(path)
-    except MalformedYMLException as e:
-        raise JobMappingException(e)
+    return destination['priority'][default_priority]
 
-    # Get all inputs from tool and databases
-    inp_data = dict([(da.name, da.dataset) for da in job.input_datasets])
-    inp_data.update([(da.name, da.dataset) for da in job.input_library_datasets])
 
-    try:
-        # If you're going to the vfdb do this.
-        for this_tool in tool.installed_tool_dependencies:
-            if this_tool.name == "vfdb":
-                bact = job.get_param_values(app, True)["mlst_or_genedb"]["vfdb_in"]
-                install_dir = str(this_tool.installation_directory(app))
-                _file = glob.glob(install_dir + "/vfdb/?" + bact[1:] + "*")
-                inp_db = open(str(_file[0]))
-                if verbose:
-                    log.debug("Loading file: " + _file[0])
-    except(KeyError, IndexError, TypeError):
-        if verbose:
-            log.info("No virulence factors database")
+def _match_bounds(rule, measure, verbose=False):
+    """
+    Match rules that apply to inputs of a size between lower_bound (inclusive) and
+    upper_bound (exclusive).
+    """
+    value = measure(rule.rule_type)
+    return rule.lower_bound <= value and value < rule.upper_bound
 
-    if config is not None and str(tool.old_id) in config['tools']:
-        if 'rules' in config['tools'][str(tool.old_id)]:
-            for rule in config['tools'][str(tool.old_id)]['rules']:
-                if rule["rule_type"] == "file_size":
-                    filesize_rule_present = True
 
-                if rule["rule_type"] == "num_input_datasets":
-                    num_input_datasets_rule_present = True
+# stands in for parameters a job doesn't have
+_missing = object()
 
-                if rule["rule_type"] == "records":
-                    records_rule_present = True
 
-    file_size = 0
-    records = 0
-    num_input_datasets = 0
+def _param_value(options, arg, path):
+    """
+    Find the value of one of a job's parameters, either by its name or, for
+    parameters inside conditionals and sections, by the dotted path to it.
 
-    if filesize_rule_present or records_rule_present or num_input_datasets_rule_present:
-        # Loop through the database and look for amount of records
-        try:
-            for line in inp_db:
-                if line[0] == ">":
-                    records += 1
-        except NameError:
-            pass
-        # Loop through each input file and adds the size to the total
-        # or looks through db for records
-        for da in inp_data:
-            try:
-                # If the input is a file, check and add the size
-                if inp_data[da] is not None and os.path.isfile(inp_data[da].file_name):
-                    num_input_datasets += 1
-                    if verbose:
-                        message = "Loading file: " + str(da)
-                        message += str(inp_data[da].file_name)
-                        log.debug(message)
-
-                    # Add to records if the file type is fasta
-                    if inp_data[da].ext == "fasta":
-                        if records_rule_present:
-                            inp_db = open(inp_data[da].file_name)
-
-                            # Try to find automatically computed sequences
-                            metadata = inp_data[da].get_metadata()
-
-                            try:
-                                records += int(metadata.get("sequences"))
-                            except (TypeError, KeyError):
-                                for line in inp_db:
-                                    if line[0] == ">":
-                                        records += 1
-                    elif filesize_rule_present:
-                        query_file = str(inp_data[da].file_name)
-                        file_size += os.path.getsize(query_file)
-            except AttributeError:
-                # Otherwise, say that input isn't a file
-                if verbose:
-                    log.debug("Not a file: " + str(inp_data[da]))
+    @type options: dict
+    @param options: the job's parameter values
 
-        if verbose:
-            if filesize_rule_present:
-                log.debug("Total size: " + bytes_to_str(file_size))
-            if records_rule_present:
-                log.debug("Total amount of records: " + str(records))
-            if num_input_datasets_rule_present:
-                log.debug("Total number of files: " + str(num_input_datasets))
-
-    matched_rule = None
-    user_authorized = None
-    rule_counter = 0
-
-    # For each different rule for the tool that's running
-    fail_message = None
-
-    # set default priority to med
-    default_priority = 'med'
-    priority = default_priority
-
-    if config is not None:
-        # get the users priority
-        if "users" in config:
-            if user_email in config["users"]:
-                priority = config["users"][user_email]["priority"]
-
-        if "default_destination" in config:
-            if isinstance(config['default_destination'], str):
-                destination = config['default_destination']
-            else:
-                if priority in config['default_destination']['priority']:
-                    destination = config['default_destination']['priority'][priority]
-                else:
-                    destination = (
-                        config['default_destination']['priority'][default_priority])
-            config = config['tools']
-            if str(tool.old_id) in config:
-                if 'rules' in config[str(tool.old_id)]:
-                    for rule in config[str(tool.old_id)]['rules']:
-                        rule_counter += 1
-                        user_authorized = False
-                        if 'users' in rule and isinstance(rule['users'], list):
-                            if user_email in rule['users']:
-                                user_authorized = True
-                        else:
-                            user_authorized = True
+    @type arg: str
+    @param arg: the argument as given in the rule
 
-                        if user_authorized:
-                            matched = False
-                            if rule["rule_type"] == "file_size":
+    @type path: tuple
+    @param path: arg split on its dots
 
-                                # bounds comparisons
-                                upper_bound = str_to_bytes(rule["upper_bound"])
-                                lower_bound = str_to_bytes(rule["lower_bound"])
+    @return: the parameter's value, or _missing if the job doesn't have it
+    """
+    if arg in options:
+        return options[arg]
 
-                                if upper_bound == -1:
-                                    if lower_bound <= file_size:
-                                        matched = True
+    if len(path) == 1:
+        return _missing
 
-                                else:
-                                    if (lower_bound <= file_size and
-                                            file_size < upper_bound):
-                                        matched = True
+    value = options
+    for name in path:
+        if not isinstance(value, dict) or name not in value:
+            return _missing
+        value = value[name]
 
-                            elif rule["rule_type"] == "num_input_datasets":
+    return value
 
-                                # bounds comparisons
-                                upper_bound = rule["upper_bound"]
-                                lower_bound = rule["lower_bound"]
 
-                                if upper_bound == "Infinity":
-                                    if lower_bound <= num_input_datasets:
-                                        matched = True
-                                else:
-                                    if (lower_bound <= num_input_datasets and
-                                            num_input_datasets < upper_bound):
-                                        matched = True
+def _match_arguments(rule, measure, verbose=False):
+    """
+    Match rules that apply when all of their arguments have the configured value.
+    """
+    options = measure('params')
 
-                            elif rule["rule_type"] == "records":
+    for arg, path, expected in rule.argument_paths:
+        value = _param_value(options, arg, path)
+        if value is _missing:
+            if verbose:
+                log.debug("Argument '" + str(arg) + "' not recognized!")
+            return False
 
-                                # bounds comparisons
-                                upper_bound = str_to_bytes(rule["upper_bound"])
-                                lower_bound = str_to_bytes(rule["lower_bound"])
+        if expected != value:
+            return False
 
-                                if upper_bound == -1:
-                                    if lower_bound <= records:
-                                        matched = True
+    return True
 
-                                else:
-                                    if lower_bound <= records and records < upper_bound:
-                                        matched = True
-
-                            elif rule["rule_type"] == "arguments":
-                                options = job.get_param_values(app)
-                                matched = True
-
-                                # check if the args in the config file are available
-                                for arg in rule["arguments"]:
-                                    if arg in options:
-                                        if rule["arguments"][arg] != options[arg]:
-                                            matched = False
-                                            options = "test"
-                                    else:
-                                        matched = False
-                                        if verbose:
-                                            error = "Argument '" + str(arg)
-                                            error = + "' not recognized!"
-                                            log.debug(error)
 
-                            # if we matched a rule
-                            if matched:
-                                if (matched_rule is None or rule["nice_value"] <
-                                        matched_rule["nice_value"]):
-                                    matched_rule = rule
-                        # if user_authorized
-                        else:
-                            if verbose:
-                                error = "User email '" + str(user_email) + "' not "
-                                error += "specified in list of authorized users for "
-                                error += "rule " + str(rule_counter) + " in tool '"
-                                error += str(tool.old_id) + "'! Ignoring rule."
-                                log.debug(error)
+# how to match each rule_type; the bounded types compare the measurement of the
+# same name with the rule's bounds
+_rule_matchers = {
+    'file_size': _match_bounds,
+    'num_input_datasets': _match_bounds,
+    'records': _match_bounds,
+    'arguments': _match_arguments,
+}
 
-            # if str(tool.old_id) in config
-            else:
-                error = "Tool '" + str(tool.old_id) + "' not specified in config. "
-                error += "Using default destination."
-                if verbose:
-                    log.debug(error)
 
-            if matched_rule is None:
-                if "default_destination" in config[str(tool.old_id)]:
-                    default_tool_destination = (
-                        config[str(tool.old_id)]['default_destination'])
-                    if isinstance(default_tool_destination, str):
-                        destination = default_tool_destination
-                    else:
-                        if priority in default_tool_destination['priority']:
-                            destination = default_tool_destination['priority'][priority]
-                        else:
-                            destination = (
-                                default_tool_destination['priority'][default_priority])
-            else:
-                if isinstance(matched_rule["destination"], str):
-                    destination = matched_rule["destination"]
-                else:
-                    if priority in matched_rule["destination"]["priority"]:
-                        destination = matched_rule["destination"]["priority"][priority]
-                    else:
-                        destination = (
-                            matched_rule["destination"]["priority"][default_priority])
+class CompiledRule(object):
+    """
+    A validated rule, with its bounds converted to numbers and its matching
+    function looked up, so that matching a job only has to compare values.
+    """
 
-        # if "default_destination" in config
-        else:
-            destination = "fail"
-            fail_message = "Job '" + str(tool.old_id) + "' failed; "
-            fail_message += "no global default destination specified in config!"
+    __slots__ = ('number', 'rule_type', 'nice_value', 'key', 'destination',
+                 'fail_message', 'arguments', 'match', 'argument_paths', 'users',
+                 'lower_bound', 'upper_bound')
 
-    # if config is not None
-    else:
-        destination = "fail"
-        fail_message = "No config file supplied!"
+    def __init__(self, rule, number):
+        """
+        @type rule: dict
+        @param rule: the validated rule
 
-    if destination == "fail":
-        if fail_message:
-            raise JobMappingException(fail_message)
+        @type number: int
+        @param number: the rule's position among the tool's rules, starting at 1
+        """
+        self.number = number
+        self.rule_type = rule['rule_type']
+        self.nice_value = rule['nice_value']
+        # rules with a lower key win
+        self.key = (self.nice_value, number)
+        # validation keeps rules without a destination; they only fail jobs
+        # that match them
+        self.destination = rule.get('destination')
+        self.fail_message = rule.get('fail_message')
+        self.arguments = rule.get('arguments')
+        self.match = _rule_matchers[self.rule_type]
+
+        # arguments as (name, dotted path, value), so that matching doesn't
+        # have to split the names of nested parameters for every job
+        self.argument_paths = ()
+        if isinstance(self.arguments, dict):
+            self.argument_paths = tuple(
+                (arg, tuple(str(arg).split('.')), self.arguments[arg])
+                for arg in self.arguments)
+
+        if isinstance(rule.get('users'), list):
+            self.users = frozenset(rule['users'])
         else:
-            raise JobMappingException(matched_rule["fail_message"])
+            self.users = None
+
+        self.lower_bound = None
+        self.upper_bound = None
+        if self.rule_type in ('file_size', 'records'):
+            self.lower_bound = bound_to_bytes(rule['lower_bound'])
+            self.upper_bound = bound_to_bytes(rule['upper_bound'])
+            if self.upper_bound == -1:
+                self.upper_bound = INFINITY
+        elif self.rule_type == 'num_input_datasets':
+            self.lower_bound = rule['lower_bound']
+            self.upper_bound = rule['upper_bound']
+            if self.upper_bound == "Infinity":
+                self.upper_bound = INFINITY
+
+    def authorized(self, user_email):
+        """
+        @rtype: bool
+        @return: whether the rule applies to jobs from user_email
+        """
+        return self.users is None or user_email in self.users
 
-    if config is not None:
-        if destination == "fail":
-            output = "An error occurred: " + fail_message
 
-        else:
-            output = "Running '" + str(tool.old_id) + "' with '"
-            output += destination + "'."
-            log.debug(output)
+class IntervalIndex(object):
+    """
+    Finds the winning rule of one bounded rule_type for a measurement with a single
+    bisect. The bounds of all the rules split the possible values into intervals in
+    which the same rules match, and the rules matching each interval are sorted
+    ahead of time from winner to loser.
+    """
 
-    return destination
+    def __init__(self, rules):
+        """
+        @type rules: list
+        @param rules: CompiledRules of the same rule_type, with numeric bounds
+        """
+        rules = [rule for rule in rules if rule.lower_bound < rule.upper_bound]
+
+        # only rules restricted to some users can lose to rules that don't match as
+        # well, so without them there's no need to keep more than the winner
+        keep_all = False
+        starting = collections.defaultdict(list)
+        ending = collections.defaultdict(list)
+        for rule in rules:
+            starting[rule.lower_bound].append(rule)
+            ending[rule.upper_bound].append(rule)
+            if rule.users is not None:
+                keep_all = True
+
+        self.boundaries = sorted(
+            (set(starting.keys()) | set(ending.keys())) - set([INFINITY]))
+
+        # candidates[0] is for values below the first boundary, which no rule
+        # matches; candidates[i] is for values in [boundaries[i - 1], boundaries[i])
+        self.candidates = [()]
+        matching = set()
+        for boundary in self.boundaries:
+            matching.difference_update(ending.get(boundary, ()))
+            matching.update(starting.get(boundary, ()))
+            candidates = sorted(matching, key=lambda rule: rule.key)
+            if not keep_all:
+                candidates = candidates[:1]
+            self.candidates.append(tuple(candidates))
+
+        # the best key a rule found by lookup can have, or None if no value matches
+        self.min_key = None
+        if rules:
+            self.min_key = min(rule.key for rule in rules)
+
+    def lookup(self, value, user_email):
+        """
+        @type value: int
+        @param value: the job's measurement
 
-if __name__ == '__main__':
+        @type user_email: str
+        @param user_email: the email of the user running the job
+
+        @rtype: CompiledRule
+        @return: the winning rule that matches value, or None
+        """
+        candidates = self.candidates[bisect.bisect_right(self.boundaries, value)]
+        for rule in candidates:
+            if rule.authorized(user_email):
+                return rule
+
+        return None
+
+
+def _numeric_bound(bound):
+    return isinstance(bound, numbers.Number) and not isinstance(bound, bool)
+
+
+class CompiledRuleSet(object):
     """
-    This function is responsible for running the app if directly run through the
-    commandline. It offers the ability to specify a config through the commandline
-    for checking whether or not it is a valid config. It's to be run from within Galaxy,
-    assuming it is installed correctly within the proper directories in Galaxy, and it
-    looks for the config file in galaxy/config/. It can also be run with a path pointing
-    to a config file if not being run directly from inside Galaxy install directory.
+    All of the compiled rules of a tool, along with its default destination.
     """
-    verbose = True
 
-    parser = argparse.ArgumentParser()
-    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+    def __init__(self, tool, tool_config):
+        """
+        @type tool: str
+        @param tool: the tool's id
 
-    parser.add_argument(
-        '-c', '--check-config', dest='check_config', nargs='?',
-        help='Use this option to validate tool_destinations.yml.' +
-        ' Optionally, provide the path to the tool_destinations.yml' +
-        ' that you would like to check. Default: galaxy/config/tool_destinations.yml')
+        @type tool_config: dict
+        @param tool_config: the tool's validated section of the config
+        """
+        self.tool = tool
+        self.default_destination = tool_config.get('default_destination')
+        self.error = None
 
-    parser.add_argument(
-        '-V', '--version', action='version', version="%(prog)s " + __version__)
+        rules = []
+        try:
+            for number, rule in enumerate(tool_config.get('rules', []), 1):
+                rules.append(CompiledRule(rule, number))
+        except Exception as e:
+            # only the jobs of this tool can't be mapped; raise when they are
+            self.error = _tool_error(tool, e)
+        self.rules = tuple(rules)
+
+        self.rule_types = frozenset(rule.rule_type for rule in self.rules)
+        self.restricted_rules = tuple(rule for rule in self.rules if rule.users)
+
+        # bounded rules are looked up in an IntervalIndex per rule_type; the
+        # others (and bounded rules with bounds that aren't numbers) are matched
+        # one by one
+        self.indexes = []
+        unindexed_rules = []
+        for rule_type in ('num_input_datasets', 'file_size', 'records'):
+            typed_rules = [rule for rule in self.rules if rule.rule_type == rule_type]
+            if not typed_rules:
+                continue
+
+            if all(_numeric_bound(rule.lower_bound) and _numeric_bound(rule.upper_bound)
+                   for rule in typed_rules):
+                self.indexes.append((rule_type, IntervalIndex(typed_rules)))
+            else:
+                unindexed_rules.extend(typed_rules)
+
+        unindexed_rules.extend(
+            rule for rule in self.rules if rule.rule_type == 'arguments')
+        self.unindexed_rules = tuple(sorted(unindexed_rules, key=lambda rule: rule.key))
+
+        # the indexes and the unindexed rules, as (best key, rule_type, index) and
+        # (key, None, rule), in the order they're tried when matching; once a rule
+        # matched, the ones after it can't beat it and don't need measuring
+        stages = [(index.min_key, rule_type, index)
+                  for rule_type, index in self.indexes if index.min_key is not None]
+        stages.extend((rule.key, None, rule) for rule in self.unindexed_rules)
+        self.stages = tuple(sorted(stages, key=lambda stage: stage[0]))
+
+        # the features of a job the stages read, as (measurement, index), in the
+        # order they're first read; feature_counts[i] is how many of them the
+        # first i stages read. Matching reads a prefix of the features, which is
+        # what a DecisionCache keys its decisions with.
+        self.features = []
+        self.feature_counts = [0]
+        argument_paths = []
+        for key, rule_type, stage in self.stages:
+            if rule_type is not None:
+                feature = (rule_type, stage)
+            elif stage.rule_type == 'arguments':
+                feature = ('params', None)
+                for arg, path, value in stage.argument_paths:
+                    if (arg, path) not in argument_paths:
+                        argument_paths.append((arg, path))
+            else:
+                feature = (stage.rule_type, None)
 
-    args = parser.parse_args()
+            if feature[0] not in [name for name, index in self.features]:
+                self.features.append(feature)
+            self.feature_counts.append(len(self.features))
+        self.features = tuple(self.features)
+        self.argument_paths = tuple(argument_paths)
 
-    # if run with no arguments, display the help message
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit(1)
+    def match(self, user_email, measure, verbose=False):
+        """
+        Find the rule a job should be sent with. When more than one rule matches,
+        the one with the lowest nice_value wins, and the first one in the config
+        wins among those.
+
+        @type user_email: str
+        @param user_email: the email of the user running the job
+
+        @type measure: callable
+        @param measure: takes the name of a measurement ('file_size', 'records',
+                          'num_input_datasets' or 'params') and returns its value
+                          for the job; it's only called for the measurements
+                          of rules that could still win
+
+        @type verbose: bool
+        @param verbose: log why rules were ignored when True
+
+        @rtype: CompiledRule
+        @return: the matched rule, or None if no rule matched
+        """
+        return self.match_stages(user_email, measure, verbose)[0]
+
+    def match_stages(self, user_email, measure, verbose=False):
+        """
+        Like match, but also tell how many stages were tried.
+
+        @rtype: CompiledRule, int (tuple)
+        @return: the matched rule, or None, and the number of stages tried
+        """
+        if self.error is not None:
+            raise self.error
+
+        if verbose:
+            self.log_unauthorized(user_email)
+
+        matched_rule = None
+        tried = 0
+        for key, rule_type, stage in self.stages:
+            if matched_rule is not None and key >= matched_rule.key:
+                break
+
+            tried += 1
+            if rule_type is not None:
+                rule = stage.lookup(measure(rule_type), user_email)
+                if rule is not None and (matched_rule is None or
+                                         rule.key < matched_rule.key):
+                    matched_rule = rule
+            elif stage.authorized(user_email) and stage.match(stage, measure, verbose):
+                matched_rule = stage
+
+        return matched_rule, tried
+
+    def log_unauthorized(self, user_email):
+        """
+        Log the rules that are ignored because user_email isn't one of their users.
+        """
+        for rule in self.restricted_rules:
+            if not rule.authorized(user_email):
+                error = "User email '" + str(user_email) + "' not "
+                error += "specified in list of authorized users for "
+                error += "rule " + str(rule.number) + " in tool '"
+                error += str(self.tool) + "'! Ignoring rule."
+                log.debug(error)
+
+    def feature_value(self, feature, measure):
+        """
+        Get the value of one of self.features for a job. For indexed rule_types
+        that's the interval the measurement falls in, since every measurement in
+        it matches the same rules.
+
+        @type feature: tuple
+        @param feature: one of self.features
+
+        @type measure: callable
+        @param measure: see match
+
+        @return: the feature's value
+        """
+        name, index = feature
+        if name == 'params':
+            params = measure('params')
+            return tuple(_param_value(params, arg, path)
+                         for arg, path in self.argument_paths)
+
+        value = measure(name)
+        if index is not None:
+            return bisect.bisect_right(index.boundaries, value)
+        return value
+
+
+# marks the features of a DecisionCache key that more features are needed after
+_more_features = object()
+
+
+class LRUCache(object):
+    """
+    A thread safe dict that keeps at most max_entries entries, dropping the least
+    recently used ones first, and optionally forgets entries older than ttl.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None):
+        """
+        @type max_entries: int
+        @param max_entries: how many entries to keep
+
+        @type ttl: int
+        @param ttl: how many seconds to keep entries for, or None to keep them
+                    until they're evicted
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.tick = 0
+
+    def get(self, key):
+        """
+        @return: the value of key, or None if it isn't cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl is not None and time.time() - entry[2] > self.ttl:
+                del self.entries[key]
+                return None
+            self.tick += 1
+            entry[1] = self.tick
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.tick += 1
+            self.entries[key] = [value, self.tick, time.time()]
+            if len(self.entries) > self.max_entries:
+                # drop the least recently used quarter at once, so evicting
+                # doesn't sort the entries for every put
+                used = sorted(self.entries.items(), key=lambda item: item[1][1])
+                for old_key, entry in used[:len(used) - self.max_entries * 3 // 4]:
+                    del self.entries[old_key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DecisionCache(LRUCache):
+    """
+    A cache of the rules CompiledRuleSets matched, keyed by the tool, the user
+    when the tool has rules restricted to some users, and the values of the
+    features of the job the match read.
+
+    Since a rule set always reads its features in the same order, the features
+    read are a prefix of CompiledRuleSet.features. Every shorter prefix of a
+    cached decision is kept as an entry telling to read the next feature, so
+    looking a job up never measures more than matching it would.
+    """
+
+    def __init__(self, max_entries=1000):
+        """
+        @type max_entries: int
+        @param max_entries: how many entries to keep
+        """
+        LRUCache.__init__(self, max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, rule_set, user_email, measure, verbose=False):
+        """
+        Match a job with rule_set, or reuse the rule it matched for a job with the
+        same features.
+
+        @type rule_set: CompiledRuleSet
+        @param rule_set: the rules of the job's tool
+
+        @type user_email: str
+        @param user_email: the email of the user running the job
+
+        @type measure: callable
+        @param measure: see CompiledRuleSet.match
+
+        @type verbose: bool
+        @param verbose: log why rules were ignored when True
+
+        @rtype: CompiledRule
+        @return: the matched rule, or None if no rule matched
+        """
+        if self.max_entries < 1 or rule_set.error is not None:
+            return rule_set.match(user_email, measure, verbose)
+
+        user = None
+        if rule_set.restricted_rules:
+            user = user_email
+        key = (rule_set.tool, user)
+        values = []
+
+        try:
+            entry = self.get(key)
+            while entry is _more_features and len(values) < len(rule_set.features):
+                feature = rule_set.features[len(values)]
+                values.append(rule_set.feature_value(feature, measure))
+                entry = self.get(key + tuple(values))
+        except TypeError:
+            # parameter values that can't be hashed can't be cached either
+            return rule_set.match(user_email, measure, verbose)
+
+        if entry is not None and entry is not _more_features:
+            with self.lock:
+                self.hits += 1
+            if verbose:
+                rule_set.log_unauthorized(user_email)
+            return entry[0]
+
+        with self.lock:
+            self.misses += 1
+
+        matched_rule, tried = rule_set.match_stages(user_email, measure, verbose)
+
+        # read the features the stages that were tried depend on, and remember
+        # the decision for them
+        needed = rule_set.feature_counts[tried]
+        while len(values) < needed:
+            feature = rule_set.features[len(values)]
+            values.append(rule_set.feature_value(feature, measure))
+
+        try:
+            for count in range(needed):
+                self.put(key + tuple(values[:count]), _more_features)
+            self.put(key + tuple(values), (matched_rule,))
+        except TypeError:
+            pass
+
+        return matched_rule
+
+
+class LazyRuleSets(object):
+    """
+    The CompiledRuleSets of the tools of a config validated lazily, compiled
+    when they're first looked up.
+    """
+
+    def __init__(self, sections):
+        """
+        @type sections: LazyToolSections, dict
+        @param sections: the config's tools, validated or to be validated
+        """
+        self.sections = sections
+        self.rule_sets = {}
+
+    def get(self, tool, default=None):
+        """
+        @type tool: str
+        @param tool: the tool's id
+
+        @rtype: CompiledRuleSet
+        @return: the tool's rules, or default if the tool isn't in the config
+        """
+        rule_set = self.rule_sets.get(tool, _missing)
+        if rule_set is _missing:
+            rule_set = None
+            try:
+                section = self.sections.get(tool)
+                if section is not None:
+                    rule_set = CompiledRuleSet(tool, section)
+            except Exception as e:
+                # only the jobs of this tool can't be mapped, like when the
+                # tool's rules can't be compiled
+                rule_set = CompiledRuleSet(tool, {})
+                rule_set.error = _tool_error(tool, e)
+            rule_set = self.rule_sets.setdefault(tool, rule_set)
+
+        if rule_set is None:
+            return default
+        return rule_set
+
+
+class CompiledConfig(object):
+    """
+    A validated config compiled into a CompiledRuleSet per tool.
+    """
+
+    def __init__(self, config, verbose=False, previous=None):
+        """
+        @type config: dict
+        @param config: the validated config
+
+        @type verbose: bool
+        @param verbose: the config's verbose setting
+
+        @type previous: CompiledConfig
+        @param previous: see compile_config
+        """
+        self.config = config
+        self.verbose = verbose
+        self.default_destination = config.get('default_destination')
+
+        # how long loading the config took, set by get_compiled_config and
+        # counted towards the first job timed with it
+        self.load_times = None
+
+        # the digests and validated sections of the tools, and the tools that
+        # changed since the version of the config loaded before, or None if
+        # that isn't known; set by get_compiled_config
+        self.tool_sections = {}
+        self.changed_tools = None
+
+        self.settings = {}
+        for setting in available_settings:
+            self.settings[setting] = available_settings[setting][1]
+        self.settings.update(config.get('settings', {}))
+
+        self.record_cache = None
+        if self.settings['record_cache'] is not None:
+            self.record_cache = get_record_cache(
+                self.settings['record_cache'], self.settings['record_cache_size'])
+
+        # forgotten along with the config when it's reloaded
+        self.decisions = DecisionCache(self.settings['decision_cache_size'])
+
+        self.dataset_cache = get_dataset_cache(
+            self.settings['dataset_cache_size'], self.settings['dataset_cache_ttl'])
+
+        self.priorities = {}
+        for user, user_config in config.get('users', {}).items():
+            self.priorities[user] = user_config['priority']
+
+        # the tools of a snapshot were validated when it was written, but they
+        # can still be compiled lazily
+        tools = config.get('tools', {})
+        if isinstance(tools, LazyToolSections) or self.settings['lazy_validation']:
+            self.tools = LazyRuleSets(tools)
+        else:
+            self.tools = {}
+            for tool, tool_config in tools.items():
+                rule_set = None
+                if previous is not None and isinstance(previous.tools, dict):
+                    rule_set = previous.tools.get(tool)
+                if rule_set is None or previous.config['tools'][tool] is not tool_config:
+                    rule_set = CompiledRuleSet(tool, tool_config)
+                self.tools[tool] = rule_set
+
+    def map(self, tool, user_email, measure):
+        """
+        Decide where a job should run.
+
+        @type tool: str
+        @param tool: the id of the job's tool
+
+        @type user_email: str
+        @param user_email: the email of the user running the job
+
+        @type measure: callable
+        @param measure: see CompiledRuleSet.match
+
+        @rtype: str, str (tuple)
+        @return: the destination, and why the job failed if the destination is 'fail'
+        """
+        if self.default_destination is None:
+            fail_message = "Job '" + str(tool) + "' failed; "
+            fail_message += "no global default destination specified in config!"
+            return "fail", fail_message
+
+        # set default priority to med
+        priority = self.priorities.get(user_email, 'med')
+
+        matched_rule = None
+
+        rule_set = self.tools.get(tool)
+        if rule_set is not None:
+            matched_rule = self.decisions.match(
+                rule_set, user_email, measure, self.verbose)
+        else:
+            error = "Tool '" + str(tool) + "' not specified in config. "
+            error += "Using default destination."
+            if self.verbose:
+                log.debug(error)
+
+        destination = self.destination(tool, priority, matched_rule)
+        if destination != "fail":
+            return destination, None
+
+        if matched_rule is not None and matched_rule.fail_message:
+            return destination, matched_rule.fail_message
+
+        return destination, "Job '" + str(tool) + "' failed; destination is 'fail'."
+
+    def map_many(self, tool, file_sizes=None, records=None, num_input_datasets=None,
+                 priorities=None, user_email=None):
+        """
+        Decide where many jobs of the same tool and user should run, from their
+        measurements alone. The jobs go where map would send them, but the rules
+        are evaluated for all of them at once, with NumPy if it's installed.
+
+        @type tool: str
+        @param tool: the id of the jobs' tool
+
+        @type file_sizes: sequence
+        @param file_sizes: the file_size of each job, or None for 0
+
+        @type records: sequence
+        @param records: the records of each job, or None for 0
+
+        @type num_input_datasets: sequence
+        @param num_input_datasets: the num_input_datasets of each job, or None
+                                   for 0
+
+        @type priorities: sequence
+        @param priorities: the priority of each job, or None for the priority of
+                           user_email
+
+        @type user_email: str
+        @param user_email: the email of the user running the jobs
+
+        @rtype: list, sequence (tuple)
+        @return: the destinations, and the position of each job's destination
+                 among them, as an array when NumPy is installed
+        """
+        features = {'file_size': file_sizes, 'records': records,
+                    'num_input_datasets': num_input_datasets, 'priority': priorities}
+        count = max([0] + [len(values) for values in features.values()
+                           if values is not None])
+        for name, values in features.items():
+            if values is None:
+                if name == 'priority':
+                    values = [self.priorities.get(user_email, 'med')] * count
+                elif numpy is not None:
+                    values = numpy.zeros(count, dtype=numpy.intp)
+                else:
+                    values = [0] * count
+            elif len(values) != count:
+                raise ValueError("Expected " + str(count) + " values of " + name +
+                                 ", got " + str(len(values)))
+            features[name] = values
+
+        rule_set = self.tools.get(tool)
+        if rule_set is not None and rule_set.error is not None:
+            raise rule_set.error
+
+        if numpy is None or (rule_set is not None and any(
+                rule.rule_type != 'arguments' for rule in rule_set.unindexed_rules)):
+            return self._map_each(tool, features, user_email)
+
+        # the winning rule of each job, by its position in the tool's rules
+        # sorted from winner to loser, len(rules) standing for no rule
+        rules = []
+        if rule_set is not None:
+            rules = sorted(rule_set.rules, key=lambda rule: rule.key)
+        ranks = dict((rule, rank) for rank, rule in enumerate(rules))
+        winners = numpy.full(count, len(rules), dtype=numpy.intp)
+
+        if rule_set is not None:
+            # jobs don't have parameters, so arguments rules match all of them or none
+            for rule in rule_set.unindexed_rules:
+                if rule.authorized(user_email) and rule.match(
+                        rule, {'params': {}}.get, False):
+                    numpy.minimum(winners, ranks[rule], out=winners)
+
+            for rule_type, index in rule_set.indexes:
+                candidates = numpy.array(
+                    [min([ranks[rule] for rule in candidates
+                          if rule.authorized(user_email)] + [len(rules)])
+                     for candidates in index.candidates], dtype=numpy.intp)
+                positions = numpy.searchsorted(
+                    numpy.array(index.boundaries), numpy.asarray(features[rule_type]),
+                    side='right')
+                numpy.minimum(winners, candidates[positions], out=winners)
+
+        # look destinations up by priority and winner
+        destinations = []
+        positions = {}
+        if priorities is None:
+            priority_names = [self.priorities.get(user_email, 'med')]
+            priority_indices = numpy.zeros(count, dtype=numpy.intp)
+        else:
+            priority_names, priority_indices = numpy.unique(
+                numpy.asarray(priorities, dtype=object), return_inverse=True)
+        table = numpy.empty((len(priority_names), len(rules) + 1), dtype=numpy.intp)
+        errors = {}
+        for row, priority in enumerate(priority_names):
+            for rank in range(len(rules) + 1):
+                try:
+                    if rank < len(rules):
+                        destination = self.destination(tool, priority, rules[rank])
+                    else:
+                        destination = self.destination(tool, priority, None)
+                except MalformedYMLException as e:
+                    # only an error if some job actually matched the rule
+                    errors[rank] = e
+                    table[row, rank] = -1
+                    continue
+                if destination not in positions:
+                    positions[destination] = len(destinations)
+                    destinations.append(destination)
+                table[row, rank] = positions[destination]
+
+        indices = table[priority_indices, winners]
+        if errors and (indices < 0).any():
+            raise errors[int(winners[numpy.argmax(indices < 0)])]
+        return destinations, indices
+
+    def _map_each(self, tool, features, user_email):
+        """
+        Do what map_many does one job at a time.
+        """
+        destinations = []
+        positions = {}
+        indices = []
+        rule_set = self.tools.get(tool)
+        for job in range(len(features['priority'])):
+            matched_rule = None
+            if rule_set is not None:
+                def measure(name):
+                    if name == 'params':
+                        return {}
+                    return features[name][job]
+                matched_rule = rule_set.match(user_email, measure)
+
+            destination = self.destination(tool, features['priority'][job], matched_rule)
+            if destination not in positions:
+                positions[destination] = len(destinations)
+                destinations.append(destination)
+            indices.append(positions[destination])
+
+        if numpy is not None:
+            indices = numpy.array(indices, dtype=numpy.intp)
+        return destinations, indices
+
+    def destination(self, tool, priority, matched_rule):
+        """
+        @type tool: str
+        @param tool: the id of the job's tool
+
+        @type priority: str
+        @param priority: the priority of the job's user
+
+        @type matched_rule: CompiledRule
+        @param matched_rule: the rule the job matched, or None
+
+        @rtype: str
+        @return: the job's destination
+
+        @raise MalformedYMLException: if the job matched a rule without a destination
+        """
+        if self.default_destination is None:
+            return "fail"
+
+        rule_set = self.tools.get(tool)
+        if matched_rule is not None:
+            if matched_rule.destination is None:
+                error = "No destination specified for rule " + str(matched_rule.number)
+                error += " in '" + str(tool) + "'."
+                raise MalformedYMLException(error)
+            return resolve_destination(matched_rule.destination, priority)
+        elif rule_set is not None and rule_set.default_destination is not None:
+            return resolve_destination(rule_set.default_destination, priority)
+        return resolve_destination(self.default_destination, priority)
+
+
+def compile_config(config, verbose=False, previous=None):
+    """
+    Compile a validated config so that jobs can be mapped with it.
+
+    @type config: dict
+    @param config: the validated config, as returned by validate_config
+
+    @type verbose: bool
+    @param verbose: the config's verbose setting
+
+    @type previous: CompiledConfig
+    @param previous: an earlier version of the config, whose compiled rules
+                     are reused for the tools whose validated sections it shares
+
+    @rtype: CompiledConfig
+    @return: the compiled config
+    """
+    return CompiledConfig(config, verbose, previous)
+
+
+# upper bounds, in seconds, of the buckets phase durations are counted in; the
+# last bucket counts everything longer
+TIMING_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of mapping one job. Phases can be nested, and the time
+    spent in a nested phase only counts towards it, so that, for instance, the
+    measurements taken while rules are evaluated aren't counted as evaluating
+    rules.
+    """
+
+    def __init__(self):
+        # seconds spent in each phase, and the phases being timed as
+        # [phase, start, seconds spent in nested phases]
+        self.durations = {}
+        self.running = []
+
+    def add(self, phase, seconds):
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+
+    def start(self, phase):
+        self.running.append([phase, _clock(), 0.0])
+
+    def stop(self):
+        phase, started, nested = self.running.pop()
+        elapsed = _clock() - started
+        self.add(phase, elapsed - nested)
+        if self.running:
+            self.running[-1][2] += elapsed
+
+
+class TimingStats(object):
+    """
+    How long each phase of mapping took, added up per tool id across the jobs
+    of the process.
+    """
+
+    def __init__(self):
+        # [count, sum, max, bucket counts] by tool id and phase
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, tool, durations):
+        """
+        @type tool: str
+        @param tool: the id of the job's tool
+
+        @type durations: dict
+        @param durations: seconds spent in each phase
+        """
+        with self.lock:
+            tool_stats = self.stats.setdefault(tool, {})
+            for phase, seconds in durations.items():
+                phase_stats = tool_stats.get(phase)
+                if phase_stats is None:
+                    phase_stats = [0, 0.0, 0.0, [0] * (len(TIMING_BUCKETS) + 1)]
+                    tool_stats[phase] = phase_stats
+                phase_stats[0] += 1
+                phase_stats[1] += seconds
+                phase_stats[2] = max(phase_stats[2], seconds)
+                phase_stats[3][bisect.bisect_left(TIMING_BUCKETS, seconds)] += 1
+
+    def get(self):
+        """
+        @rtype: dict
+        @return: by tool id and phase, the 'count' of jobs, the 'sum' and 'max'
+                 of their durations, and 'buckets', a list of (upper bound, count)
+        """
+        timings = {}
+        with self.lock:
+            for tool, tool_stats in self.stats.items():
+                timings[tool] = {}
+                for phase, (count, total, longest, buckets) in tool_stats.items():
+                    timings[tool][phase] = {
+                        'count': count,
+                        'sum': total,
+                        'max': longest,
+                        'buckets': list(zip(TIMING_BUCKETS + (INFINITY,), buckets)),
+                    }
+        return timings
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+
+# the timings of all the jobs mapped with timing turned on
+_timing_stats = TimingStats()
+
+
+def get_timings():
+    """
+    Get how long mapping jobs took, phase by phase, for the configs with the
+    timing setting turned on. The phases are:
+    'config' (checking whether the config changed),
+    'parse', 'validate' and 'compile' (when it did; 'snapshot' replaces
+    'parse' and 'validate' when a snapshot was loaded),
+    'params' (getting the job's parameters),
+    'vfdb' (finding and counting the virulence factors database),
+    'stat' (finding which inputs are files and their sizes),
+    'records' (counting records), 'rules' (evaluating rules) and 'total'.
+
+    @rtype: dict
+    @return: see TimingStats.get
+    """
+    return _timing_stats.get()
+
+
+def reset_timings():
+    """
+    Forget the timings recorded so far.
+    """
+    _timing_stats.reset()
+
+
+def _format_timings(tool, destination, durations):
+    """
+    Write the timings of a job as a single line of key=value pairs, in
+    milliseconds.
+    """
+    line = "Timings: tool=" + str(tool) + " destination=" + str(destination)
+    for phase in sorted(durations):
+        line += " " + phase + "=%.3f" % (durations[phase] * 1000)
+    return line
+
+
+def _label_value(value):
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def write_atomically(path, text, binary=False):
+    """
+    Write text to path through a temporary file renamed over it, so that readers
+    never see a partly written file.
+    """
+    temporary = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(temporary, 'wb' if binary else 'w') as stream:
+            stream.write(text)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+class Metrics(object):
+    """
+    Counts the jobs sent to each destination, the jobs failed by a 'fail'
+    destination, and config reloads, and keeps a histogram of how long mapping
+    jobs takes, for writing in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.jobs = {}
+            self.failures = {}
+            self.reloads = 0
+            self.rejections = 0
+            self.latency_buckets = [0] * (len(TIMING_BUCKETS) + 1)
+            self.latency_sum = 0.0
+            self.latency_count = 0
+            self.last_write = None
+
+    def reloaded(self):
+        with self.lock:
+            self.reloads += 1
+
+    def rejected(self):
+        with self.lock:
+            self.rejections += 1
+
+    def mapped(self, tool, destination, seconds):
+        """
+        Count a job of tool sent to destination in seconds.
+        """
+        with self.lock:
+            if destination == "fail":
+                self.failures[tool] = self.failures.get(tool, 0) + 1
+            else:
+                self.jobs[destination] = self.jobs.get(destination, 0) + 1
+            self.latency_buckets[bisect.bisect_left(TIMING_BUCKETS, seconds)] += 1
+            self.latency_sum += seconds
+            self.latency_count += 1
+
+    def render(self, labels=None):
+        """
+        @type labels: dict
+        @param labels: labels to add to every sample, if any
+
+        @rtype: str
+        @return: the metrics in the Prometheus text format
+        """
+        common = ""
+        if labels:
+            common = ",".join(name + '="' + _label_value(labels[name]) + '"'
+                              for name in sorted(labels))
+
+        def sample(name, value, extra=None):
+            pairs = [pair for pair in (extra, common) if pair]
+            if pairs:
+                name += "{" + ",".join(pairs) + "}"
+            return name + " " + repr(value) + "\n"
+
+        with self.lock:
+            prefix = "dynamic_tool_destination_"
+            text = "# HELP " + prefix + "jobs_total Jobs mapped, by destination.\n"
+            text += "# TYPE " + prefix + "jobs_total counter\n"
+            for destination in sorted(self.jobs):
+                text += sample(prefix + "jobs_total", self.jobs[destination],
+                               'destination="' + _label_value(destination) + '"')
+
+            text += "# HELP " + prefix + "jobs_failed_total Jobs failed by a 'fail' "
+            text += "destination, by tool.\n"
+            text += "# TYPE " + prefix + "jobs_failed_total counter\n"
+            for tool in sorted(self.failures):
+                text += sample(prefix + "jobs_failed_total", self.failures[tool],
+                               'tool="' + _label_value(tool) + '"')
+
+            text += "# HELP " + prefix + "config_reloads_total Times a config was "
+            text += "loaded.\n"
+            text += "# TYPE " + prefix + "config_reloads_total counter\n"
+            text += sample(prefix + "config_reloads_total", self.reloads)
+
+            text += "# HELP " + prefix + "config_rejections_total Times changes to a "
+            text += "config were rejected.\n"
+            text += "# TYPE " + prefix + "config_rejections_total counter\n"
+            text += sample(prefix + "config_rejections_total", self.rejections)
+
+            text += "# HELP " + prefix + "mapping_seconds Time taken to map a job.\n"
+            text += "# TYPE " + prefix + "mapping_seconds histogram\n"
+            cumulative = 0
+            for bound, count in zip(TIMING_BUCKETS + (INFINITY,), self.latency_buckets):
+                cumulative += count
+                if bound == INFINITY:
+                    le = "+Inf"
+                else:
+                    le = repr(bound)
+                text += sample(prefix + "mapping_seconds_bucket", cumulative,
+                               'le="' + le + '"')
+            text += sample(prefix + "mapping_seconds_sum", self.latency_sum)
+            text += sample(prefix + "mapping_seconds_count", self.latency_count)
+
+        return text
+
+    def write(self, path, interval=0):
+        """
+        Write the metrics to path, unless they were written less than interval
+        seconds ago or another thread is writing them. A '{pid}' in path is
+        replaced by the id of the process, which is then added as a label so
+        that the files of several handlers can be collected together.
+
+        @type path: str
+        @param path: the file to write
+
+        @type interval: int
+        @param interval: how many seconds to wait between writes
+        """
+        now = time.time()
+        if self.last_write is not None and now - self.last_write < interval:
+            return
+        if not self.write_lock.acquire(False):
+            return
+
+        try:
+            self.last_write = now
+            labels = None
+            if '{pid}' in path:
+                labels = {'pid': os.getpid()}
+                path = path.replace('{pid}', str(os.getpid()))
+            write_atomically(path, self.render(labels))
+        except (IOError, OSError) as e:
+            log.warning("Couldn't write metrics to " + path + ": " + str(e))
+        finally:
+            self.write_lock.release()
+
+
+# the metrics of all the jobs mapped by this process
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    Get the metrics of the jobs mapped by this process.
+
+    @rtype: Metrics
+    @return: the metrics
+    """
+    return _metrics
+
+
+def importer(test):
+    """
+    Uses Mock galaxy for testing or real galaxy for production
+
+    @type test: bool
+    @param test: True when being run from a test
+    """
+    global JobDestination
+    global JobMappingException
+    if test:
+        from tests.mockGalaxy import JobDestination
+        from tests.mockGalaxy import JobMappingException
+    else:
+        from galaxy.jobs import JobDestination
+        from galaxy.jobs.mapper import JobMappingException
+
+
+# size of the blocks read at once when counting the records of a file
+RECORDS_CHUNK_SIZE = 1024 * 1024
+
+# size of the windows of a file mapped at once when counting records through mmap;
+# mapped pages count towards the handler's memory until they are unmapped, so the
+# file is never mapped whole. Must be a multiple of mmap.ALLOCATIONGRANULARITY
+MMAP_WINDOW_SIZE = 16 * RECORDS_CHUNK_SIZE
+
+# how many '>' of a block are checked one at a time before leaving the rest of the
+# block to bytes.count
+SPARSE_RECORDS = 32
+
+
+def _count_chunk_records(chunk, line_start):
+    """
+    Count the '>' at the start of a line in chunk.
+
+    Finding single bytes is much faster than counting a two byte pattern, so the
+    '>' are first found one by one, which is all that's needed for files with
+    long sequences. Blocks with many records are left to bytes.count.
+
+    @type chunk: bytes
+    @param chunk: a block of the file
+
+    @type line_start: bool
+    @param line_start: whether the block starts at the start of a line
+
+    @rtype: int
+    @return: the number of records starting in chunk
+    """
+    records = 0
+    position = chunk.find(b">")
+    if position == 0:
+        if line_start:
+            records += 1
+        position = chunk.find(b">", 1)
+
+    checked = 0
+    while position != -1:
+        if checked == SPARSE_RECORDS:
+            return records + chunk.count(b"\n>", position - 1)
+        if chunk[position - 1:position] == b"\n":
+            records += 1
+        checked += 1
+        position = chunk.find(b">", position + 1)
+
+    return records
+
+
+def _mapped_chunks(stream, chunk_size):
+    """
+    Read a file in blocks of chunk_size bytes through memory maps of at most
+    MMAP_WINDOW_SIZE bytes, one window at a time.
+
+    @type stream: file
+    @param stream: the file opened in binary mode
+
+    @type chunk_size: int
+    @param chunk_size: the size of the blocks
+
+    @rtype: generator
+    @return: the blocks of the file
+    """
+    size = os.fstat(stream.fileno()).st_size
+    offset = 0
+    while offset < size:
+        length = min(MMAP_WINDOW_SIZE, size - offset)
+        window = mmap.mmap(
+            stream.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+        try:
+            for start in range(0, length, chunk_size):
+                yield window[start:start + chunk_size]
+        finally:
+            window.close()
+        offset += length
+
+
+def count_records(file_name, use_mmap=False, chunk_size=RECORDS_CHUNK_SIZE):
+    """
+    Count the records of a FASTA file, which are the lines starting with '>'. The
+    file is read in binary blocks of chunk_size bytes which are searched with
+    bytes methods, instead of going through it line by line in Python. Only one
+    block is held at a time, so memory use doesn't depend on how long the lines
+    of the file are.
+
+    @type file_name: str
+    @param file_name: the path of the FASTA file
+
+    @type use_mmap: bool
+    @param use_mmap: count through a memory map of the file instead of reading it
+
+    @type chunk_size: int
+    @param chunk_size: how many bytes to count at once
+
+    @rtype: int
+    @return: the number of records in the file
+    """
+    records = 0
+    # the start of the file is the start of a line
+    line_start = True
+
+    with open(file_name, 'rb') as stream:
+        if use_mmap:
+            chunks = _mapped_chunks(stream, chunk_size)
+        else:
+            chunks = iter(lambda: stream.read(chunk_size), b"")
+
+        for chunk in chunks:
+            records += _count_chunk_records(chunk, line_start)
+            line_start = chunk[-1:] == b"\n"
+
+    return records
+
+
+class RecordCache(object):
+    """
+    Record counts of FASTA files kept in an SQLite database, so that each version
+    of a file is only counted once by all of the handler processes sharing the
+    database. A file is recognized by its real path, inode, size and mtime. The
+    least recently used files are forgotten once there are more than max_entries.
+    """
+
+    # how long a file has to go unused before using it is worth writing down
+    touch_interval = 3600
+
+    def __init__(self, path, max_entries=10000):
+        """
+        @type path: str
+        @param path: the path of the SQLite database
+
+        @type max_entries: int
+        @param max_entries: how many files to remember
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        SQLite connections can't be shared between threads, nor between processes
+        after a fork, so each thread of each process gets its own.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            # wait for other handlers writing to the database instead of failing
+            connection = sqlite3.connect(self.path, timeout=30)
+            # let handlers read while another one is writing
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS records (path TEXT PRIMARY KEY, "
+                "inode INTEGER, size INTEGER, mtime REAL, records INTEGER, "
+                "used REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_used ON records (used)")
+            connection.commit()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def count(self, file_name):
+        """
+        Get the number of records of a file, counting them only if no handler has
+        counted this version of the file yet.
+
+        @type file_name: str
+        @param file_name: the path of the FASTA file
+
+        @rtype: int
+        @return: the number of records in the file
+        """
+        path = os.path.realpath(file_name)
+        stat = os.stat(path)
+        now = time.time()
+
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                "SELECT inode, size, mtime, records, used FROM records WHERE path = ?",
+                (path,)).fetchone()
+        except sqlite3.Error as e:
+            log.warning("Couldn't read record cache " + self.path + ": " + str(e))
+            return count_records(path)
+
+        if row is not None and tuple(row[:3]) == (
+                stat.st_ino, stat.st_size, stat.st_mtime):
+            if now - row[4] > self.touch_interval:
+                try:
+                    with connection:
+                        connection.execute(
+                            "UPDATE records SET used = ? WHERE path = ?", (now, path))
+                except sqlite3.Error:
+                    pass
+            return row[3]
+
+        records = count_records(path)
+
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, stat.st_ino, stat.st_size, stat.st_mtime, records, now))
+                connection.execute(
+                    "DELETE FROM records WHERE path IN (SELECT path FROM records "
+                    "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        except sqlite3.Error as e:
+            log.warning("Couldn't update record cache " + self.path + ": " + str(e))
+
+        return records
+
+
+# RecordCaches by path, shared by all the configs that use the same database
+_record_caches = {}
+_record_caches_lock = threading.Lock()
+
+
+def get_record_cache(path, max_entries=10000):
+    """
+    Get the RecordCache using the database at path.
+
+    @type path: str
+    @param path: the path of the SQLite database
+
+    @type max_entries: int
+    @param max_entries: how many files to remember
+
+    @rtype: RecordCache
+    @return: the record cache
+    """
+    with _record_caches_lock:
+        record_cache = _record_caches.get(path)
+        if record_cache is None:
+            record_cache = RecordCache(path, max_entries)
+            _record_caches[path] = record_cache
+        record_cache.max_entries = max_entries
+
+    return record_cache
+
+
+# Virulence factor databases by (install_dir, organism), as
+# [vfdb directory mtime, path, records or None]
+_vfdb_cache = {}
+_vfdb_cache_lock = threading.Lock()
+
+
+def get_vfdb(install_dir, organism, count=None):
+    """
+    Find the virulence factors database of organism installed in install_dir,
+    and count its records when count is given.
+
+    Both are remembered until the vfdb directory's mtime changes, that is
+    until the tool dependency is reinstalled.
+
+    @type install_dir: str
+    @param install_dir: the installation directory of the vfdb dependency
+
+    @type organism: str
+    @param organism: the vfdb_in parameter of the job
+
+    @type count: callable
+    @param count: counts the records of a FASTA file, like count_records
+
+    @rtype: tuple
+    @return: the path of the database, or None if there isn't one, and its
+             number of records, or None if count isn't given
+    """
+    key = (install_dir, organism)
+    directory = install_dir + "/vfdb"
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return None, None
+
+    with _vfdb_cache_lock:
+        entry = _vfdb_cache.get(key)
+
+    if entry is None or entry[0] != mtime:
+        found = glob.glob(directory + "/?" + organism[1:] + "*")
+        if found:
+            entry = [mtime, str(found[0]), None]
+        else:
+            entry = [mtime, None, 0]
+        with _vfdb_cache_lock:
+            _vfdb_cache[key] = entry
+
+    if count is not None and entry[2] is None:
+        entry[2] = count(entry[1])
+
+    if count is None:
+        return entry[1], None
+    return entry[1], entry[2]
+
+
+# jobs with fewer inputs than this are always measured serially
+PARALLEL_MEASUREMENT_MIN_INPUTS = 8
+
+# ThreadPools by size, as (pid, pool), shared by all the configs measuring jobs
+# with the same number of threads
+_measurement_pools = {}
+_measurement_pools_lock = threading.Lock()
+
+
+def get_measurement_pool(threads):
+    """
+    Get the pool of threads measuring job inputs.
+
+    @type threads: int
+    @param threads: the number of threads in the pool
+
+    @rtype: ThreadPool
+    @return: the pool
+    """
+    pid = os.getpid()
+    with _measurement_pools_lock:
+        entry = _measurement_pools.get(threads)
+        # pools don't survive a fork, so a forked handler gets its own
+        if entry is None or entry[0] != pid:
+            entry = (pid, ThreadPool(threads))
+            _measurement_pools[threads] = entry
+    return entry[1]
+
+
+def _stat_input(dataset, filesize_rule_present):
+    """
+    Check whether an input of a job is a file, and get its size if it isn't a
+    FASTA file. This is run in the measurement pool, so anything to log is left
+    to the caller.
+
+    @param dataset: the input's dataset
+
+    @type filesize_rule_present: bool
+    @param filesize_rule_present: get the input's size if it isn't a FASTA file
+
+    @rtype: tuple
+    @return: whether the input is a file, whether it is a FASTA file, its size,
+             and whether it turned out not to be a file
+    """
+    is_file = False
+    try:
+        # If the input is a file, check and add the size
+        if dataset is not None and os.path.isfile(dataset.file_name):
+            is_file = True
+
+            if dataset.ext == "fasta":
+                return is_file, True, 0, False
+            elif filesize_rule_present:
+                return is_file, False, os.path.getsize(str(dataset.file_name)), False
+    except AttributeError:
+        return is_file, False, 0, True
+
+    return is_file, False, 0, False
+
+
+def _count_input_records(dataset, count):
+    """
+    Get the number of records of a FASTA input of a job. This is run in the
+    measurement pool, so anything to log is left to the caller.
+
+    @param dataset: the input's dataset
+
+    @type count: callable
+    @param count: counts the records of a FASTA file, like count_records
+
+    @rtype: int
+    @return: the number of records, or None if the input isn't a file after all
+    """
+    try:
+        # Try to find automatically computed sequences
+        metadata = dataset.get_metadata()
+
+        try:
+            return int(metadata.get("sequences"))
+        except (TypeError, KeyError):
+            return count(dataset.file_name)
+    except AttributeError:
+        return None
+
+
+def dataset_key(dataset):
+    """
+    Get what identifies the file behind an input of a job: the id of its Galaxy
+    dataset, which all the HDAs and LDDAs copied from it share, or else its path.
+
+    @param dataset: the input's dataset
+
+    @rtype: tuple
+    @return: the key, or None if the input has neither
+    """
+    dataset_id = getattr(dataset, 'dataset_id', None)
+    if dataset_id is None:
+        dataset_id = getattr(getattr(dataset, 'dataset', None), 'id', None)
+    if dataset_id is not None:
+        return ('id', dataset_id)
+
+    file_name = getattr(dataset, 'file_name', None)
+    if file_name is not None:
+        return ('path', str(file_name))
+
+    return None
+
+
+# measurements of the datasets used by recent jobs, by dataset_key, as dicts
+# with the result of _stat_input under 'stat', whether it has the size under
+# 'sized', and the number of records under 'records'
+_dataset_cache = LRUCache()
+
+
+def get_dataset_cache(max_entries=1000, ttl=300):
+    """
+    Get the cache of the measurements of datasets, which all configs share.
+
+    @type max_entries: int
+    @param max_entries: how many datasets to remember
+
+    @type ttl: int
+    @param ttl: how many seconds to remember a dataset for
+
+    @rtype: LRUCache
+    @return: the cache, or None if max_entries is less than 1
+    """
+    if max_entries < 1:
+        return None
+
+    _dataset_cache.max_entries = max_entries
+    _dataset_cache.ttl = ttl
+    return _dataset_cache
+
+
+class JobMeasurements(object):
+    """
+    Measures the inputs of a job the first time a rule needs them. Checking
+    which inputs are files and adding up their sizes is done together, since it
+    only needs a stat of each input; counting the records of the FASTA inputs
+    reads them, and is only done if a records rule could still win.
+
+    Instances are called with the name of a measurement ('file_size',
+    'records', 'num_input_datasets' or 'params') and return its value, as
+    expected by CompiledRuleSet.match.
+    """
+
+    def __init__(self, job, app, tool, rule_types, verbose=False,
+                 count=count_records, threads=1, dataset_cache=None, timer=None):
+        """
+        @param job: galaxy job
+        @param app: current app
+        @param tool: current tool
+
+        @type rule_types: set
+        @param rule_types: the rule_types of the tool's rules
+
+        @type verbose: bool
+        @param verbose: log what's being measured when True
+
+        @type count: callable
+        @param count: counts the records of a FASTA file, like count_records
+
+        @type threads: int
+        @param threads: how many inputs to measure at the same time when the job
+                        has at least PARALLEL_MEASUREMENT_MIN_INPUTS of them
+
+        @type dataset_cache: LRUCache
+        @param dataset_cache: measurements of datasets of earlier jobs, see
+                              get_dataset_cache
+
+        @type timer: PhaseTimer
+        @param timer: times the measurements, if given
+        """
+        self.job = job
+        self.app = app
+        self.tool = tool
+        self.rule_types = rule_types
+        self.verbose = verbose
+        self.count = count
+        self.threads = threads
+        self.dataset_cache = dataset_cache
+        self.timer = timer
+        self.values = {}
+        self.param_values = None
+        self.param_error = None
+        self.vfdb = None
+        self.fasta_inputs = None
+
+    def __call__(self, name):
+        if name not in self.values:
+            if name == 'params':
+                self.values[name] = self.timed('params', self.params)
+            elif name == 'records':
+                self.timed('records', self.count_records)
+            else:
+                self.timed('stat', self.stat_inputs)
+
+        return self.values[name]
+
+    def timed(self, phase, function, *args):
+        """
+        Call function with args, timing it as phase if there's a timer.
+        """
+        if self.timer is None:
+            return function(*args)
+
+        self.timer.start(phase)
+        try:
+            return function(*args)
+        finally:
+            self.timer.stop()
+
+    def params(self, ignore_errors=False):
+        """
+        Get the job's parameter values. Galaxy builds them from the whole tool
+        state, so they are only fetched once per job, the way the first caller
+        asks for them, and that result or error is reused by the other callers:
+        the values only differ when the tool state has errors.
+
+        @type ignore_errors: bool
+        @param ignore_errors: whether to still get values when the tool state
+                              has errors, like job.get_param_values. If they were
+                              fetched without ignoring the errors, the values are
+                              then empty.
+
+        @rtype: dict
+        @return: the job's parameter values
+        """
+        if self.param_values is None and self.param_error is None:
+            try:
+                self.param_values = self.job.get_param_values(self.app, ignore_errors)
+            except Exception as e:
+                self.param_error = e
+
+        if self.param_error is not None:
+            if not ignore_errors:
+                raise self.param_error
+            return {}
+        return self.param_values
+
+    def map(self, function, items):
+        """
+        Apply function to each of items, on the measurement pool if there are
+        enough of them.
+        """
+        if self.threads > 1 and len(items) >= PARALLEL_MEASUREMENT_MIN_INPUTS:
+            return get_measurement_pool(self.threads).map(function, items)
+        return [function(item) for item in items]
+
+    def map_datasets(self, function, datasets):
+        """
+        Apply function to each of datasets, but only once per underlying Galaxy
+        dataset when several inputs share one.
+
+        @type function: callable
+        @param function: takes the dataset_key of a dataset, or None, and the
+                         dataset
+
+        @type datasets: list
+        @param datasets: the datasets
+
+        @rtype: list
+        @return: what function returned for each of datasets
+        """
+        keys = []
+        first = {}
+        for position, dataset in enumerate(datasets):
+            key = dataset_key(dataset)
+            if key is None:
+                key = ('input', position)
+            keys.append(key)
+            first.setdefault(key, dataset)
+
+        unique = list(first)
+
+        def apply(key):
+            if key[0] == 'input':
+                return function(None, first[key])
+            return function(key, first[key])
+
+        results = dict(zip(unique, self.map(apply, unique)))
+        return [results[input_key] for input_key in keys]
+
+    def find_vfdb(self):
+        """
+        @rtype: tuple
+        @return: the install directory and the organism of the job's virulence
+                 factors database, or None if it doesn't use one
+        """
+        vfdb = None
+        try:
+            # If you're going to the vfdb do this.
+            for this_tool in self.tool.installed_tool_dependencies:
+                if this_tool.name == "vfdb":
+                    bact = self.params(True)["mlst_or_genedb"]["vfdb_in"]
+                    install_dir = str(this_tool.installation_directory(self.app))
+                    vfdb_file = get_vfdb(install_dir, bact)[0]
+                    if vfdb_file is None:
+                        raise IndexError(bact)
+                    vfdb = (install_dir, bact)
+                    if self.verbose:
+                        log.debug("Loading file: " + vfdb_file)
+        except (KeyError, IndexError, TypeError):
+            if self.verbose:
+                log.info("No virulence factors database")
+
+        return vfdb
+
+    def stat_inputs(self):
+        """
+        Find which inputs are files, and add up the sizes of the ones that
+        aren't FASTA files if the tool has file_size rules.
+        """
+        if self.fasta_inputs is not None:
+            return
+
+        if 'records' in self.rule_types:
+            self.vfdb = self.timed('vfdb', self.find_vfdb)
+        else:
+            self.vfdb = None
+
+        # Get all inputs from tool and databases
+        inp_data = dict([(da.name, da.dataset) for da in self.job.input_datasets])
+        inp_data.update([(da.name, da.dataset) for da in self.job.input_library_datasets])
+        names = list(inp_data)
+
+        filesize_rule_present = 'file_size' in self.rule_types
+        dataset_cache = self.dataset_cache
+
+        def stat(key, dataset):
+            entry = None
+            if key is not None and dataset_cache is not None:
+                entry = dataset_cache.get(key)
+                if (entry is not None and entry['stat'] is not None and
+                        (entry['sized'] or not filesize_rule_present)):
+                    return entry['stat']
+
+            result = _stat_input(dataset, filesize_rule_present)
+            # an input that isn't a file may only not be there yet, or not be
+            # visible yet on a shared filesystem, so it's looked at again next time
+            if key is not None and dataset_cache is not None and result[0]:
+                records = None
+                if entry is not None:
+                    records = entry['records']
+                dataset_cache.put(key, {'stat': result, 'sized': filesize_rule_present,
+                                        'records': records})
+            return result
+
+        file_size = 0
+        num_input_datasets = 0
+        self.fasta_inputs = []
+        for da, (is_file, is_fasta, input_size, not_a_file) in zip(
+                names, self.map_datasets(stat, [inp_data[name] for name in names])):
+            if is_file:
+                num_input_datasets += 1
+                if self.verbose:
+                    message = "Loading file: " + str(da)
+                    message += str(inp_data[da].file_name)
+                    log.debug(message)
+            if is_fasta:
+                self.fasta_inputs.append(inp_data[da])
+            file_size += input_size
+            if not_a_file:
+                # Otherwise, say that input isn't a file
+                if self.verbose:
+                    log.debug("Not a file: " + str(inp_data[da]))
+
+        self.values['file_size'] = file_size
+        self.values['num_input_datasets'] = num_input_datasets
+
+    def count_records(self):
+        """
+        Add up the records of the FASTA inputs and of the virulence factors
+        database.
+        """
+        if self.fasta_inputs is None:
+            self.timed('stat', self.stat_inputs)
+
+        records = 0
+        # Look through the database for amount of records
+        if self.vfdb is not None:
+            records += self.timed(
+                'vfdb', get_vfdb, self.vfdb[0], self.vfdb[1], self.count)[1]
+
+        dataset_cache = self.dataset_cache
+
+        def count(key, dataset):
+            entry = None
+            if key is not None and dataset_cache is not None:
+                entry = dataset_cache.get(key)
+                if entry is not None and entry['records'] is not None:
+                    return entry['records']
+
+            records = _count_input_records(dataset, self.count)
+            if key is not None and dataset_cache is not None and records is not None:
+                if entry is None:
+                    entry = {'stat': None, 'sized': False, 'records': records}
+                else:
+                    entry = dict(entry, records=records)
+                dataset_cache.put(key, entry)
+            return records
+
+        for dataset, input_records in zip(
+                self.fasta_inputs, self.map_datasets(count, self.fasta_inputs)):
+            if input_records is not None:
+                records += input_records
+            elif self.verbose:
+                log.debug("Not a file: " + str(dataset))
+
+        self.values['records'] = records
+
+    def log_totals(self):
+        """
+        Log the measurements that were taken, when verbose.
+        """
+        if not self.verbose:
+            return
+
+        if 'file_size' in self.rule_types and 'file_size' in self.values:
+            log.debug("Total size: " + bytes_to_str(self.values['file_size']))
+        if 'records' in self.rule_types and 'records' in self.values:
+            log.debug("Total amount of records: " + str(self.values['records']))
+        if ('num_input_datasets' in self.rule_types and
+                'num_input_datasets' in self.values):
+            log.debug("Total number of files: " + str(self.values['num_input_datasets']))
+
+
+def measure_job(job, app, tool, rule_types, verbose=False, count=count_records,
+                threads=1):
+    """
+    Measure the inputs of a job that are needed to match rules of rule_types.
+
+    @param job: galaxy job
+    @param app: current app
+    @param tool: current tool
+
+    @type rule_types: set
+    @param rule_types: the rule_types of the tool's rules
+
+    @type verbose: bool
+    @param verbose: log what's being measured when True
+
+    @type count: callable
+    @param count: counts the records of a FASTA file, like count_records
+
+    @type threads: int
+    @param threads: how many inputs to measure at the same time when the job
+                    has at least PARALLEL_MEASUREMENT_MIN_INPUTS of them
+
+    @rtype: dict
+    @return: the 'file_size', 'records' and 'num_input_datasets' of the job
+    """
+    measurements = JobMeasurements(job, app, tool, rule_types, verbose, count, threads)
+
+    if rule_types & set(['file_size', 'records', 'num_input_datasets']):
+        measurements('file_size')
+        if 'records' in rule_types:
+            measurements('records')
+        measurements.log_totals()
+
+    return {
+        'file_size': measurements.values.get('file_size', 0),
+        'records': measurements.values.get('records', 0),
+        'num_input_datasets': measurements.values.get('num_input_datasets', 0),
+    }
+
+
+def map_tool_to_destination(
+        job, app, tool, user_email, test=False, path="/config/tool_destinations.yml"):
+    """
+    Dynamically allocate resources
+
+    @param job: galaxy job
+    @param app: current app
+    @param tool: current tool
+
+    @type test: bool
+    @param test: True when running in test mode
+
+    @type path: str
+    @param path: path to tool_destinations.yml
+    """
+    importer(test)
+    started = _clock()
+
+    # Get configuration from tool_destinations.yml
+    try:
+        config = get_compiled_config(path)
+    except MalformedYMLException as e:
+        raise JobMappingException(e)
+
+    tool_id = str(tool.old_id)
+
+    timer = None
+    if config.settings['timing'] or config.settings['timing_log']:
+        timer = PhaseTimer()
+        config_time = _clock() - started
+        if config.load_times is not None:
+            with _config_cache_lock:
+                load_times, config.load_times = config.load_times, None
+            if load_times is not None:
+                for phase, seconds in load_times.items():
+                    timer.add(phase, seconds)
+                    config_time -= seconds
+        timer.add('config', max(0.0, config_time))
+
+    try:
+        # tools of configs with lazy_validation are validated here
+        rule_set = config.tools.get(tool_id)
+    except MalformedYMLException as e:
+        raise JobMappingException(e)
+    if rule_set is not None:
+        rule_types = rule_set.rule_types
+    else:
+        rule_types = frozenset()
+
+    if config.record_cache is not None:
+        count = config.record_cache.count
+    else:
+        count = count_records
+
+    # inputs are only measured once a rule needs them
+    measurements = JobMeasurements(
+        job, app, tool, rule_types, config.verbose, count,
+        config.settings['measurement_threads'], config.dataset_cache, timer)
+
+    try:
+        destination, fail_message = measurements.timed(
+            'rules', config.map, tool_id, user_email, measurements)
+    except MalformedYMLException as e:
+        raise JobMappingException(e)
+
+    measurements.log_totals()
+
+    metrics_file = config.settings['metrics_file']
+    if metrics_file is not None:
+        _metrics.mapped(tool_id, destination, _clock() - started)
+        _metrics.write(metrics_file, config.settings['metrics_interval'])
+
+    if timer is not None:
+        timer.add('total', _clock() - started)
+        _timing_stats.record(tool_id, timer.durations)
+        if config.settings['timing_log']:
+            log.info(_format_timings(tool_id, destination, timer.durations))
+
+    if destination == "fail":
+        raise JobMappingException(fail_message)
+
+    log.debug("Running '" + tool_id + "' with '" + destination + "'.")
+
+    return destination
+
+
+def map_many(tool_id, file_sizes=None, records=None, num_input_datasets=None,
+             priorities=None, user_email=None, path="/config/tool_destinations.yml"):
+    """
+    Decide where many hypothetical jobs of a tool would run, for capacity
+    planning. See CompiledConfig.map_many.
+
+    @type tool_id: str
+    @param tool_id: the id of the jobs' tool
+
+    @type path: str
+    @param path: path to tool_destinations.yml
+
+    @rtype: list, sequence (tuple)
+    @return: the destinations, and the position of each job's destination
+             among them
+    """
+    return get_compiled_config(path).map_many(
+        tool_id, file_sizes, records, num_input_datasets, priorities, user_email)
+
+
+class ReplayDataset(object):
+    """
+    An input of a replayed job that is a file on disk.
+    """
+
+    def __init__(self, file_name, ext, records=None):
+        self.file_name = file_name
+        self.ext = ext
+        self.metadata = {}
+        if records is not None:
+            self.metadata['sequences'] = records
+
+    def get_metadata(self):
+        return self.metadata
+
+
+class ReplayInput(object):
+    def __init__(self, name, dataset):
+        self.name = name
+        self.dataset = dataset
+
+
+class ReplayJob(object):
+    """
+    A job built from a job descriptor, with its inputs given by path.
+    """
+
+    def __init__(self, inputs, params):
+        self.input_datasets = inputs
+        self.input_library_datasets = []
+        self.param_values = params
+
+    def get_param_values(self, app, ignore_errors=False):
+        return self.param_values
+
+
+class ReplayTool(object):
+    def __init__(self, tool_id):
+        self.old_id = tool_id
+        self.installed_tool_dependencies = []
+
+
+class ReplayMeasurements(object):
+    """
+    Measures a job descriptor: its inputs given by path are measured like
+    those of a Galaxy job, and the sizes and numbers of records of its inputs
+    given without a path are added to them.
+    """
+
+    def __init__(self, descriptor, rule_types, count=count_records):
+        """
+        @type descriptor: dict
+        @param descriptor: the job descriptor, see replay_decisions
+
+        @type rule_types: set
+        @param rule_types: the rule_types of the tool's rules
+
+        @type count: callable
+        @param count: counts the records of a FASTA file, like count_records
+        """
+        inputs = []
+        self.given = {'file_size': 0, 'records': 0, 'num_input_datasets': 0}
+        for position, described in enumerate(descriptor.get('inputs', [])):
+            if not isinstance(described, dict):
+                described = {'path': described}
+            if 'path' in described:
+                dataset = ReplayDataset(str(described['path']),
+                                        described.get('ext', 'data'),
+                                        described.get('records'))
+                inputs.append(ReplayInput("input" + str(position), dataset))
+            else:
+                self.given['file_size'] += str_to_bytes(described.get('size', 0))
+                self.given['records'] += described.get('records', 0)
+                self.given['num_input_datasets'] += 1
+
+        for name in ('file_size', 'records', 'num_input_datasets'):
+            if name in descriptor:
+                self.given[name] = descriptor[name]
+                if name == 'file_size':
+                    self.given[name] = str_to_bytes(descriptor[name])
+
+        self.overridden = set(descriptor) & set(self.given)
+        self.measurements = JobMeasurements(
+            ReplayJob(inputs, descriptor.get('params', {})), None,
+            ReplayTool(descriptor.get('tool_id')), rule_types, count=count)
+
+    def __call__(self, name):
+        if name in self.overridden:
+            return self.given[name]
+        if name == 'params':
+            return self.measurements(name)
+        return self.measurements(name) + self.given[name]
+
+
+def replay_job(config, descriptor):
+    """
+    Decide where the job described by descriptor would run.
+
+    @type config: CompiledConfig
+    @param config: the config to map the job with
+
+    @type descriptor: dict
+    @param descriptor: the job descriptor, see replay_decisions
+
+    @rtype: str
+    @return: the job's destination
+    """
+    tool_id = descriptor.get('tool_id')
+    rule_set = config.tools.get(tool_id)
+    if rule_set is not None:
+        rule_types = rule_set.rule_types
+    else:
+        rule_types = frozenset()
+    if config.record_cache is not None:
+        count = config.record_cache.count
+    else:
+        count = count_records
+
+    measure = ReplayMeasurements(descriptor, rule_types, count)
+    return config.map(tool_id, descriptor.get('user_email'), measure)[0]
+
+
+def replay_decisions(stream, path="/config/tool_destinations.yml"):
+    """
+    Map the jobs described by the lines of stream, one at a time, with the
+    config at path. Each line is a JSON object with the job's 'tool_id', its
+    'user_email', its 'params' and its 'inputs', each either the path of a
+    file, an object with its 'path' (and optionally its 'ext' and number of
+    'records'), or an object with its 'size' and number of 'records' for
+    files that aren't around. 'file_size', 'records' and
+    'num_input_datasets' can also be given for the whole job.
+
+    @type stream: iterable
+    @param stream: the lines of the corpus
+
+    @type path: str
+    @param path: path to tool_destinations.yml
+
+    @rtype: generator
+    @return: for each job, its line number, tool id, destination (None if the
+             line couldn't be replayed) and how many seconds mapping it took
+    """
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+
+        config = get_compiled_config(path)
+        try:
+            descriptor = json.loads(line)
+            tool_id = descriptor.get('tool_id')
+            started = _clock()
+            destination = replay_job(config, descriptor)
+            seconds = _clock() - started
+        except (ValueError, TypeError, AttributeError, KeyError,
+                MalformedYMLException) as e:
+            log.warning("Couldn't replay line " + str(line_number) + ": " + str(e))
+            yield line_number, None, None, 0.0
+            continue
+
+        yield line_number, tool_id, destination, seconds
+
+
+def replay(stream, path="/config/tool_destinations.yml"):
+    """
+    Map the jobs described by the lines of stream with the config at path,
+    keeping only totals so that corpora of any size can be replayed.
+
+    @type stream: iterable
+    @param stream: the lines of the corpus, see replay_decisions
+
+    @type path: str
+    @param path: path to tool_destinations.yml
+
+    @rtype: dict
+    @return: the number of 'jobs' replayed, the number of lines that couldn't
+             be ('errors'), the 'seconds' it took, the number of jobs sent to
+             each destination ('destinations'), and the 'timings' of mapping
+             the jobs of each tool, as returned by TimingStats.get
+    """
+    started = _clock()
+    summary = {'jobs': 0, 'errors': 0, 'destinations': {}}
+    timings = TimingStats()
+
+    for line_number, tool_id, destination, seconds in replay_decisions(stream, path):
+        if destination is None:
+            summary['errors'] += 1
+            continue
+        summary['jobs'] += 1
+        summary['destinations'][destination] = \
+            summary['destinations'].get(destination, 0) + 1
+        timings.record(tool_id, {'total': seconds})
+
+    summary['seconds'] = _clock() - started
+    summary['timings'] = timings.get()
+    return summary
+
+
+def _format_replay(summary):
+    """
+    Write the summary returned by replay as lines of text.
+    """
+    lines = []
+    rate = 0.0
+    if summary['seconds'] > 0:
+        rate = summary['jobs'] / summary['seconds']
+    lines.append("Replayed " + str(summary['jobs']) + " jobs in " +
+                 "%.3f" % summary['seconds'] + " seconds (" + "%.1f" % rate +
+                 " jobs per second), " + str(summary['errors']) + " errors.")
+
+    lines.append("Destinations:")
+    for destination in sorted(summary['destinations']):
+        lines.append("  " + str(destination) + ": " +
+                     str(summary['destinations'][destination]))
+
+    lines.append("Latency per tool (jobs, mean ms, max ms):")
+    for tool in sorted(summary['timings'], key=str):
+        stats = summary['timings'][tool]['total']
+        lines.append("  " + str(tool) + ": " + str(stats['count']) + ", " +
+                     "%.3f" % (stats['sum'] / stats['count'] * 1000) + ", " +
+                     "%.3f" % (stats['max'] * 1000))
+
+    return "\n".join(lines)
+
+
+# how many lines of a corpus are compared at once by diff_configs
+DIFF_BATCH_SIZE = 1000
+
+
+def diff_batch(old_path, new_path, batch):
+    """
+    Map a batch of jobs with two configs.
+
+    @type old_path: str
+    @param old_path: path to the current tool_destinations.yml
+
+    @type new_path: str
+    @param new_path: path to the changed tool_destinations.yml
+
+    @type batch: list
+    @param batch: (line number, line) of the job descriptors
+
+    @rtype: list
+    @return: for each job, its line number, the line, its tool id and its
+             destination with each config, or None for all three if the
+             line couldn't be replayed
+    """
+    old_config = get_compiled_config(old_path)
+    new_config = get_compiled_config(new_path)
+
+    results = []
+    for line_number, line in batch:
+        try:
+            descriptor = json.loads(line)
+            results.append((line_number, line, descriptor.get('tool_id'),
+                            replay_job(old_config, descriptor),
+                            replay_job(new_config, descriptor)))
+        except (ValueError, TypeError, AttributeError, KeyError,
+                MalformedYMLException) as e:
+            log.warning("Couldn't replay line " + str(line_number) + ": " + str(e))
+            results.append((line_number, line, None, None, None))
+
+    return results
+
+
+def _corpus_batches(stream, batch_size):
+    """
+    Split the non-blank lines of stream into lists of (line number, line).
+    """
+    batch = []
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            batch.append((line_number, line.strip()))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def diff_configs(stream, old_path, new_path, batch_size=DIFF_BATCH_SIZE, processes=1):
+    """
+    Find which jobs of a corpus would go to another destination with the config
+    at new_path than with the one at old_path. Both configs are validated like
+    they are when mapping jobs, and the corpus is read a batch at a time.
+
+    @type stream: iterable
+    @param stream: the lines of the corpus, see replay_decisions
+
+    @type old_path: str
+    @param old_path: path to the current tool_destinations.yml
+
+    @type new_path: str
+    @param new_path: path to the changed tool_destinations.yml
+
+    @type batch_size: int
+    @param batch_size: how many jobs to map at once
+
+    @type processes: int
+    @param processes: how many processes to map batches in
+
+    @rtype: dict
+    @return: the number of 'jobs' compared, of 'errors' and of jobs 'moved',
+             and the 'transitions' of each tool, as a dict of the 'count' of
+             jobs and the 'line_number' and line ('example') of the first of
+             them by (old destination, new destination)
+    """
+    # fail on an invalid config before reading the corpus
+    get_compiled_config(old_path)
+    get_compiled_config(new_path)
+
+    summary = {'jobs': 0, 'errors': 0, 'moved': 0, 'transitions': {}}
+
+    def add(results):
+        for line_number, line, tool_id, old, new in results:
+            if old is None:
+                summary['errors'] += 1
+                continue
+            summary['jobs'] += 1
+            if old != new:
+                summary['moved'] += 1
+            transitions = summary['transitions'].setdefault(tool_id, {})
+            transition = transitions.get((old, new))
+            if transition is None:
+                transitions[(old, new)] = {'count': 1, 'line_number': line_number,
+                                           'example': line}
+            else:
+                transition['count'] += 1
+
+    batches = _corpus_batches(stream, batch_size)
+    if processes <= 1:
+        for batch in batches:
+            add(diff_batch(old_path, new_path, batch))
+        return summary
+
+    # only a few batches are handed out at a time, so that the corpus isn't
+    # read into memory faster than it's mapped
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(diff_batch, (old_path, new_path, batch)))
+            if len(pending) >= 2 * processes:
+                add(pending.popleft().get())
+        while pending:
+            add(pending.popleft().get())
+    finally:
+        pool.terminate()
+
+    return summary
+
+
+def _format_diff(summary):
+    """
+    Write the summary returned by diff_configs as a destination transition
+    matrix per tool, with an example of each job that moved.
+    """
+    lines = ["Compared " + str(summary['jobs']) + " jobs, " + str(summary['moved']) +
+             " moved, " + str(summary['errors']) + " errors."]
+
+    for tool in sorted(summary['transitions'], key=str):
+        transitions = summary['transitions'][tool]
+        olds = sorted(set(old for old, new in transitions))
+        news = sorted(set(new for old, new in transitions))
+        moved = sum(transition['count'] for (old, new), transition
+                    in transitions.items() if old != new)
+        total = sum(transition['count'] for transition in transitions.values())
+        lines.append("")
+        lines.append(str(tool) + ": " + str(total) + " jobs, " + str(moved) + " moved")
+
+        first = max([len("old \\ new")] + [len(old) for old in olds])
+        widths = [max(len(new), 5) for new in news]
+        row = "  " + "old \\ new".ljust(first)
+        for new, width in zip(news, widths):
+            row += "  " + new.rjust(width)
+        lines.append(row)
+        for old in olds:
+            row = "  " + old.ljust(first)
+            for new, width in zip(news, widths):
+                transition = transitions.get((old, new))
+                count = "."
+                if transition is not None:
+                    count = str(transition['count'])
+                row += "  " + count.rjust(width)
+            lines.append(row)
+
+        for (old, new) in sorted(transitions):
+            if old != new:
+                transition = transitions[(old, new)]
+                lines.append("  " + old + " -> " + new + ", e.g. line " +
+                             str(transition['line_number']) + ": " +
+                             transition['example'])
+
+    return "\n".join(lines)
+
+
+def _replay_report(corpus, config_path, diff=None, processes=1):
+    """
+    Replay a corpus of job descriptors against a config, or compare where two
+    configs send them when diff is the path to a second config.
+    """
+    if diff:
+        return _format_diff(diff_configs(corpus, config_path, diff, processes=processes))
+    return _format_replay(replay(corpus, config_path))
+
+
+if __name__ == '__main__':
+    """
+    This function is responsible for running the app if directly run through the
+    commandline. It offers the ability to specify a config through the commandline
+    for checking whether or not it is a valid config. It's to be run from within Galaxy,
+    assuming it is installed correctly within the proper directories in Galaxy, and it
+    looks for the config file in galaxy/config/. It can also be run with a path pointing
+    to a config file if not being run directly from inside Galaxy install directory.
+    """
+    verbose = True
+
+    parser = argparse.ArgumentParser()
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+    parser.add_argument(
+        '-c', '--check-config', dest='check_config', nargs='?',
+        help='Use this option to validate tool_destinations.yml.' +
+        ' Optionally, provide the path to the tool_destinations.yml' +
+        ' that you would like to check. Default: galaxy/config/tool_destinations.yml')
+
+    parser.add_argument(
+        '-s', '--snapshot', dest='snapshot', action='store_true',
+        help='Validate the config given by --check-config and write a snapshot' +
+        ' of it next to it, which handlers load instead of parsing the config' +
+        ' for as long as the config is unchanged.')
+
+    parser.add_argument(
+        '-r', '--replay', dest='replay', metavar='CORPUS',
+        help='Map the jobs described in CORPUS, a file with one JSON job' +
+        ' descriptor per line (- for standard input), with the config given' +
+        ' by --check-config, and report where they went and how fast.')
+
+    parser.add_argument(
+        '-d', '--diff', dest='diff', metavar='NEW_CONFIG',
+        help='With --replay, compare where the jobs of the corpus go with' +
+        ' NEW_CONFIG to where they go with the config given by --check-config.')
+
+    parser.add_argument(
+        '-p', '--processes', dest='processes', type=int, default=1,
+        help='How many processes to compare configs in. Default: 1')
+
+    parser.add_argument(
+        '-V', '--version', action='version', version="%(prog)s " + __version__)
+
+    args = parser.parse_args()
+
+    # if run with no arguments, display the help message
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.snapshot:
+        try:
+            snapshot_file = write_snapshot(args.check_config or
+                                           "/config/tool_destinations.yml")
+        except (MalformedYMLException, ScannerError, IOError, OSError) as e:
+            print("Errors detected; snapshot not written! " + str(e))
+            sys.exit(1)
+        print("Snapshot written to " + snapshot_file)
+        sys.exit(0)
+
+    if args.replay:
+        logging.getLogger().setLevel(logging.WARNING)
+        config_path = args.check_config or "/config/tool_destinations.yml"
+        try:
+            if args.replay == '-':
+                print(_replay_report(sys.stdin, config_path, args.diff, args.processes))
+            else:
+                with open(args.replay) as corpus:
+                    print(_replay_report(corpus, config_path, args.diff, args.processes))
+        except MalformedYMLException as e:
+            print("Errors detected; config not valid! " + str(e))
+            sys.exit(1)
+        sys.exit(0)
 
     if args.check_config:
         valid_config = parse_yaml(path=args.check_config, return_bool=True)
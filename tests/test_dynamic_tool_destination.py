@@ -33,8 +33,14 @@ Created on June 23rd, 2015
 
 import logging
 import os
+import pickle
+import random
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 sys.path.append("")
 import unittest
 import mockGalaxy as mg
@@ -91,6 +97,13 @@ vfdbJob = mg.Job()
 vfdbJob.add_input_dataset( mg.InputDataset("input1", mg.Dataset( (os.getcwd() + "/tests/data/test.fasta"), "fasta", 6)) )
 vfdbJob.set_arg_value( "mlst_or_genedb", {"vfdb_in": "-bact"} )
 
+manyInputsJob = mg.Job()
+for i in range(12):
+    manyInputsJob.add_input_dataset( mg.InputDataset("input" + str(i), mg.Dataset( (os.getcwd() + "/tests/data/test.fasta"), "fasta", None)) )
+    manyInputsJob.add_input_dataset( mg.InputDataset("full" + str(i), mg.Dataset( (os.getcwd() + "/tests/data/test3.full"), "txt", 15)) )
+manyInputsJob.add_input_dataset( mg.InputDataset("missing", mg.Dataset( (os.getcwd() + "/tests/data/not_here.full"), "txt", 15)) )
+manyInputsJob.add_input_dataset( mg.InputDataset("notafile", mg.NotAFile() ) )
+
 #======================Tools===================================
 vanillaTool = mg.Tool( 'test' )
 
@@ -138,6 +151,7 @@ class TestDynamicToolDestination(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
         logger = logging.getLogger()
+        dt.clear_caches()
 
     #=======================map_tool_to_destination()================================
 
@@ -148,9 +162,7 @@ class TestDynamicToolDestination(unittest.TestCase):
         l.check(
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Running config validation...'),
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'No global default destination specified in config!'),
-            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.'),
-            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Loading file: input1' + os.getcwd() + '/tests/data/test3.full'),
-            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Total size: 3.23 KB')
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.')
         )
 
     @log_capture()
@@ -422,6 +434,1288 @@ class TestDynamicToolDestination(unittest.TestCase):
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', "Running 'test_users' with 'lame_cluster'.")
         )
 
+    @log_capture()
+    def test_config_cached(self, l):
+        job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, path )
+        self.assertEquals( job, 'Destination1' )
+        job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, path )
+        self.assertEquals( job, 'Destination1' )
+
+        l.check(
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Running config validation...'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Loading file: input1' + os.getcwd() + '/tests/data/test3.full'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Total size: 3.23 KB'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Total number of files: 1'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', "Running 'test' with 'Destination1'."),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Loading file: input1' + os.getcwd() + '/tests/data/test3.full'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Total size: 3.23 KB'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Total number of files: 1'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', "Running 'test' with 'Destination1'.")
+        )
+
+    def test_config_cache_keeps_verbose(self):
+        self.assertTrue( dt.get_compiled_config( no_verbose_path ) is dt.get_compiled_config( no_verbose_path ) )
+        self.assertFalse( dt.get_compiled_config( no_verbose_path ).verbose )
+        self.assertTrue( dt.get_compiled_config( path ).verbose )
+        self.assertFalse( dt.get_compiled_config( no_verbose_path ).verbose )
+        self.assertTrue( dt.verbose )
+
+    def test_config_reloaded_on_change(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tmp_path = os.path.join( tmp_dir, "tool_destinations.yml" )
+            shutil.copy( path, tmp_path )
+            job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, tmp_path )
+            self.assertEquals( job, 'Destination1' )
+
+            shutil.copy( priority_path, tmp_path )
+            job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, tmp_path )
+            self.assertEquals( job, 'Destination1_high' )
+        finally:
+            shutil.rmtree( tmp_dir )
+
+    def test_concurrent_mapping_verbosity(self):
+        # half of the threads map with a verbose config, the other half with a quiet
+        # one; neither may change how the other logs
+        records = []
+        lock = threading.Lock()
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                with lock:
+                    records.append((record.threadName, record.getMessage()))
+
+        handler = Handler()
+        logger = logging.getLogger('dynamic_tool_destination.DynamicToolDestination')
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+
+        results = {}
+        iterations = 200
+
+        def run(name, tool, config_path):
+            found = []
+            for i in range(iterations):
+                found.append(map_tool_to_destination(runJob, theApp, tool, "user@email.com", True, config_path))
+            results[name] = found
+
+        threads = []
+        for i in range(8):
+            if i % 2:
+                args = ("quiet" + str(i), noVBTool, no_verbose_path)
+            else:
+                args = ("verbose" + str(i), vanillaTool, path)
+            threads.append(threading.Thread(target=run, name=args[0], args=args))
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertEquals(len(results), 8)
+        for name, found in results.items():
+            self.assertEquals(found, ['Destination1'] * iterations)
+            messages = [message for thread, message in records if thread == name]
+            if name.startswith("quiet"):
+                self.assertEquals(messages, ["Running 'test_no_verbose' with 'Destination1'."] * iterations)
+            else:
+                self.assertEquals(messages.count('Total size: 3.23 KB'), iterations)
+
+
+#================================compile_config()===============================
+    def test_compile_bounds(self):
+        config = dt.compile_config(dt.parse_yaml(path=yt.vYMLTest2, test=True))
+        rules = config.tools['smalt'].rules
+        self.assertEquals( [(rule.lower_bound, rule.upper_bound) for rule in rules],
+                           [(0, 100000000), (100000000, dt.INFINITY)] )
+        self.assertEquals( config.tools['smalt'].rule_types, frozenset(['file_size']) )
+
+    def test_compiled_map(self):
+        config = dt.compile_config(dt.parse_yaml(path=yt.vYMLTest2, test=True))
+        measure = {'file_size': 100000000}.__getitem__
+        self.assertEquals( config.map('smalt', "user@email.com", measure),
+                           ('fail', 'Too few reads for smalt to work') )
+        self.assertEquals( config.map('spades', "user@email.com", measure),
+                           ('waffles_default', None) )
+        self.assertEquals( config.map('unregistered', "user@email.com", measure),
+                           ('waffles_low', None) )
+
+    def test_interval_index_matches_linear_scan(self):
+        rng = random.Random(1234)
+        users = ["user@email.com", "other@email.com"]
+        for attempt in range(200):
+            rules = []
+            for number in range(rng.randint(1, 12)):
+                lower = rng.randint(0, 20)
+                upper = rng.choice([lower + rng.randint(0, 10), "Infinity"])
+                rule = {"rule_type": "records", "nice_value": rng.randint(-2, 2),
+                        "lower_bound": lower, "upper_bound": upper, "destination": "d" + str(number)}
+                if rng.random() < 0.3:
+                    rule["users"] = [rng.choice(users)]
+                rules.append(rule)
+            rule_set = dt.CompiledRuleSet("tool", {"rules": rules})
+
+            for value in range(0, 35):
+                for user in users:
+                    expected = None
+                    for rule in rule_set.rules:
+                        if (rule.authorized(user) and rule.lower_bound <= value < rule.upper_bound and
+                                (expected is None or rule.nice_value < expected.nice_value)):
+                            expected = rule
+                    self.assertTrue( rule_set.match(user, {"records": value}.__getitem__) is expected )
+
+    def test_lazy_match_matches_linear_scan(self):
+        rng = random.Random(4321)
+        users = ["user@email.com", "other@email.com"]
+        rule_types = ["file_size", "records", "num_input_datasets", "arguments"]
+        for attempt in range(300):
+            rules = []
+            for number in range(rng.randint(1, 8)):
+                rule = {"rule_type": rng.choice(rule_types), "nice_value": rng.randint(-2, 2),
+                        "destination": "d" + str(number)}
+                if rule["rule_type"] == "arguments":
+                    rule["arguments"] = {"careful": rng.choice([True, False])}
+                else:
+                    rule["lower_bound"] = rng.randint(0, 20)
+                    rule["upper_bound"] = rule["lower_bound"] + rng.randint(0, 10)
+                if rng.random() < 0.3:
+                    rule["users"] = [rng.choice(users)]
+                rules.append(rule)
+            rule_set = dt.CompiledRuleSet("tool", {"rules": rules})
+
+            values = {"file_size": rng.randint(0, 30), "records": rng.randint(0, 30),
+                      "num_input_datasets": rng.randint(0, 30),
+                      "params": {"careful": rng.choice([True, False])}}
+            for user in users:
+                expected = None
+                for rule in rule_set.rules:
+                    if rule.rule_type == "arguments":
+                        matched = rule.arguments["careful"] == values["params"]["careful"]
+                    else:
+                        value = values[rule.rule_type]
+                        matched = rule.lower_bound <= value < rule.upper_bound
+                    if (rule.authorized(user) and matched and
+                            (expected is None or rule.nice_value < expected.nice_value)):
+                        expected = rule
+
+                measured = []
+
+                def measure(name):
+                    measured.append(name)
+                    return values[name]
+
+                self.assertTrue( rule_set.match(user, measure) is expected )
+                if expected is not None:
+                    # nothing is measured for rules that can't beat the match
+                    for name in measured:
+                        rule_type = "arguments" if name == "params" else name
+                        self.assertTrue( any(rule.key <= expected.key for rule in rule_set.rules
+                                             if rule.rule_type == rule_type) )
+
+    def test_records_not_counted_when_decided(self):
+        counted = []
+
+        def count(file_name):
+            counted.append(file_name)
+            return dt.count_records(file_name)
+
+        rule_set = dt.CompiledRuleSet("tool", {"rules": [
+            {"rule_type": "arguments", "nice_value": -5, "arguments": {"careful": True},
+             "destination": "careful"},
+            {"rule_type": "records", "nice_value": 0, "lower_bound": 0, "upper_bound": 100,
+             "destination": "records"},
+        ]})
+        measurements = dt.JobMeasurements(
+            argJob, theApp, argTool, rule_set.rule_types, False, count)
+        self.assertEquals( rule_set.match("user@email.com", measurements).destination, "careful" )
+        self.assertEquals( counted, [] )
+        self.assertEquals( sorted(measurements.values), ["params"] )
+
+        measurements = dt.JobMeasurements(
+            dbcountJob, theApp, dbTool, rule_set.rule_types, False, count)
+        self.assertEquals( rule_set.match("user@email.com", measurements).destination, "records" )
+        self.assertEquals( counted, [os.getcwd() + "/tests/data/test.fasta"] )
+
+    def test_nested_arguments(self):
+        rule_set = dt.CompiledRuleSet("tool", {"rules": [
+            {"rule_type": "arguments", "nice_value": 0, "destination": "bact",
+             "arguments": {"mlst_or_genedb.vfdb_in": "-bact", "careful": True}},
+        ]})
+        params = {"careful": True, "mlst_or_genedb": {"vfdb_in": "-bact"}}
+        self.assertEquals( rule_set.match("user@email.com", {"params": params}.__getitem__).destination,
+                           "bact" )
+        params["mlst_or_genedb"]["vfdb_in"] = "-other"
+        self.assertTrue( rule_set.match("user@email.com", {"params": params}.__getitem__) is None )
+        params["mlst_or_genedb"] = "-bact"
+        self.assertTrue( rule_set.match("user@email.com", {"params": params}.__getitem__) is None )
+
+    def test_params_fetched_once(self):
+        calls = []
+
+        class CountingJob(mg.Job):
+            def get_param_values(self, app, ignore_errors=False):
+                calls.append(ignore_errors)
+                return mg.Job.get_param_values(self, app, ignore_errors)
+
+        job = CountingJob()
+        job.set_arg_value( "careful", False )
+        job.set_arg_value( "mlst_or_genedb", {"vfdb_in": "-bact"} )
+        rule_set = dt.CompiledRuleSet("tool", {"rules": [
+            {"rule_type": "arguments", "nice_value": 0, "destination": "d" + str(number),
+             "arguments": {"careful": True, "mlst_or_genedb.vfdb_in": "-bact"}}
+            for number in range(5)
+        ] + [
+            {"rule_type": "records", "nice_value": 1, "lower_bound": 0, "upper_bound": 10,
+             "destination": "records"},
+        ]})
+        measurements = dt.JobMeasurements(job, theApp, vfdbTool, rule_set.rule_types)
+        self.assertEquals( rule_set.match("user@email.com", measurements).destination, "records" )
+        self.assertEquals( calls, [False] )
+
+        # the first result or error is reused when the tool state has errors
+        class BrokenJob(CountingJob):
+            def get_param_values(self, app, ignore_errors=False):
+                if not ignore_errors:
+                    calls.append(ignore_errors)
+                    raise ValueError("invalid tool state")
+                return CountingJob.get_param_values(self, app, ignore_errors)
+
+        del calls[:]
+        job = BrokenJob()
+        job.set_arg_value( "mlst_or_genedb", {"vfdb_in": "-bact"} )
+        measurements = dt.JobMeasurements(job, theApp, vfdbTool, rule_set.rule_types)
+        self.assertEquals( measurements.params(True)["mlst_or_genedb"], {"vfdb_in": "-bact"} )
+        self.assertEquals( measurements.params(True)["mlst_or_genedb"], {"vfdb_in": "-bact"} )
+        self.assertEquals( measurements.params()["mlst_or_genedb"], {"vfdb_in": "-bact"} )
+        self.assertEquals( calls, [True] )
+
+        del calls[:]
+        measurements = dt.JobMeasurements(job, theApp, vfdbTool, rule_set.rule_types)
+        self.assertRaises( ValueError, measurements.params )
+        self.assertRaises( ValueError, measurements.params )
+        self.assertEquals( measurements.params(True), {} )
+        self.assertEquals( calls, [False] )
+
+    def test_map_many_matches_map(self):
+        rng = random.Random(1357)
+        users = ["user@email.com", "other@email.com", "nobody@email.com"]
+        rule_types = ["file_size", "records", "num_input_datasets", "arguments"]
+        priorities = ["low", "med", "high"]
+        numpy = dt.numpy
+        try:
+            for attempt in range(100):
+                rules = []
+                for number in range(rng.randint(0, 8)):
+                    rule = {"rule_type": rng.choice(rule_types), "nice_value": rng.randint(-2, 2),
+                            "destination": "d" + str(number)}
+                    if rng.random() < 0.3:
+                        rule["destination"] = {"priority": {"med": "d" + str(number) + "_med",
+                                                            "high": "d" + str(number) + "_high"}}
+                    if rule["rule_type"] == "arguments":
+                        rule["arguments"] = {"careful": True}
+                    else:
+                        rule["lower_bound"] = rng.randint(0, 20)
+                        rule["upper_bound"] = rng.choice([rule["lower_bound"] + rng.randint(0, 10),
+                                                          "Infinity"])
+                    if rng.random() < 0.3:
+                        rule["users"] = [rng.choice(users)]
+                    rules.append(rule)
+                config = dt.CompiledConfig({
+                    "default_destination": {"priority": {"med": "default_med", "low": "default_low"}},
+                    "users": {"user@email.com": {"priority": "high"},
+                              "other@email.com": {"priority": "low"}},
+                    "tools": {"tool": {"rules": rules, "default_destination": rng.choice([None, "tool_default"])}},
+                })
+
+                jobs = rng.randint(0, 40)
+                file_sizes = [rng.randint(0, 30) for job in range(jobs)]
+                records = [rng.randint(0, 30) for job in range(jobs)]
+                num_input_datasets = [rng.randint(0, 30) for job in range(jobs)]
+                job_priorities = rng.choice([None, [rng.choice(priorities) for job in range(jobs)]])
+                user = rng.choice(users)
+                tool = rng.choice(["tool", "tool", "other_tool"])
+
+                for module_numpy in (numpy, None):
+                    dt.numpy = module_numpy
+                    destinations, indices = config.map_many(
+                        tool, file_sizes, records, num_input_datasets, job_priorities, user)
+                    self.assertEquals( len(indices), jobs )
+                    for job in range(jobs):
+                        values = {"file_size": file_sizes[job], "records": records[job],
+                                  "num_input_datasets": num_input_datasets[job], "params": {}}
+                        if job_priorities is None:
+                            expected = config.map(tool, user, values.__getitem__)[0]
+                        else:
+                            config.priorities[user] = job_priorities[job]
+                            expected = config.map(tool, user, values.__getitem__)[0]
+                            del config.priorities[user]
+                        self.assertEquals( destinations[indices[job]], expected )
+        finally:
+            dt.numpy = numpy
+
+    def test_map_many(self):
+        destinations, indices = dt.map_many( 'test', [0, 2048, 100], None, [1, 1, 10],
+                                             user_email="user@email.com", path=path )
+        self.assertEquals( [destinations[index] for index in indices],
+                           ['fail', 'Destination1', 'fail'] )
+        self.assertRaises( ValueError, dt.map_many, 'test', [0, 1], [0], path=path )
+
+    def test_decision_cache_matches_rule_set(self):
+        rng = random.Random(2468)
+        users = ["user@email.com", "other@email.com"]
+        rule_types = ["file_size", "records", "num_input_datasets", "arguments"]
+        hits = 0
+        for attempt in range(100):
+            rules = []
+            for number in range(rng.randint(1, 8)):
+                rule = {"rule_type": rng.choice(rule_types), "nice_value": rng.randint(-2, 2),
+                        "destination": "d" + str(number)}
+                if rule["rule_type"] == "arguments":
+                    rule["arguments"] = {"careful": rng.choice([True, False])}
+                else:
+                    rule["lower_bound"] = rng.randint(0, 20)
+                    rule["upper_bound"] = rule["lower_bound"] + rng.randint(0, 10)
+                if rng.random() < 0.3:
+                    rule["users"] = [rng.choice(users)]
+                rules.append(rule)
+            rule_set = dt.CompiledRuleSet("tool", {"rules": rules})
+            decisions = dt.DecisionCache(rng.choice([4, 1000]))
+
+            for job in range(50):
+                values = {"file_size": rng.randint(0, 30), "records": rng.randint(0, 30),
+                          "num_input_datasets": rng.randint(0, 30),
+                          "params": {"careful": rng.choice([True, False])}}
+                user = rng.choice(users)
+                measured = []
+
+                def measure(name):
+                    measured.append(name)
+                    return values[name]
+
+                expected = rule_set.match(user, values.__getitem__)
+                self.assertTrue( decisions.match(rule_set, user, measure) is expected )
+                self.assertTrue( len(decisions.entries) <= decisions.max_entries )
+            self.assertEquals( decisions.hits + decisions.misses, 50 )
+            hits += decisions.hits
+        self.assertTrue( hits > 1000 )
+
+    def test_decision_cache_hit(self):
+        counted = []
+
+        def count(file_name):
+            counted.append(file_name)
+            return dt.count_records(file_name)
+
+        rule_set = dt.CompiledRuleSet("tool", {"rules": [
+            {"rule_type": "arguments", "nice_value": -5, "arguments": {"careful": True},
+             "destination": "careful"},
+            {"rule_type": "records", "nice_value": 0, "lower_bound": 0, "upper_bound": 100,
+             "destination": "records"},
+        ]})
+        decisions = dt.DecisionCache()
+        for job in (dbcountJob, dbcountJob):
+            measurements = dt.JobMeasurements(
+                job, theApp, dbTool, rule_set.rule_types, False, count)
+            self.assertEquals( decisions.match(rule_set, "user@email.com", measurements).destination,
+                               "records" )
+        self.assertEquals( (decisions.hits, decisions.misses), (1, 1) )
+        self.assertEquals( len(counted), 2 )
+
+        # a job the arguments rule decides is looked up without counting records
+        for job in (argJob, argJob):
+            measurements = dt.JobMeasurements(
+                job, theApp, argTool, rule_set.rule_types, False, count)
+            self.assertEquals( decisions.match(rule_set, "user@email.com", measurements).destination,
+                               "careful" )
+            self.assertEquals( sorted(measurements.values), ["params"] )
+        self.assertEquals( (decisions.hits, decisions.misses), (2, 2) )
+
+    def test_decision_cache_reloaded_with_config(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            shutil.copy(path, config_path)
+            map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, config_path )
+            map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, config_path )
+            decisions = dt.get_compiled_config(config_path).decisions
+            self.assertEquals( (decisions.hits, decisions.misses), (1, 1) )
+
+            with open(config_path, "a") as stream:
+                stream.write("\n")
+            self.assertEquals( map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, config_path ),
+                               'Destination1' )
+            decisions = dt.get_compiled_config(config_path).decisions
+            self.assertEquals( (decisions.hits, decisions.misses), (0, 1) )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_dataset_cache(self):
+        counted = []
+
+        def count(file_name):
+            counted.append(file_name)
+            return dt.count_records(file_name)
+
+        def shared_dataset(dataset_id, file_name, ext):
+            dataset = mg.Dataset(os.getcwd() + file_name, ext, None)
+            dataset.dataset_id = dataset_id
+            return dataset
+
+        # two HDAs of the same dataset, and a copy of test3.full known by its path only
+        job = mg.Job()
+        job.add_input_dataset( mg.InputDataset("hda1", shared_dataset(1, "/tests/data/test.fasta", "fasta")) )
+        job.add_input_dataset( mg.InputDataset("hda2", shared_dataset(1, "/tests/data/test.fasta", "fasta")) )
+        job.add_input_dataset( mg.InputDataset("full", mg.Dataset(os.getcwd() + "/tests/data/test3.full", "txt", 15)) )
+        rule_types = frozenset(['file_size', 'records', 'num_input_datasets'])
+
+        cache = dt.get_dataset_cache(10, 300)
+        for attempt in range(2):
+            measurements = dt.JobMeasurements(
+                job, theApp, vanillaTool, rule_types, False, count, dataset_cache=cache)
+            self.assertEquals( (measurements('file_size'), measurements('records'),
+                                measurements('num_input_datasets')),
+                               (os.path.getsize(os.getcwd() + "/tests/data/test3.full"), 12, 3) )
+        self.assertEquals( counted, [os.getcwd() + "/tests/data/test.fasta"] )
+        self.assertEquals( sorted(cache.entries), [('id', 1), ('path', os.getcwd() + "/tests/data/test3.full")] )
+
+        # expired measurements are taken again
+        cache.ttl = -1
+        measurements = dt.JobMeasurements(
+            job, theApp, vanillaTool, rule_types, False, count, dataset_cache=cache)
+        self.assertEquals( measurements('records'), 12 )
+        self.assertEquals( len(counted), 2 )
+
+        self.assertTrue( dt.get_dataset_cache(0, 300) is None )
+
+    def test_dataset_cache_missing_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmp_dir, "later.fasta")
+            dataset = mg.Dataset(file_name, "fasta", None)
+            dataset.dataset_id = 7
+            job = mg.Job()
+            job.add_input_dataset( mg.InputDataset("later", dataset) )
+            rule_types = frozenset(['file_size', 'num_input_datasets'])
+            cache = dt.get_dataset_cache(10, 300)
+
+            measurements = dt.JobMeasurements(
+                job, theApp, vanillaTool, rule_types, False, dataset_cache=cache)
+            self.assertEquals( measurements('num_input_datasets'), 0 )
+            self.assertEquals( len(cache.entries), 0 )
+
+            # the file shows up, under the same dataset id
+            shutil.copy(os.getcwd() + "/tests/data/test.fasta", file_name)
+            measurements = dt.JobMeasurements(
+                job, theApp, vanillaTool, rule_types, False, dataset_cache=cache)
+            self.assertEquals( measurements('num_input_datasets'), 1 )
+            self.assertEquals( sorted(cache.entries), [('id', 7)] )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @log_capture()
+    def test_lazy_validation(self, l):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            with open(path) as stream:
+                config = stream.read()
+            broken = "tools:\n  broken:\n    rules:\n      - nice_value: 0\n"
+            broken += "    default_destination: waffles_default\n"
+            with open(config_path, "w") as stream:
+                stream.write(config.replace("tools:\n", broken, 1))
+                stream.write("\nsettings:\n  lazy_validation: True\n")
+
+            error = "No rule_type found for rule 1 in 'broken'."
+            config = dt.get_compiled_config(config_path)
+            self.assertTrue( isinstance(config.config['tools'], dt.LazyToolSections) )
+            self.assertEquals( config.config['tools'].sections, {} )
+            self.assertFalse( error in [record.getMessage() for record in l.records] )
+            self.assertEquals( config.map('broken', "user@email.com", {}.__getitem__),
+                               ('waffles_default', None) )
+            self.assertTrue( error in [record.getMessage() for record in l.records] )
+            self.assertFalse( dt.parse_yaml(config_path, return_bool=True) )
+
+            eager = dt.compile_config(dt.parse_yaml(path), True)
+            self.assertTrue( isinstance(dt.parse_yaml(config_path)['tools'], dict) )
+            for tool in ['test', 'test_db', 'test_arguments', 'unregistered']:
+                for records in [0, 10, 5000]:
+                    values = {"file_size": records, "records": records, "num_input_datasets": 1,
+                              "params": {"careful": True}}
+                    self.assertEquals( config.map(tool, "user@email.com", values.__getitem__),
+                                       eager.map(tool, "user@email.com", values.__getitem__) )
+            self.assertEquals( sorted(config.config['tools'].sections),
+                               ['broken', 'test', 'test_arguments', 'test_db', 'unregistered'] )
+            self.assertTrue( config.config['tools'].get('unregistered') is None )
+
+            job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination4' )
+
+            # tools of a snapshot are already validated, but still compiled lazily
+            dt.write_snapshot(config_path)
+            dt.clear_caches()
+            config = dt.get_compiled_config(config_path)
+            self.assertTrue( isinstance(config.tools, dt.LazyRuleSets) )
+            self.assertEquals( config.tools.rule_sets, {} )
+            job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination4' )
+            self.assertEquals( sorted(config.tools.rule_sets), ['test_db'] )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lazy_validation_error(self):
+        tmp_dir = tempfile.mkdtemp()
+        validate_tool = dt._validate_tool
+        validated = []
+
+        def counting_validate_tool(tool, *args, **kwargs):
+            validated.append(tool)
+            return validate_tool(tool, *args, **kwargs)
+
+        try:
+            with open(path) as stream:
+                config = stream.read()
+            bad_size = "  test_db:\n    rules:\n      - rule_type: file_size\n        nice_value: 0\n"
+            bad_size += "        lower_bound: 12 QB\n        upper_bound: Infinity\n"
+            bad_size += "        destination: Destination1\n"
+            config = config.replace("  test_db:\n    rules:\n", bad_size, 1)
+            for lazy in [False, True]:
+                config_path = os.path.join(tmp_dir, "lazy.yml" if lazy else "eager.yml")
+                with open(config_path, "w") as stream:
+                    stream.write(config)
+                    stream.write("\nsettings:\n  lazy_validation: " + str(lazy) + "\n")
+
+                dt._validate_tool = counting_validate_tool
+                del validated[:]
+                for attempt in range(2):
+                    self.assertRaises( mg.JobMappingException, map_tool_to_destination,
+                                       dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+                if lazy:
+                    # the tool isn't validated again for each of its jobs
+                    self.assertEquals( validated, ['test_db'] )
+                    job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, config_path )
+                    self.assertEquals( job, 'Destination1' )
+        finally:
+            dt._validate_tool = validate_tool
+            shutil.rmtree(tmp_dir)
+
+    def test_lazy_compile_error(self):
+        tmp_dir = tempfile.mkdtemp()
+        compiled_rule = dt.CompiledRule
+        compiled = []
+
+        def broken_rule(rule, number):
+            compiled.append(rule['rule_type'])
+            if rule['rule_type'] == 'records':
+                raise KeyError('destination')
+            return compiled_rule(rule, number)
+
+        try:
+            config_path = os.path.join(tmp_dir, "lazy.yml")
+            with open(path) as stream:
+                config = stream.read()
+            with open(config_path, "w") as stream:
+                stream.write(config)
+                stream.write("\nsettings:\n  lazy_validation: True\n")
+
+            dt.CompiledRule = broken_rule
+            for attempt in range(2):
+                self.assertRaises( mg.JobMappingException, map_tool_to_destination,
+                                   dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            # the tool isn't compiled again for each of its jobs
+            self.assertEquals( compiled, ['records'] )
+            job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination1' )
+        finally:
+            dt.CompiledRule = compiled_rule
+            shutil.rmtree(tmp_dir)
+
+    def test_rule_without_destination(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(path) as stream:
+                config = stream.read()
+            config = config.replace("        upper_bound: 1 KB\n        destination: Destination4\n",
+                                    "        upper_bound: 1 KB\n", 1)
+            for lazy in [False, True]:
+                config_path = os.path.join(tmp_dir, "lazy.yml" if lazy else "eager.yml")
+                with open(config_path, "w") as stream:
+                    stream.write(config)
+                    stream.write("\nsettings:\n  lazy_validation: " + str(lazy) + "\n")
+
+                job = map_tool_to_destination( runJob, theApp, unTool, "user@email.com", True, config_path )
+                self.assertEquals( job, 'waffles_default' )
+                job = map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, config_path )
+                self.assertEquals( job, 'Destination1' )
+                # only jobs that match the rule fail
+                self.assertRaises( mg.JobMappingException, map_tool_to_destination,
+                                   dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_incremental_reload(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            with open(path) as stream:
+                original = stream.read()
+            with open(config_path, "w") as stream:
+                stream.write(original)
+            config = dt.get_compiled_config(config_path)
+            self.assertTrue( config.changed_tools is None )
+            self.assertEquals( sorted(config.tool_sections),
+                               ['test', 'test_arguments', 'test_db', 'test_db_high', 'test_overlap'] )
+
+            changed = original.replace("1 KB\n        destination: Destination4",
+                                       "1 KB\n        destination: Destination9")
+            changed = changed.replace("  test_arguments:", "  test_new:\n    default_destination: new\n\n  test_arguments:")
+            changed = changed.replace("verbose: True", "verbose: False")
+            with open(config_path, "w") as stream:
+                stream.write(changed)
+            reloaded = dt.get_compiled_config(config_path)
+            self.assertEquals( reloaded.changed_tools, ('test_db', 'test_new') )
+            self.assertFalse( reloaded.verbose )
+            for tool in ['test', 'test_arguments', 'test_db_high', 'test_overlap']:
+                self.assertTrue( reloaded.tools[tool] is config.tools[tool] )
+            self.assertFalse( reloaded.tools['test_db'] is config.tools['test_db'] )
+
+            fresh = dt.compile_config(dt.parse_yaml(config_path), False)
+            self.assertEquals( reloaded.config, fresh.config )
+            job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination9' )
+
+            with open(config_path, "w") as stream:
+                stream.write(changed.replace("  test_new:\n    default_destination: new\n\n", ""))
+            self.assertEquals( dt.get_compiled_config(config_path).changed_tools, ('test_new',) )
+
+            # a snapshot knows the digests of its tools
+            with open(config_path, "w") as stream:
+                stream.write(original.replace("destination: Destination1\n", "destination: Destination7\n", 1))
+            dt.write_snapshot(config_path)
+            snapshotted = dt.get_compiled_config(config_path)
+            self.assertEquals( sorted(snapshotted.load_times), ['compile', 'snapshot'] )
+            self.assertEquals( snapshotted.changed_tools, ('test', 'test_db') )
+
+            # and the tools it had are validated again once the config is parsed
+            with open(config_path, "w") as stream:
+                stream.write(original)
+            reloaded = dt.get_compiled_config(config_path)
+            self.assertEquals( reloaded.changed_tools, ('test',) )
+            self.assertEquals( reloaded.config, dt.parse_yaml(path) )
+
+            # tools validated lazily aren't hashed, so which of them changed isn't known
+            with open(config_path, "w") as stream:
+                stream.write(original + "\nsettings:\n  lazy_validation: True\n")
+            self.assertTrue( dt.get_compiled_config(config_path).changed_tools is None )
+            with open(config_path, "w") as stream:
+                stream.write(changed + "\nsettings:\n  lazy_validation: True\n")
+            self.assertTrue( dt.get_compiled_config(config_path).changed_tools is None )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_section_digest(self):
+        def section(arguments):
+            return {"rules": [{"rule_type": "arguments", "nice_value": 0, "destination": "d",
+                               "arguments": arguments}]}
+
+        self.assertEquals( dt._section_digest(section({123: True})),
+                           dt._section_digest(section({123: True})) )
+        # keys and values that only differ by their type are told apart
+        for old, new in [({123: True}, {"123": True}), ({"careful": 1}, {"careful": "1"}),
+                         ({"careful": 1}, {"careful": True}), ({"careful": 1}, {"careful": 1.0})]:
+            self.assertNotEquals( dt._section_digest(section(old)), dt._section_digest(section(new)) )
+
+    @log_capture()
+    def test_reload_checks_changed_tools(self, l):
+        tmp_dir = tempfile.mkdtemp()
+        validate_tool = dt._validate_tool
+        validated = []
+
+        def counting_validate_tool(tool, *args, **kwargs):
+            validated.append(tool)
+            return validate_tool(tool, *args, **kwargs)
+
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            with open(path) as stream:
+                original = stream.read().replace("verbose: True", "verbose: False")
+            with open(config_path, "w") as stream:
+                stream.write(original)
+            config = dt.get_compiled_config(config_path)
+
+            # only the changed tool is validated, once, and quietly
+            dt._validate_tool = counting_validate_tool
+            l.clear()
+            with open(config_path, "w") as stream:
+                stream.write(original.replace("destination: Destination4", "destination: Destination9", 1))
+            reloaded = dt.get_compiled_config(config_path)
+            self.assertFalse( reloaded is config )
+            self.assertEquals( validated, ['test_overlap'] )
+            self.assertEquals( [record for record in l.records if record.levelname == 'DEBUG'], [] )
+
+            # a tool that had to be fixed when the config was first loaded isn't
+            # validated again, but still rejects changes to the other tools
+            fixable_path = os.path.join(tmp_dir, "fixable.yml")
+            fixable = original.replace("        nice_value: -20\n", "", 1)
+            with open(fixable_path, "w") as stream:
+                stream.write(fixable)
+            config = dt.get_compiled_config(fixable_path)
+            del validated[:]
+            with open(fixable_path, "w") as stream:
+                stream.write(fixable.replace("destination: Destination6", "destination: Destination7"))
+            self.assertTrue( dt.get_compiled_config(fixable_path) is config )
+            self.assertEquals( validated, ['test_arguments'] )
+        finally:
+            dt._validate_tool = validate_tool
+            shutil.rmtree(tmp_dir)
+
+    @log_capture()
+    def test_rejected_config(self, l):
+        dt.get_metrics().reset()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            shutil.copy(path, config_path)
+            config = dt.get_compiled_config(config_path)
+
+            # a config being edited is rejected once, and the last valid one is kept
+            with open(config_path, "w") as stream:
+                stream.write("tools: [\n")
+            for attempt in range(3):
+                self.assertTrue( dt.get_compiled_config(config_path) is config )
+                job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+                self.assertEquals( job, 'Destination4' )
+
+            shutil.copy(path, config_path)
+            with open(config_path, "a") as stream:
+                stream.write("\n")
+            self.assertFalse( dt.get_compiled_config(config_path) is config )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        errors = [record.getMessage() for record in l.records if record.levelname == 'ERROR']
+        self.assertEquals( len(errors), 1 )
+        self.assertTrue( errors[0].startswith("Rejected changes to " + os.path.realpath(config_path) +
+                                              "; still using the config loaded before them: ") )
+        text = dt.get_metrics().render()
+        self.assertTrue( "dynamic_tool_destination_config_rejections_total 1\n" in text )
+        self.assertTrue( "dynamic_tool_destination_config_reloads_total 2\n" in text )
+
+    @log_capture()
+    def test_rejected_incomplete_config(self, l):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            shutil.copy(path, config_path)
+            config = dt.get_compiled_config(config_path)
+            job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination4' )
+
+            with open(path) as stream:
+                lines = stream.readlines()
+            edits = [
+                "",                                   # emptied
+                "".join(lines[:50]),                  # cut before the global default_destination
+                "".join(lines[:-2]) + "verbose: True\n",                    # no default_destination
+                "".join(lines).replace("        nice_value: -20\n", "", 1),  # fixable problem
+            ]
+            for edit in edits:
+                with open(config_path, "w") as stream:
+                    stream.write(edit)
+                self.assertTrue( dt.get_compiled_config(config_path) is config )
+                job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+                self.assertEquals( job, 'Destination4' )
+
+            # a config that validates is loaded again
+            shutil.copy(path, config_path)
+            with open(config_path, "a") as stream:
+                stream.write("\n")
+            self.assertFalse( dt.get_compiled_config(config_path) is config )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        errors = [record.getMessage() for record in l.records if record.levelname == 'ERROR']
+        self.assertEquals( len(errors), 4 )
+        prefix = "Rejected changes to " + os.path.realpath(config_path) + "; still using the config loaded before them: "
+        self.assertEquals( errors[:3], [prefix + "No valid global default_destination in config!"] * 3 )
+        self.assertEquals( errors[3], prefix + "Config doesn't validate; check it with DynamicToolDestination.py -c" )
+
+    def test_config_watcher(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            shutil.copy(path, config_path)
+            with open(config_path, "a") as stream:
+                stream.write("\nsettings:\n  reload_interval: 3600\n")
+            config = dt.get_compiled_config(config_path)
+            watcher = dt._config_watchers[config_path]
+            self.assertTrue( watcher.watching() )
+
+            # jobs don't check the file, the watcher does
+            with open(config_path, "w") as stream:
+                stream.write("tools: [\n")
+            self.assertTrue( dt.get_compiled_config(config_path) is config )
+            watcher.check()
+            self.assertTrue( dt.get_compiled_config(config_path) is config )
+
+            with open(path) as stream:
+                changed = stream.read().replace("Destination4", "Destination9")
+            with open(config_path, "w") as stream:
+                stream.write(changed + "\nsettings:\n  reload_interval: 3600\n")
+            self.assertTrue( dt.get_compiled_config(config_path) is config )
+            watcher.check()
+            config = dt.get_compiled_config(config_path)
+            job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination9' )
+
+            # without a reload_interval, jobs check the file again
+            with open(config_path, "w") as stream:
+                stream.write(changed)
+            watcher.check()
+            self.assertFalse( watcher.watching() )
+            self.assertFalse( dt.get_compiled_config(config_path) is config )
+        finally:
+            dt.clear_caches()
+            shutil.rmtree(tmp_dir)
+
+    @log_capture()
+    def test_snapshot(self, l):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            shutil.copy(path, config_path)
+            snapshot_path = dt.write_snapshot(config_path)
+            self.assertEquals( snapshot_path, os.path.realpath(config_path) + ".snapshot" )
+            self.assertEquals( dt.load_snapshot(config_path), (dt.parse_yaml(path), True) )
+
+            dt.clear_caches()
+            config = dt.get_compiled_config(config_path)
+            self.assertEquals( sorted(config.load_times), ['compile', 'snapshot'] )
+            job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+            self.assertEquals( job, 'Destination4' )
+
+            # an edited config makes the snapshot stale
+            with open(config_path, "a") as stream:
+                stream.write("\n")
+            dt.clear_caches()
+            self.assertEquals( sorted(dt.get_compiled_config(config_path).load_times),
+                               ['compile', 'parse', 'validate'] )
+
+            with open(snapshot_path, "wb") as stream:
+                stream.write(b"not a snapshot")
+            self.assertTrue( dt.load_snapshot(config_path) is None )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        warnings = [record.getMessage() for record in l.records if record.levelname == 'WARNING']
+        self.assertEquals( len(warnings), 2 )
+        self.assertTrue( warnings[0].endswith(" is out of date; parsing " + os.path.realpath(config_path)) )
+        self.assertTrue( warnings[1].startswith("Couldn't read " + snapshot_path) )
+
+    @log_capture()
+    def test_snapshot_from_command_line(self, l):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            with open(path) as stream:
+                config = stream.read()
+            with open(config_path, "w") as stream:
+                stream.write(config.replace("default_destination: waffles_default\nverbose",
+                                            "default_destination:\n  priority:\n    med: waffles_default\nverbose"))
+
+            # the module runs as __main__, but handlers import it under its own name
+            script = os.path.join(os.getcwd(), "dynamic_tool_destination", "DynamicToolDestination.py")
+            process = subprocess.Popen([sys.executable, script, "-c", config_path, "-s"],
+                                       stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            self.assertEquals( process.returncode, 0, output )
+
+            config, verbose = dt.load_snapshot(config_path)
+            self.assertEquals( config, dt.parse_yaml(config_path) )
+            self.assertTrue( isinstance(config['tools']['test'], dt.ToolEntry) )
+            self.assertTrue( isinstance(config['tools']['test']['rules'][0], dt.Rule) )
+            self.assertTrue( isinstance(config['default_destination'], dt.PriorityDestination) )
+            self.assertEquals( sorted(dt.get_compiled_config(config_path).load_times), ['compile', 'snapshot'] )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEquals( [record.getMessage() for record in l.records if record.levelname == 'WARNING'], [] )
+
+    def test_validated_records(self):
+        config = dt.parse_yaml(yt.vYMLTest7, test=True)
+        tool = config['tools']['spades']
+        rule = tool['rules'][0]
+        self.assertTrue( isinstance(tool, dt.ToolEntry) )
+        self.assertTrue( isinstance(rule, dt.Rule) )
+        self.assertTrue( isinstance(config['default_destination'], dt.PriorityDestination) )
+        self.assertEquals( rule, {'rule_type': 'file_size', 'nice_value': 0, 'lower_bound': 0,
+                                  'upper_bound': 100000000, 'destination': {'priority': {'med': 'things'}}} )
+        self.assertEquals( rule['destination']['priority']['med'], 'things' )
+        self.assertEquals( sorted(tool), ['rules'] )
+        self.assertTrue( 'default_destination' not in tool )
+        self.assertEquals( tool.get('default_destination', 'none'), 'none' )
+        self.assertRaises( KeyError, lambda: tool['default_destination'] )
+        self.assertFalse( hasattr(rule, '__dict__') )
+        self.assertRaises( AttributeError, setattr, rule, 'nice_value', 5 )
+
+        # keys a rule doesn't know are kept
+        extra = dt.Rule(dict(rule, hax=1337))
+        self.assertEquals( extra['hax'], 1337 )
+        self.assertEquals( extra, dict(rule, hax=1337) )
+        self.assertNotEqual( extra, rule )
+
+        # the validated rules share what they don't change with the original config
+        raw = {'tools': {'spades': {'rules': [{'rule_type': 'arguments', 'nice_value': 0,
+                                               'arguments': {'careful': True},
+                                               'destination': 'cluster'}]}},
+               'default_destination': 'waffles'}
+        validated = dt.validate_config(raw)
+        self.assertTrue( validated['tools']['spades']['rules'][0]['arguments'] is
+                         raw['tools']['spades']['rules'][0]['arguments'] )
+
+        self.assertEquals( pickle.loads(pickle.dumps(config, 2)), config )
+
+    def test_rule_errors(self):
+        self.assertEquals( sorted(dt.rule_schema), sorted(dt.available_rule_types) )
+
+        rule = {'rule_type': 'file_size', 'lower_bound': '2 KB', 'upper_bound': '1 KB',
+                'destination': 'fail', 'users': ['user@email.com', 'not an email']}
+        errors = []
+        validated = dt.rule_validators['file_size'](rule, 2, 'spades', False, errors)
+        self.assertEquals( validated, {'rule_type': 'file_size', 'lower_bound': '1 KB',
+                                       'upper_bound': '2 KB', 'destination': 'fail',
+                                       'users': ['user@email.com'], 'nice_value': 0,
+                                       'fail_message': "Invalid parameters for rule 2 in 'spades'."} )
+        self.assertEquals( rule['users'], ['user@email.com', 'not an email'] )
+        self.assertEquals( [error.message() for error in errors],
+                           ["Supplied email 'not an email' for rule 2 in tool 'spades' is in an invalid format! Ignoring email.",
+                            "No nice_value found for rule 2 in 'spades'. Setting nice_value to 0.",
+                            "Missing a fail_message for rule 2 in 'spades'. Adding generic fail_message.",
+                            "lower_bound exceeds upper_bound for rule 2 in 'spades'. Reversing bounds."] )
+        self.assertEquals( errors[1].message(return_bool=True),
+                           "No nice_value found for rule 2 in 'spades'." )
+
+        # nothing is fixed when only the result is wanted
+        errors = []
+        validated = dt.rule_validators['file_size'](rule, 2, 'spades', True, errors)
+        self.assertTrue( 'nice_value' not in validated )
+        self.assertEquals( validated['lower_bound'], '2 KB' )
+        self.assertEquals( len(errors), 4 )
+
+        errors = []
+        self.assertTrue( dt.rule_validators['arguments']({'rule_type': 'arguments', 'nice_value': 0,
+                                                         'destination': 'cluster'},
+                                                        1, 'spades', False, errors) is None )
+        self.assertEquals( [error.message() for error in errors],
+                           ["No arguments found for rule 1 in 'spades' despite being of type arguments. Ignoring rule."] )
+
+        self.assertEquals( dt.bound_to_bytes("1 KB"), 1024 )
+        self.assertEquals( dt.bound_to_bytes(5), 5 )
+        self.assertEquals( dt.bound_to_bytes("Infinity"), -1 )
+        self.assertRaises( dt.MalformedYMLException, dt.bound_to_bytes, "1 XB" )
+
+    @log_capture()
+    def test_timings(self, l):
+        dt.reset_timings()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            shutil.copy(path, config_path)
+            with open(config_path, "a") as stream:
+                stream.write("\nsettings:\n  timing_log: True\n")
+
+            for attempt in range(2):
+                job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+                self.assertEquals( job, 'Destination4' )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        timings = dt.get_timings()
+        self.assertEquals( list(timings), ['test_db'] )
+        counts = dict((phase, timings['test_db'][phase]['count']) for phase in timings['test_db'])
+        self.assertEquals( counts, {'config': 2, 'parse': 1, 'validate': 1, 'compile': 1,
+                                    'vfdb': 2, 'stat': 2, 'records': 2, 'rules': 2, 'total': 2} )
+        for phase, stats in timings['test_db'].items():
+            self.assertEquals( sum(count for bound, count in stats['buckets']), stats['count'] )
+            self.assertTrue( 0 <= stats['max'] <= stats['sum'] )
+        self.assertTrue( timings['test_db']['total']['sum'] >= timings['test_db']['records']['sum'] )
+
+        lines = [record.getMessage() for record in l.records if record.levelname == 'INFO']
+        self.assertEquals( len(lines), 2 )
+        self.assertTrue( lines[0].startswith("Timings: tool=test_db destination=Destination4 ") )
+        self.assertTrue( " parse=" in lines[0] and " parse=" not in lines[1] )
+
+    def test_timings_off(self):
+        dt.reset_timings()
+        map_tool_to_destination( runJob, theApp, vanillaTool, "user@email.com", True, path )
+        self.assertEquals( dt.get_timings(), {} )
+
+    def test_phase_timer_nesting(self):
+        timer = dt.PhaseTimer()
+        timer.start('rules')
+        timer.start('records')
+        timer.stop()
+        timer.stop()
+        self.assertEquals( sorted(timer.durations), ['records', 'rules'] )
+        self.assertTrue( min(timer.durations.values()) >= 0 )
+
+    def test_metrics(self):
+        dt.get_metrics().reset()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            metrics_path = os.path.join(tmp_dir, "dtd.prom")
+            shutil.copy(path, config_path)
+            with open(config_path, "a") as stream:
+                stream.write("\nsettings:\n  metrics_file: " + metrics_path + "\n")
+
+            for attempt in range(2):
+                job = map_tool_to_destination( dbcountJob, theApp, dbTool, "user@email.com", True, config_path )
+                self.assertEquals( job, 'Destination4' )
+
+            with open(metrics_path) as stream:
+                text = stream.read()
+            self.assertEquals( sorted(os.listdir(tmp_dir)), ["dtd.prom", "tool_destinations.yml"] )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # only the first job is written, the second is within metrics_interval
+        self.assertTrue( 'dynamic_tool_destination_jobs_total{destination="Destination4"} 1\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_config_reloads_total 1\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_bucket{le="+Inf"} 1\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_count 1\n' in text )
+        self.assertTrue( '# TYPE dynamic_tool_destination_mapping_seconds histogram\n' in text )
+
+    def test_metrics_render(self):
+        metrics = dt.Metrics()
+        metrics.mapped('spades', 'cluster', 0.002)
+        metrics.mapped('spades', 'cluster', 0.2)
+        metrics.mapped('bwa "mem"', 'fail', 20)
+        text = metrics.render({'pid': 42})
+
+        self.assertTrue( 'dynamic_tool_destination_jobs_total{destination="cluster",pid="42"} 2\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_jobs_failed_total{tool="bwa \\"mem\\"",pid="42"} 1\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_bucket{le="0.001",pid="42"} 0\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_bucket{le="0.005",pid="42"} 1\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_bucket{le="10.0",pid="42"} 2\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_bucket{le="+Inf",pid="42"} 3\n' in text )
+        self.assertTrue( 'dynamic_tool_destination_mapping_seconds_count{pid="42"} 3\n' in text )
+
+#================================replay()=======================================
+    def replay_corpus(self):
+        fasta = os.getcwd() + "/tests/data/test.fasta"
+        return [
+            '{"tool_id": "test_db", "user_email": "user@email.com", "inputs": [{"size": 0, "records": 10}]}\n',
+            '{"tool_id": "test_db", "inputs": [{"path": "' + fasta + '", "ext": "fasta"}]}\n',
+            '{"tool_id": "test_db", "records": 5000}\n',
+            '\n',
+            '{"tool_id": "test_arguments", "params": {"careful": true}}\n',
+            '{"tool_id": "test_arguments", "params": {"careful": false}}\n',
+            'not json\n',
+        ]
+
+    def test_replay_decisions(self):
+        decisions = [(line_number, tool_id, destination) for line_number, tool_id, destination, seconds
+                     in dt.replay_decisions(self.replay_corpus(), path)]
+        self.assertEquals( decisions, [
+            (1, 'test_db', 'Destination4'),
+            (2, 'test_db', 'Destination4'),
+            (3, 'test_db', 'fail'),
+            (5, 'test_arguments', 'Destination6'),
+            (6, 'test_arguments', 'waffles_default'),
+            (7, None, None),
+        ] )
+
+    def test_replay(self):
+        summary = dt.replay(iter(self.replay_corpus()), path)
+        self.assertEquals( summary['jobs'], 5 )
+        self.assertEquals( summary['errors'], 1 )
+        self.assertEquals( summary['destinations'], {'Destination4': 2, 'fail': 1,
+                                                     'Destination6': 1, 'waffles_default': 1} )
+        self.assertEquals( sorted(summary['timings']), ['test_arguments', 'test_db'] )
+        self.assertEquals( summary['timings']['test_db']['total']['count'], 3 )
+
+        text = dt._format_replay(summary)
+        self.assertTrue( text.startswith("Replayed 5 jobs in ") )
+        self.assertTrue( "  Destination4: 2\n" in text )
+        self.assertTrue( "  test_db: 3, " in text )
+
+    def test_diff_configs(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            new_path = os.path.join(tmp_dir, "tool_destinations.yml")
+            with open(path) as stream:
+                config = stream.read()
+            with open(new_path, "w") as stream:
+                stream.write(config.replace("destination: Destination6", "destination: Destination7"))
+
+            for processes in (1, 2):
+                summary = dt.diff_configs(iter(self.replay_corpus()), path, new_path,
+                                          batch_size=2, processes=processes)
+                self.assertEquals( (summary['jobs'], summary['moved'], summary['errors']), (5, 1, 1) )
+                self.assertEquals( summary['transitions']['test_arguments'], {
+                    ('Destination6', 'Destination7'): {'count': 1, 'line_number': 5,
+                                                       'example': '{"tool_id": "test_arguments", "params": {"careful": true}}'},
+                    ('waffles_default', 'waffles_default'): {'count': 1, 'line_number': 6,
+                                                             'example': '{"tool_id": "test_arguments", "params": {"careful": false}}'},
+                } )
+                self.assertEquals( summary['transitions']['test_db'][('Destination4', 'Destination4')]['count'], 2 )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        text = dt._format_diff(summary)
+        self.assertTrue( text.startswith("Compared 5 jobs, 1 moved, 1 errors.") )
+        self.assertTrue( "test_arguments: 2 jobs, 1 moved\n" in text )
+        self.assertTrue( "  Destination6 -> Destination7, e.g. line 5: " in text )
+
+#================================count_records()================================
+    def count_lines(self, file_name):
+        with open(file_name) as stream:
+            return len([line for line in stream if line[0] == ">"])
+
+    def test_count_records(self):
+        for file_name in ["/tests/data/test.fasta", "/tests/vfdb/?bact.test", "/tests/data/test.empty"]:
+            expected = self.count_lines(os.getcwd() + file_name)
+            self.assertEquals( dt.count_records(os.getcwd() + file_name), expected )
+            self.assertEquals( dt.count_records(os.getcwd() + file_name, use_mmap=True), expected )
+
+    def test_count_records_chunk_boundaries(self):
+        fd, file_name = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(b">a\nACGT\n>b\n>\n\n>c\nAC>GT\n>")
+            for chunk_size in range(1, 12):
+                for use_mmap in (False, True):
+                    self.assertEquals( dt.count_records(file_name, use_mmap, chunk_size), 5 )
+        finally:
+            os.remove(file_name)
+
+    def test_count_records_memory(self):
+        # a single 2 GB sequence line, written as a sparse file; counting it must not
+        # hold the line (or a mapping of the whole file) in memory
+        line_length = 2 * valueG
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(tmp_dir, "genome.fasta")
+            with open(file_name, 'wb') as stream:
+                stream.write(b">chr1\n")
+                stream.seek(line_length, os.SEEK_CUR)
+                stream.write(b"\n>plasmid\nACGT\n")
+
+            script = ("import resource, sys; sys.path.insert(0, %r); "
+                      "import dynamic_tool_destination.DynamicToolDestination as dt; "
+                      "print(dt.count_records(%r, %s)); "
+                      "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+            for use_mmap in (False, True):
+                output = subprocess.Popen(
+                    [sys.executable, "-c", script % (os.getcwd(), file_name, use_mmap)],
+                    stdout=subprocess.PIPE).communicate()[0].split()
+                self.assertEquals( int(output[0]), 2 )
+                # ru_maxrss is in KB
+                self.assertTrue( int(output[1]) * valueK < 128 * valueM, output[1] )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_record_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        count_records = dt.count_records
+        try:
+            fasta = os.path.join(tmp_dir, "test.fasta")
+            shutil.copy(os.getcwd() + "/tests/data/test.fasta", fasta)
+            database = os.path.join(tmp_dir, "records.sqlite")
+            self.assertEquals( dt.RecordCache(database).count(fasta), 6 )
+
+            # another handler finds the count without reading the file
+            def fail(file_name):
+                raise AssertionError("counted " + file_name)
+            dt.count_records = fail
+            self.assertEquals( dt.RecordCache(database).count(fasta), 6 )
+            dt.count_records = count_records
+
+            # but counts it again once it changed
+            with open(fasta, 'a') as stream:
+                stream.write("\n>one more\nACGT\n")
+            self.assertEquals( dt.RecordCache(database).count(fasta), 7 )
+        finally:
+            dt.count_records = count_records
+            shutil.rmtree(tmp_dir)
+
+    def test_record_cache_size(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            record_cache = dt.RecordCache(os.path.join(tmp_dir, "records.sqlite"), 2)
+            for i in range(3):
+                fasta = os.path.join(tmp_dir, str(i) + ".fasta")
+                with open(fasta, 'w') as stream:
+                    stream.write(">record\nACGT\n" * i)
+                self.assertEquals( record_cache.count(fasta), i )
+            rows = record_cache._connection().execute("SELECT path FROM records").fetchall()
+            self.assertEquals( len(rows), 2 )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @log_capture()
+    def test_parallel_measurement(self, l):
+        rule_types = frozenset(['file_size', 'records', 'num_input_datasets'])
+        serial = dt.measure_job(manyInputsJob, theApp, vanillaTool, rule_types, True)
+        serial_logs = [record.getMessage() for record in l.records]
+        l.clear()
+        parallel = dt.measure_job(
+            manyInputsJob, theApp, vanillaTool, rule_types, True, threads=4)
+        self.assertEquals( serial, {
+            'file_size': 12 * os.path.getsize(os.getcwd() + "/tests/data/test3.full"),
+            'records': 12 * 6,
+            'num_input_datasets': 24,
+        })
+        self.assertEquals( parallel, serial )
+        self.assertEquals( [record.getMessage() for record in l.records], serial_logs )
+        self.assertTrue( "Not a file: " + str(manyInputsJob.input_datasets[-1].dataset) in serial_logs )
+
+    def test_vfdb_cached(self):
+        tmp_dir = tempfile.mkdtemp()
+        counted = []
+
+        def count(file_name):
+            counted.append(file_name)
+            return dt.count_records(file_name)
+
+        try:
+            os.mkdir(os.path.join(tmp_dir, "vfdb"))
+            vfdb = os.path.join(tmp_dir, "vfdb", "xbact.fasta")
+            with open(vfdb, 'w') as stream:
+                stream.write(">one\nACGT\n>two\nACGT\n")
+            self.assertEquals( dt.get_vfdb(tmp_dir, "-bact"), (vfdb, None) )
+            self.assertEquals( dt.get_vfdb(tmp_dir, "-bact", count), (vfdb, 2) )
+            self.assertEquals( dt.get_vfdb(tmp_dir, "-bact", count), (vfdb, 2) )
+            self.assertEquals( counted, [vfdb] )
+            self.assertEquals( dt.get_vfdb(tmp_dir, "-not_here", count), (None, 0) )
+
+            # Reinstalling the database changes the directory's mtime
+            os.remove(vfdb)
+            vfdb = os.path.join(tmp_dir, "vfdb", "ybact.fasta")
+            with open(vfdb, 'w') as stream:
+                stream.write(">one\nACGT\n")
+            stat = os.stat(os.path.join(tmp_dir, "vfdb"))
+            os.utime(os.path.join(tmp_dir, "vfdb"), (stat.st_atime, stat.st_mtime + 10))
+            self.assertEquals( dt.get_vfdb(tmp_dir, "-bact", count), (vfdb, 1) )
+            self.assertEquals( dt.get_vfdb(tmp_dir + "/missing", "-bact", count), (None, None) )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_count_records_dense(self):
+        fd, file_name = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(b">r\nAC>GT\n" * 100)
+            for chunk_size in (7, 64, 1024):
+                self.assertEquals( dt.count_records(file_name, chunk_size=chunk_size), 100 )
+        finally:
+            os.remove(file_name)
+
 
 #================================Invalid yaml files==============================
     @log_capture()
@@ -782,6 +2076,16 @@ class TestDynamicToolDestination(unittest.TestCase):
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.')
         )
 
+    @log_capture()
+    def test_return_rule_for_invalid_settings(self, l):
+        self.assertEquals(dt.parse_yaml(path=yt.ivYMLTest149, test=True), yt.iv149dict)
+        self.assertFalse(dt.parse_yaml(path=yt.ivYMLTest149, test=True, return_bool=True))
+        self.assertEquals(sorted(l.records[i].getMessage() for i in range(1, 4)), [
+            "Invalid value '12' for setting 'record_cache'! Using default.",
+            "Invalid value 'True' for setting 'record_cache_size'! Using default.",
+            "Unrecognized setting 'colour' found in config! Ignoring..."
+        ])
+
 #================================Valid yaml files==============================
     @log_capture()
     def test_parse_valid_yml(self, l):
@@ -796,6 +2100,8 @@ class TestDynamicToolDestination(unittest.TestCase):
         self.assertEqual(dt.parse_yaml(yt.vYMLTest6, test=True), yt.vdictTest6_yml)
         self.assertTrue(dt.parse_yaml(yt.vYMLTest7, test=True, return_bool=True))
         self.assertEqual(dt.parse_yaml(yt.vYMLTest7, test=True), yt.vdictTest7_yml)
+        self.assertTrue(dt.parse_yaml(yt.vYMLTest8, test=True, return_bool=True))
+        self.assertEqual(dt.parse_yaml(yt.vYMLTest8, test=True), yt.vdictTest8_yml)
         l.check(
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Running config validation...'),
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.'),
@@ -811,8 +2117,30 @@ class TestDynamicToolDestination(unittest.TestCase):
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.'),
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Running config validation...'),
             ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Running config validation...'),
+            ('dynamic_tool_destination.DynamicToolDestination', 'DEBUG', 'Finished config validation.'),
         )
 
+    def test_tool_priority_default_destination(self):
+        config = dt.parse_yaml("""
+            tools:
+              spades:
+                default_destination:
+                  priority:
+                    low: spades_low
+                    med: spades_med
+            default_destination: waffles_default
+            users:
+              user@email.com:
+                priority: low
+            verbose: False
+            """, test=True)
+        self.assertEqual( config['tools']['spades']['default_destination'],
+                          {'priority': {'low': 'spades_low', 'med': 'spades_med'}} )
+        compiled = dt.compile_config(config)
+        self.assertEqual( compiled.map('spades', "user@email.com", {}.__getitem__), ('spades_low', None) )
+        self.assertEqual( compiled.map('spades', "other@email.com", {}.__getitem__), ('spades_med', None) )
+
 #================================Testing str_to_bytes==========================
     def test_str_to_bytes_invalid(self):
         self.assertRaises(dt.MalformedYMLException, dt.str_to_bytes, "1d")
@@ -303,6 +303,33 @@ vdictTest7_yml = {
       }
     }
 }
+
+# Settings
+vYMLTest8 = """
+    tools:
+      spades:
+        default_destination: waffles_default
+    default_destination: waffles_low
+    settings:
+      record_cache: /tmp/records.sqlite
+      record_cache_size: 500
+      measurement_threads: 4
+    verbose: True
+"""
+
+vdictTest8_yml = {
+    "tools": {
+        "spades": {
+            "default_destination": "waffles_default"
+        }
+    },
+    'default_destination': "waffles_low",
+    'settings': {
+        'record_cache': '/tmp/records.sqlite',
+        'record_cache_size': 500,
+        'measurement_threads': 4
+    }
+}
 #=====================================================Invalid XML tests==========================================================
 
 # Empty file
@@ -970,3 +997,17 @@ ivYMLTest148 ='''
         priority: mine
     verbose: True
 '''
+
+# unknown setting and a setting with the wrong type
+ivYMLTest149 ='''
+    default_destination: waffles_low
+    settings:
+      record_cache: 12
+      record_cache_size: True
+      colour: blue
+    verbose: True
+'''
+
+iv149dict = {
+    'default_destination': "waffles_low"
+}